@@ -0,0 +1,290 @@
+"""
+Load test of the flyingpigeon processes.
+
+Each scenario starts a fresh interpreter, which forks one worker per concurrent client, like the pre-fork
+server does (the netCDF libraries are not thread safe). Each worker creates the WSGI application with a
+temporary configuration, sends warm-up requests, then synchronous Execute requests on the files of
+tests/testdata until all the requests of the scenario are done. The throughput, the latency percentiles and
+the largest peak resident memory of the workers are reported for each scenario, i.e. for each process type.
+The WFS polygon subsets fetch their region from the stand-in WFS server of the tests, started by the load test.
+
+Results may be saved as a baseline and later runs compared to it, failing if the throughput drops, or the
+90th latency percentile or the memory grow by more than the tolerance. Baselines depend on the machine, and
+should be saved on the machine where the comparisons run. Without a baseline, the comparison saves the
+results as baseline for the next runs, unless requests failed.
+
+Usage::
+
+    $ python benchmarks/load.py --requests 20 --concurrency 4 --save
+    $ python benchmarks/load.py --requests 20 --concurrency 4 --compare
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA = os.path.join(ROOT, 'tests', 'testdata')
+
+CMIP5 = 'file://' + os.path.join(TESTDATA, 'cmip5', 'tasmax_Amon_MPI-ESM-MR_rcp45_r1i1p1_200601-200612.nc')
+CORDEX = 'file://' + os.path.join(
+    TESTDATA, 'cordex', 'tasmax_EUR-44_MPI-M-MPI-ESM-LR_rcp45_r1i1p1_MPI-CSC-REMO2009_v1_mon_200602-200612.nc')
+INDICATORS_SMALL = 'file://' + os.path.join(TESTDATA, 'spatial_analog', 'indicators_small.nc')
+INDICATORS_MEDIUM = 'file://' + os.path.join(TESTDATA, 'spatial_analog', 'indicators_medium.nc')
+DISSIMILARITY = 'file://' + os.path.join(TESTDATA, 'spatial_analog', 'dissimilarity.nc')
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'load_baseline.json')
+
+# Scenarios: process identifier and data inputs of the Execute requests, where {wfs} is the URL of the stand-in
+# WFS server.
+SCENARIOS = {
+    'subset_bbox': ('subset_bbox', 'resource=files@xlink:href={};lat0=2;lon0=3;lat1=4;lon1=5'.format(CMIP5)),
+    'subset_countries': ('subset_countries', 'resource=@xlink:href={};region=DEU;mosaic=False'.format(CORDEX)),
+    'subset_continents': ('subset_continents',
+                          'resource=@xlink:href={};region=Africa;mosaic=False'.format(CMIP5)),
+    'pointinspection_cmip5': ('pointinspection',
+                              'resource=files@xlink:href={};coords=2.356138,48.846450;coords=10,50'.format(CMIP5)),
+    'pointinspection_cordex': ('pointinspection',
+                               'resource=files@xlink:href={};coords=2.356138,48.846450;coords=10,50'.format(CORDEX)),
+    'plot_timeseries': ('plot_timeseries', 'resource=files@xlink:href={};variable=tasmax'.format(CMIP5)),
+    'spatial_analog': ('spatial_analog',
+                       'candidate=files@xlink:href={};target=files@xlink:href={};location=-72,46;'
+                       'indices=meantemp;indices=totalpr;dist=seuclidean;'
+                       'dateStartCandidate=1970-01-01T00:00:00;dateEndCandidate=1990-01-01T00:00:00;'
+                       'dateStartTarget=1970-01-01T00:00:00;dateEndTarget=1990-01-01T00:00:00'.format(
+                           INDICATORS_SMALL, INDICATORS_MEDIUM)),
+    'plot_spatial_analog': ('plot_spatial_analog',
+                            'resource=files@xlink:href={};fmt=png;title=Load test'.format(DISSIMILARITY)),
+    'subset_wfs_polygon': ('subset-wfs-polygon',
+                           'resource=files@xlink:href={};typename=public:regions;featureids=regions.1;'
+                           'geoserver={{wfs}}'.format(CMIP5)),
+}
+
+# Region returned by the stand-in WFS server: lon0, lat0, lon1, lat1.
+WFS_REGION = (0, 40, 20, 55)
+
+# Measures compared to the baselines, and whether larger values are better.
+COMPARED = {'throughput': True, 'p90': False, 'peak_rss': False}
+
+CONFIG = """
+[server]
+allowedinputpaths = /
+workdir = {tmp}
+outputpath = {tmp}/outputs
+parallelprocesses = -1
+[logging]
+level = WARNING
+file = {tmp}/flyingpigeon.log
+database = sqlite:///{tmp}/pywps-logs.sqlite
+[extra]
+processes = {identifier}
+cache_dir = {tmp}/cache
+metrics_database = {tmp}/metrics.sqlite
+"""
+
+SCRIPT = """
+import json, multiprocessing, os, sys, tempfile, time
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+args = json.loads(sys.argv[1])
+tmp = tempfile.mkdtemp(prefix='flyingpigeon-load-')
+os.makedirs(os.path.join(tmp, 'outputs'))
+cfg = os.path.join(tmp, 'load.cfg')
+with open(cfg, 'w') as f:
+    f.write(args['config'].format(tmp=tmp, identifier=args['identifier']))
+
+from flyingpigeon.metrics import peak_rss
+from flyingpigeon.wsgi import create_app
+query = {'service': 'WPS', 'request': 'Execute', 'version': '1.0.0', 'identifier': args['identifier'],
+         'datainputs': args['datainputs']}
+
+def execute(client):
+    tic = time.perf_counter()
+    resp = client.get('/wps', query_string=query)
+    latency = time.perf_counter() - tic
+    ok = resp.status_code == 200 and b'ProcessSucceeded' in resp.get_data()
+    if not ok:
+        sys.stderr.write(resp.get_data(as_text=True)[:2000] + '\\n')
+    return latency, ok
+
+def worker(barrier, tasks, results):
+    try:
+        client = Client(create_app([cfg]), BaseResponse)
+        for i in range(args['warmup']):
+            execute(client)
+    except BaseException:
+        barrier.abort()
+        raise
+    barrier.wait()
+    while tasks.get() is not None:
+        results.put(('run', execute(client)))
+    results.put(('rss', peak_rss()))
+
+ctx = multiprocessing.get_context('fork')
+barrier, tasks, results = ctx.Barrier(args['concurrency'] + 1), ctx.Queue(), ctx.Queue()
+for i in range(args['requests']):
+    tasks.put(i)
+for i in range(args['concurrency']):
+    tasks.put(None)
+workers = [ctx.Process(target=worker, args=(barrier, tasks, results)) for i in range(args['concurrency'])]
+for w in workers:
+    w.start()
+
+barrier.wait()
+tic = time.perf_counter()
+runs, rss = [], []
+while len(runs) < args['requests'] or len(rss) < len(workers):
+    # Raises queue.Empty if a worker died.
+    kind, value = results.get(timeout=args['timeout'])
+    if kind == 'rss':
+        rss.append(value)
+        continue
+    runs.append(value)
+    if len(runs) == args['requests']:
+        wall = time.perf_counter() - tic
+for w in workers:
+    w.join()
+
+print(json.dumps({'wall': wall, 'latencies': [r[0] for r in runs], 'errors': sum(not r[1] for r in runs),
+                  'peak_rss': max(rss)}))
+"""
+
+
+def region(ids):
+    lon0, lat0, lon1, lat1 = WFS_REGION
+    ring = [[lon0, lat0], [lon1, lat0], [lon1, lat1], [lon0, lat1], [lon0, lat0]]
+    return [{'type': 'Polygon', 'coordinates': [ring]}]
+
+
+def wfs_server():
+    """Return the stand-in WFS server of the tests, answering GetFeature requests with the `WFS_REGION` polygon."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from tests.common import StandInServer, wfs_respond
+    return StandInServer(wfs_respond(region))
+
+
+def percentile(values, q):
+    """Return the q-th percentile of values, by the nearest rank method."""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(q / 100. * len(values))) - 1)]
+
+
+def run_scenario(name, requests=10, concurrency=2, warmup=1, timeout=600, wfs=''):
+    """Run a scenario in a fresh interpreter and return its results.
+
+    :param timeout: maximum time in seconds between two responses
+    :param wfs: URL of the WFS server
+    """
+    if requests < 1 or concurrency < 1:
+        raise ValueError('A scenario needs at least one request and one client.')
+    identifier, datainputs = SCENARIOS[name]
+    args = {'identifier': identifier, 'datainputs': datainputs.format(wfs=wfs), 'requests': requests,
+            'concurrency': concurrency, 'warmup': warmup, 'timeout': timeout, 'config': CONFIG}
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT, json.dumps(args)], cwd=ROOT)
+    run = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    latencies = run['latencies']
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': run['errors'],
+        'throughput': requests / run['wall'],
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+        'peak_rss': run['peak_rss'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of the results compared to the baseline, as a list of messages."""
+    regressions = []
+    for name, result in results.items():
+        if result['errors']:
+            regressions.append('{}: {} failed requests'.format(name, result['errors']))
+        reference = baseline.get('scenarios', {}).get(name)
+        if reference is None:
+            continue
+        for key, larger_is_better in COMPARED.items():
+            ratio = result[key] / reference[key] if reference[key] else 1
+            if (ratio < 1 - tolerance) if larger_is_better else (ratio > 1 + tolerance):
+                regressions.append('{}: {} {:.4g} vs {:.4g} in the baseline'.format(
+                    name, key, result[key], reference[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run, all by default: {}'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--requests', type=int, default=10, help='number of requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=2, help='number of concurrent requests')
+    parser.add_argument('--warmup', type=int, default=1, help='number of requests sent before measuring')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save the results as baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results to the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative tolerance of the comparison')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios).difference(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    if args.requests < 1:
+        parser.error('--requests must be at least 1')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.warmup < 0:
+        parser.error('--warmup must not be negative')
+
+    results = {}
+    with wfs_server() as wfs:
+        for name in args.scenarios or sorted(SCENARIOS):
+            results[name] = run_scenario(name, requests=args.requests, concurrency=args.concurrency,
+                                         warmup=args.warmup, wfs=wfs.url + '/wfs')
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<24} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+            'scenario', 'errors', 'req/s', 'p50 s', 'p90 s', 'p99 s', 'max s', 'RSS MB'))
+        for name, r in sorted(results.items()):
+            print('{:<24} {:>6} {:>9.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>9.1f}'.format(
+                name, r['errors'], r['throughput'], r['p50'], r['p90'], r['p99'], r['max'], r['peak_rss'] / 2 ** 20))
+
+    status = 0
+    if args.compare:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        # Failed requests are reported even without a baseline.
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        status = 1 if regressions else 0
+        if not baseline and not regressions:
+            print('WARNING no baseline in {}, the results are saved as baseline.'.format(args.baseline))
+            args.save = True
+
+    if args.save:
+        baseline = {'scenarios': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline['scenarios'].update(results)
+        baseline.update(python=platform.python_version(), machine=platform.platform(),
+                        date=datetime.datetime.now().isoformat(timespec='seconds'))
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
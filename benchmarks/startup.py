@@ -0,0 +1,72 @@
+"""
+Startup time of the flyingpigeon service.
+
+Each run starts a fresh interpreter, creates the WSGI application and answers a GetCapabilities and a
+DescribeProcess request for all processes, which is the work done by a new server worker before it handles
+its first Execute request. The modules of the computation stacks loaded meanwhile are reported too, since
+they should only be imported by Execute requests.
+
+Usage::
+
+    $ python benchmarks/startup.py --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['ocgis', 'eggshell', 'matplotlib', 'sklearn', 'cartopy', 'fiona', 'scipy.spatial',
+                 'flyingpigeon.subset']
+
+SCRIPT = """
+import json, sys, time
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+tic = time.perf_counter()
+from flyingpigeon.wsgi import create_app
+app = create_app()
+create = time.perf_counter() - tic
+
+client = Client(app, BaseResponse)
+tic = time.perf_counter()
+assert client.get('/wps?service=WPS&request=GetCapabilities&version=1.0.0').status_code == 200
+caps = time.perf_counter() - tic
+tic = time.perf_counter()
+assert client.get('/wps?service=WPS&request=DescribeProcess&version=1.0.0&identifier=all').status_code == 200
+describe = time.perf_counter() - tic
+
+print(json.dumps({'create_app': create, 'getcapabilities': caps, 'describeprocess': describe,
+                  'modules': [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def run_once():
+    """Measure the startup of a fresh interpreter and return the timings in seconds."""
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT])
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='number of runs')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    runs = [run_once() for _ in range(args.runs)]
+    results = {key: statistics.median(run[key] for run in runs)
+               for key in ('create_app', 'getcapabilities', 'describeprocess')}
+    results['modules'] = sorted(set(m for run in runs for m in run['modules']))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key in ('create_app', 'getcapabilities', 'describeprocess'):
+            print('{:<16} {:8.3f} s (median of {} runs)'.format(key, results[key], args.runs))
+        print('heavy modules    {}'.format(', '.join(results['modules']) or 'none'))
+    return results
+
+
+if __name__ == '__main__':
+    main()
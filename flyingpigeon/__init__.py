@@ -4,4 +4,11 @@
 
 from .__version__ import __author__, __email__, __version__  # noqa: F401
 
-from .wsgi import application  # noqa: F401
+
+def __getattr__(name):
+    # The WSGI application is created on first access, so that importing a flyingpigeon module does not
+    # load the configuration and the processes.
+    if name == 'application':
+        from .wsgi import application
+        return application
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
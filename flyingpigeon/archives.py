@@ -0,0 +1,268 @@
+"""
+Reading and writing of tar and zip archives of netCDF files.
+
+Archive members are streamed one by one to the output directory, so that files become available as soon
+as they are extracted and compressed archives are read in a single pass. :class:`DatasetStream` groups them
+by dataset, so that the processes start computing a dataset as soon as its files are extracted. Output
+archives are written while the files they contain are produced.
+
+Members are not read in place from the archives, since netCDF4 and ocgis open files by path.
+"""
+import logging
+import os
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+LOGGER = logging.getLogger("PYWPS")
+
+NC_SUFFIXES = ('.nc', '.nc4', '.netcdf')
+
+
+def _is_netcdf(name):
+    return name.lower().endswith(NC_SUFFIXES)
+
+
+def _member_path(archive, name, dir_output):
+    """Return the path of an archive member in the output directory.
+
+    Members are written to a subdirectory named after the archive, keeping their directories, so that members
+    of different archives do not clash and keep the file names the datasets are grouped on.
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return os.path.join(dir_output, os.path.basename(archive).replace('.', '_'), *parts)
+
+
+def _write_member(fileobj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(fileobj, f, 1024 ** 2)
+    return path
+
+
+def iter_tar(path, dir_output):
+    """Extract the netCDF members of a tar archive, possibly compressed, and yield their paths."""
+    # Stream mode reads compressed archives sequentially, without seeking back to the start.
+    with tarfile.open(path, mode='r|*') as tf:
+        for member in tf:
+            if member.isfile() and _is_netcdf(member.name):
+                yield _write_member(tf.extractfile(member), _member_path(path, member.name, dir_output))
+
+
+def iter_zip(path, dir_output):
+    """Extract the netCDF members of a zip archive and yield their paths."""
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if not info.is_dir() and _is_netcdf(info.filename):
+                with zf.open(info) as f:
+                    yield _write_member(f, _member_path(path, info.filename, dir_output))
+
+
+def list_netcdf(resources, dir_output=None):
+    """Return the paths of the netCDF files given directly or contained in archives, as returned by
+    :func:`iter_extract`, without extracting them.
+
+    Only the index of zip archives and the headers of uncompressed tar archives are read, but compressed tar
+    archives are decompressed.
+    """
+    if isinstance(resources, str):
+        resources = [resources]
+    dir_output = os.path.abspath(dir_output or os.curdir)
+
+    paths = []
+    for resource in resources:
+        if _is_netcdf(resource):
+            paths.append(os.path.realpath(resource))
+            continue
+        try:
+            if zipfile.is_zipfile(resource):
+                with zipfile.ZipFile(resource) as zf:
+                    names = [info.filename for info in zf.infolist() if not info.is_dir()]
+            elif tarfile.is_tarfile(resource):
+                with tarfile.open(resource) as tf:
+                    names = [member.name for member in tf if member.isfile()]
+            else:
+                paths.append(os.path.realpath(resource))
+                continue
+        except (tarfile.TarError, zipfile.BadZipFile, OSError):
+            # Reported by iter_extract.
+            continue
+        paths.extend(_member_path(resource, name, dir_output) for name in names if _is_netcdf(name))
+    return paths
+
+
+def iter_extract(resources, dir_output=None):
+    """Yield the netCDF files given directly or contained in archives, as soon as they are extracted.
+
+    Only netCDF members are extracted. Archives located in the output directory, i.e. the copies of the
+    inputs made in the process working directory, are removed once extracted.
+
+    :param resources: list of netCDF files and tar or zip archives
+    :param dir_output: directory of the extracted files, default is the current directory
+    """
+    if isinstance(resources, str):
+        resources = [resources]
+    dir_output = os.path.abspath(dir_output or os.curdir)
+
+    for resource in resources:
+        if _is_netcdf(resource):
+            yield os.path.realpath(resource)
+            continue
+        try:
+            if zipfile.is_zipfile(resource):
+                members = iter_zip(resource, dir_output)
+            elif tarfile.is_tarfile(resource):
+                members = iter_tar(resource, dir_output)
+            else:
+                LOGGER.warning('Unknown file type, used as netCDF file: {}'.format(resource))
+                yield os.path.realpath(resource)
+                continue
+            for path in members:
+                yield path
+        except (tarfile.TarError, zipfile.BadZipFile, OSError) as e:
+            LOGGER.exception('Failed to extract archive {}: {}'.format(resource, e))
+            continue
+
+        if os.path.dirname(os.path.abspath(resource)) == dir_output:
+            os.remove(resource)
+
+
+def extract_archive(resources, dir_output=None):
+    """Return the list of netCDF files given directly or contained in archives.
+
+    See :func:`iter_extract`.
+    """
+    return list(iter_extract(resources, dir_output))
+
+
+class DatasetStream(object):
+    """Datasets of the netCDF files given directly or contained in archives, returned as soon as their files
+    are extracted.
+
+    The datasets are known before extracting the archives, from the names of their members::
+
+        datasets = DatasetStream(resources, dir_output=workdir)
+        for key, files in datasets:
+            ...
+
+    :param resources: list of netCDF files and tar or zip archives
+    :param dir_output: directory of the extracted files, default is the current directory
+    :param historical_concatination: whether the historical files are added to the scenario datasets, see
+                                      :func:`eggshell.nc.nc_utils.sort_by_filename`
+    """
+
+    def __init__(self, resources, dir_output=None, historical_concatination=False):
+        from eggshell.nc.nc_utils import sort_by_filename
+
+        self.resources = resources
+        self.dir_output = dir_output
+        paths = list_netcdf(resources, dir_output)
+        datasets = sort_by_filename(paths, historical_concatination=historical_concatination) if paths else {}
+        self.datasets = OrderedDict(
+            (key, [files] if isinstance(files, str) else list(files)) for key, files in datasets.items())
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def keys(self):
+        return list(self.datasets.keys())
+
+    def __iter__(self):
+        """Extract the archives and yield (key, files) tuples, each dataset as soon as all its files are
+        extracted. Datasets with files that could not be extracted are returned at the end with the other
+        files."""
+        pending = OrderedDict(self.datasets)
+        extracted = set()
+        for path in iter_extract(self.resources, self.dir_output):
+            extracted.add(path)
+            for key, files in list(pending.items()):
+                if extracted.issuperset(files):
+                    del pending[key]
+                    yield key, files
+        for key, files in pending.items():
+            files = [path for path in files if path in extracted]
+            if files:
+                LOGGER.warning('Dataset {} is incomplete'.format(key))
+                yield key, files
+
+
+class TarWriter(object):
+    """Tar archive to which files are appended by a background thread as soon as they are produced.
+
+    Files are read right after they are written, while they are still in the page cache, and archiving
+    overlaps with the computation of the next files::
+
+        with TarWriter(dir_output=workdir) as tar:
+            for ...:
+                tar.add(path)
+        response.outputs['output'].file = tar.path
+
+    :param dir_output: directory of the archive
+    :param compress: whether the archive is compressed with gzip. NetCDF4 files are usually compressed
+                     already, so this mostly costs time.
+    :param on_added: function called with the path of each file once appended, e.g. to remove it. Its
+                     errors stop the archiving and are raised by :meth:`close`.
+    """
+
+    def __init__(self, dir_output=None, compress=False, on_added=None):
+        suffix = '.tar.gz' if compress else '.tar'
+        fd, self.path = tempfile.mkstemp(prefix='archive_', suffix=suffix, dir=dir_output)
+        os.close(fd)
+        self._tar = tarfile.open(self.path, 'w:gz' if compress else 'w')
+        self._queue = queue.Queue()
+        self._error = None
+        self._on_added = on_added
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._tar.add(path, arcname=os.path.basename(path))
+            except Exception as e:
+                LOGGER.exception('Failed to add {} to {}'.format(path, self.path))
+                self._error = IOError('Tar file preparation failed: {}'.format(e))
+                continue
+            if self._on_added is not None:
+                try:
+                    self._on_added(path)
+                except Exception as e:
+                    LOGGER.exception('Failed to handle {} added to {}'.format(path, self.path))
+                    self._error = e
+
+    def add(self, path):
+        """Append a file to the archive."""
+        self._queue.put(path)
+
+    def close(self):
+        """Wait until all files are appended, close the archive and return its path."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if not self._tar.closed:
+            self._tar.close()
+        if self._error is not None:
+            raise self._error
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The archive is closed without hiding the exception raised in the block.
+            try:
+                self.close()
+            except Exception:
+                pass
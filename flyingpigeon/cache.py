@@ -0,0 +1,147 @@
+"""
+Caches shared between requests.
+
+Disk caches live in the directory given by the ``cache_dir`` option of the ``[extra]`` configuration
+section, by default a ``flyingpigeon_cache`` directory in the PyWPS working directory.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from collections import Counter
+
+from pywps import configuration
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Hits and misses of the disk caches in the current process, by (cache name, 'hits' or 'misses').
+STATISTICS = Counter()
+
+
+def make_key(*parts):
+    """Return a hexadecimal digest identifying the given parts."""
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(repr(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class DiskCache(object):
+    """Directory of files identified by a key, evicting the least recently used files above a maximum size.
+
+    :param path: cache directory, created if needed
+    :param max_size: maximum size of the cache in bytes, or None for no limit
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key, suffix=''):
+        """Return the path where the entry `key` is stored."""
+        return os.path.join(self.path, key[:2], key + suffix)
+
+    @property
+    def name(self):
+        return os.path.basename(os.path.normpath(self.path))
+
+    def get(self, key, suffix=''):
+        """Return the path of a cached file, or None if it is not in the cache."""
+        filename = self.filename(key, suffix)
+        try:
+            # The modification time tracks the last use of an entry.
+            os.utime(filename, None)
+        except OSError:
+            self.misses += 1
+            STATISTICS[self.name, 'misses'] += 1
+            return None
+        self.hits += 1
+        STATISTICS[self.name, 'hits'] += 1
+        return filename
+
+    def put(self, key, write, suffix=''):
+        """Store a new entry and return its path.
+
+        :param key: entry key, see :func:`make_key`
+        :param write: function writing the entry to the path given as argument
+        :param suffix: file name suffix of the entry
+        """
+        filename = self.filename(key, suffix)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see partial entries.
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', suffix=suffix, dir=os.path.dirname(filename))
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.prune()
+        return filename
+
+    def entries(self):
+        """Return a list of (last use, size, path) tuples of the cached files."""
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def prune(self):
+        """Remove the least recently used files until the cache fits within its maximum size."""
+        if not self.max_size:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def get_cache_dir():
+    """Return the root directory of the disk caches, or None if they are disabled."""
+    path = configuration.get_config_value('extra', 'cache_dir')
+    if path is False:
+        return None
+    if not path:
+        workdir = configuration.get_config_value('server', 'workdir') or tempfile.gettempdir()
+        path = os.path.join(workdir, 'flyingpigeon_cache')
+    return path
+
+
+def get_disk_cache(name, size_option=None):
+    """Return the disk cache `name`, or None if disk caches are disabled.
+
+    :param name: name of the cache, used as sub-directory of the cache directory
+    :param size_option: name of the `[extra]` option giving the maximum size of the cache, e.g. '500mb'
+    """
+    root = get_cache_dir()
+    if root is None:
+        return None
+    max_size = None
+    if size_option:
+        size = configuration.get_config_value('extra', size_option)
+        if size:
+            max_size = int(configuration.get_size_mb(size) * 1024 ** 2)
+    try:
+        return DiskCache(os.path.join(root, name), max_size=max_size)
+    except OSError as e:
+        LOGGER.warning('Cache {} disabled: {}'.format(name, e))
+        return None
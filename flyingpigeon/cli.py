@@ -1,11 +1,13 @@
 ###########################################################
-# Demo WPS service for testing and debugging.
+# Demo WPS service for testing and debugging, or gunicorn
+# pre-fork server for production.
 #
 # See the werkzeug documentation on how to use the debugger:
 # http://werkzeug.pocoo.org/docs/0.12/debug/
 ###########################################################
 
 import os
+import signal
 import psutil
 import click
 from jinja2 import Environment, PackageLoader
@@ -64,7 +66,8 @@ def run_process_action(action=None):
                 from psutil import _pprint_secs
                 msg = "pid={}, status={}, created={}".format(
                     p.pid, p.status(), _pprint_secs(p.create_time()))
-        if action == 'stop':
+        if action == 'stop' and os.path.exists(PID_FILE):
+            # gunicorn removes its PID file itself.
             os.remove(PID_FILE)
     except IOError:
         msg = 'No PID file found. Service not running? Try "netstat -nlp | grep :5000".'
@@ -73,15 +76,23 @@ def run_process_action(action=None):
     click.echo(msg)
 
 
+def is_gunicorn(pid):
+    """Return whether a process is a gunicorn master, which reloads its workers on SIGHUP."""
+    return any('gunicorn' in arg for arg in psutil.Process(pid).cmdline())
+
+
+def _static_files():
+    # need to serve the wps outputs
+    return {
+        '/outputs': configuration.get_config_value('server', 'outputpath')
+    }
+
+
 def _run(application, bind_host=None, daemon=False):
     from werkzeug.serving import run_simple
     # call this *after* app is initialized ... needs pywps config.
     host, port = get_host()
     bind_host = bind_host or host
-    # need to serve the wps outputs
-    static_files = {
-        '/outputs': configuration.get_config_value('server', 'outputpath')
-    }
     run_simple(
         hostname=bind_host,
         port=port,
@@ -91,7 +102,86 @@ def _run(application, bind_host=None, daemon=False):
         threaded=True,
         # processes=2,
         use_evalex=not daemon,
-        static_files=static_files)
+        static_files=_static_files())
+
+
+def serve_outputs(application):
+    """Wrap the WPS application so that it also serves the output files."""
+    try:
+        from werkzeug.middleware.shared_data import SharedDataMiddleware
+    except ImportError:  # werkzeug < 0.15
+        from werkzeug.wsgi import SharedDataMiddleware
+    return SharedDataMiddleware(application, _static_files())
+
+
+def gunicorn_options(bind, workers=4, threads=1, timeout=300, graceful_timeout=60, max_requests=0,
+                     daemon=False):
+    """Return the gunicorn settings of the production server.
+
+    :param bind: address of the server, as host:port
+    :param workers: number of worker processes
+    :param threads: number of threads per worker process, handling requests concurrently
+    :param timeout: time in seconds after which a worker handling a request is killed and restarted
+    :param graceful_timeout: time in seconds given to workers to finish their requests on reload or stop
+    :param max_requests: number of requests after which a worker is restarted, 0 to disable
+    :param daemon: whether the server runs in the background
+    """
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'max_requests': max_requests,
+        # Spread worker restarts, so that workers are not all restarted at the same time.
+        'max_requests_jitter': max_requests // 10,
+        # The application is loaded once, before forking the workers.
+        'preload_app': True,
+        'daemon': daemon,
+    }
+    if daemon:
+        options['pidfile'] = PID_FILE
+    return options
+
+
+def _run_production(create, bind_host=None, daemon=False, **kwargs):
+    """Serve the application with a pre-fork gunicorn server.
+
+    :param create: function returning the WPS application, called again on reload (SIGHUP)
+    :param bind_host: IP address of the server
+    :param daemon: whether the server runs in the background
+    :param kwargs: gunicorn settings, see :func:`gunicorn_options`
+    """
+    try:
+        from gunicorn import util
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise click.ClickException('The gunicorn server requires the gunicorn package.')
+
+    host, port = get_host()
+    options = gunicorn_options('{}:{}'.format(bind_host or host, port), daemon=daemon, **kwargs)
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return serve_outputs(create())
+
+        def reload(self):
+            # Reload the configuration and processes, then fork new workers from the new application.
+            self.callable = None
+            super(Server, self).reload()
+
+        def run(self):
+            # Only the gunicorn command line application daemonizes, not BaseApplication.
+            if self.cfg.daemon:
+                util.daemonize(self.cfg.enable_stdio_inheritance)
+            super(Server, self).run()
+
+    Server().run()
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
@@ -99,8 +189,8 @@ def _run(application, bind_host=None, daemon=False):
 def cli():
     """Command line to start/stop a PyWPS service.
 
-    Do not use this service in a production environment.
-    It's intended to be running in a test environment only!
+    The default werkzeug server is intended to be running in a test environment only!
+    Use `start --server gunicorn` in a production environment.
     For more documentation, visit http://pywps.org/doc
     """
     pass
@@ -118,6 +208,29 @@ def stop():
     run_process_action(action='stop')
 
 
+@cli.command()
+def reload():
+    """Reload configuration and processes of the PyWPS service (gunicorn server only).
+
+    Running requests are completed by the old workers before they exit.
+    """
+    try:
+        with open(PID_FILE, 'r') as fp:
+            pid = int(fp.read())
+        if not is_gunicorn(pid):
+            # SIGHUP would stop the werkzeug server.
+            click.echo('pid={} is not a gunicorn server, use stop and start instead.'.format(pid))
+            return
+        os.kill(pid, signal.SIGHUP)
+        click.echo("pid={}, status=reloading".format(pid))
+    except IOError:
+        click.echo('No PID file found. Service not running?')
+    except psutil.NoSuchProcess as e:
+        click.echo(e.msg)
+    except (ValueError, OSError) as e:
+        click.echo(e)
+
+
 @cli.command()
 @click.option('--config', '-c', metavar='PATH', help='path to pywps configuration file.')
 @click.option('--bind-host', '-b', metavar='IP-ADDRESS', default='127.0.0.1',
@@ -131,11 +244,25 @@ def stop():
 @click.option('--log-level', metavar='LEVEL', default='INFO', help='log level in PyWPS configuration.')
 @click.option('--log-file', metavar='PATH', default='pywps.log', help='log file in PyWPS configuration.')
 @click.option('--database', default='sqlite:///pywps-logs.sqlite', help='database in PyWPS configuration')
+@click.option('--server', type=click.Choice(['werkzeug', 'gunicorn']), default='werkzeug',
+              help='werkzeug development server, or gunicorn pre-fork server for production.')
+@click.option('--workers', metavar='INT', default=4, type=int, help='number of gunicorn worker processes.')
+@click.option('--threads', metavar='INT', default=1, type=int, help='number of threads per gunicorn worker.')
+@click.option('--timeout', metavar='SECONDS', default=300, type=int,
+              help='gunicorn workers silent for more than this many seconds are killed and restarted.')
+@click.option('--graceful-timeout', metavar='SECONDS', default=60, type=int,
+              help='time given to gunicorn workers to finish their requests on reload or stop.')
+@click.option('--max-requests', metavar='INT', default=0, type=int,
+              help='number of requests after which a gunicorn worker is restarted (0 disables restarts).')
 def start(config, bind_host, daemon, hostname, port,
           maxsingleinputsize, maxprocesses, parallelprocesses,
-          log_level, log_file, database):
+          log_level, log_file, database,
+          server, workers, threads, timeout, graceful_timeout, max_requests):
     """Start PyWPS service.
     This service is by default available at http://localhost:8093/wps
+
+    Use `--server gunicorn` in production. Its workers are forked from an application loaded once,
+    and `flyingpigeon reload` reloads the configuration and restarts the workers gracefully.
     """
     if os.path.exists(PID_FILE):
         click.echo('PID file exists: "{}". Service still running?'.format(PID_FILE))
@@ -154,6 +281,16 @@ def start(config, bind_host, daemon, hostname, port,
     if config:
         cfgfiles.append(config)
     app = wsgi.create_app(cfgfiles)
+    if server == 'gunicorn':
+        # The gunicorn server daemonizes itself and writes the PID file.
+        created = [app]
+
+        def create():
+            return created.pop() if created else wsgi.create_app(cfgfiles)
+
+        _run_production(create, bind_host=bind_host, daemon=daemon, workers=workers, threads=threads,
+                        timeout=timeout, graceful_timeout=graceful_timeout, max_requests=max_requests)
+        return
     # let's start the service ...
     # See:
     # * https://github.com/geopython/pywps-flask/blob/master/demo.py
@@ -0,0 +1,109 @@
+"""
+Compatibility with the private API of PyWPS.
+
+The job scheduler (:mod:`flyingpigeon.jobs`), the free disk space guard (:mod:`flyingpigeon.workdir`) and the
+profiler (:mod:`flyingpigeon.profiling`) replace private methods of the processes prepared for execution, and the
+scheduler starts its queued jobs like :meth:`pywps.app.Process.Process.launch_next_process` starts the stored
+requests. The downloads of remote inputs (:mod:`flyingpigeon.remote`) read the body of POST references, which
+PyWPS 4.2 hides. These methods and attributes are not part of the PyWPS API and may change in any release, so they
+are only used through this module, and :func:`check` refuses to create the service if the installed PyWPS does
+not provide the methods.
+"""
+import inspect
+import json
+
+import pywps
+from pywps.app.Process import Process
+from pywps.app.WPSRequest import WPSRequest
+from pywps.response.execute import ExecuteResponse
+from pywps.response.status import WPS_STATUS
+
+# Private methods used by flyingpigeon, with the names of their arguments.
+PRIVATE_METHODS = [
+    (Process, '_execute_process', ('self', 'async_', 'wps_request', 'wps_response')),
+    (Process, '_run_process', ('self', 'wps_request', 'wps_response')),
+    (Process, '_run_async', ('self', 'wps_request', 'wps_response')),
+    (Process, 'launch_next_process', ('self',)),
+    (Process, '_set_uuid', ('self', 'uuid')),
+    (Process, '_setup_status_storage', ('self',)),
+    (ExecuteResponse, '__init__', ('self', 'wps_request', 'uuid', 'kwargs')),
+    (ExecuteResponse, '_update_status', ('self', 'status', 'message', 'status_percentage', 'clean')),
+]
+
+# Methods of the processes which may be replaced with :func:`override`.
+OVERRIDABLE = ('_execute_process', '_run_process', 'launch_next_process')
+
+
+def check():
+    """Raise :class:`RuntimeError` if the installed PyWPS lacks a private method used by flyingpigeon, or if its
+    arguments changed."""
+    errors = []
+    for cls, name, args in PRIVATE_METHODS:
+        method = getattr(cls, name, None)
+        if method is None:
+            errors.append('{}.{} is missing'.format(cls.__name__, name))
+            continue
+        found = tuple(inspect.signature(method).parameters)
+        if found != args:
+            errors.append('{}.{} takes ({}) instead of ({})'.format(cls.__name__, name, ', '.join(found),
+                                                                    ', '.join(args)))
+    if errors:
+        raise RuntimeError('PyWPS {} is not supported: {}'.format(pywps.__version__, '; '.join(errors)))
+
+
+def override(process, name, method):
+    """Replace a method of a process prepared for execution, and return the replaced method.
+
+    :param name: name of the method, one of `OVERRIDABLE`
+    :param method: replacing function, taking the arguments of the method without `self`
+    """
+    if name not in OVERRIDABLE:
+        raise ValueError('Method {} of PyWPS processes cannot be overridden'.format(name))
+    replaced = getattr(process, name)
+    setattr(process, name, method)
+    return replaced
+
+
+def accept(wps_response, message=u'PyWPS Request accepted'):
+    """Set the status of a response to accepted."""
+    wps_response._update_status(WPS_STATUS.ACCEPTED, message, 0)
+
+
+def run(process, wps_request, wps_response):
+    """Run a process in the current process, see :meth:`pywps.app.Process.Process._run_process`."""
+    return process._run_process(wps_request, wps_response)
+
+
+def start(process, wps_request, wps_response):
+    """Run a process in a new process."""
+    process._run_async(wps_request, wps_response)
+
+
+def restore(service, uuid, request_json):
+    """Prepare the process of a stored request, like :meth:`pywps.app.Process.Process.launch_next_process`.
+
+    :param service: service preparing the process
+    :param uuid: identifier of the request
+    :param request_json: JSON description of the request, see :attr:`pywps.app.WPSRequest.WPSRequest.json`
+    :return: (process, request, response) to :func:`start`
+    """
+    wps_request = WPSRequest()
+    wps_request.json = json.loads(request_json)
+    process = service.prepare_process_for_execution(wps_request.identifier)
+    process._set_uuid(uuid)
+    process._setup_status_storage()
+    process.async_ = True
+    wps_response = ExecuteResponse(wps_request, process=process, uuid=uuid)
+    wps_response.store_status_file = True
+    return process, wps_request, wps_response
+
+
+def post_data(inpt):
+    """Return the body of a POST reference input, or None if the reference is fetched with GET.
+
+    PyWPS 4.2 stores the body in the `post_data` attribute of the input before it becomes a url handler, whose
+    `post_data` property then hides it.
+    """
+    if inpt.post_data is not None:
+        return inpt.post_data
+    return vars(inpt).get('post_data')
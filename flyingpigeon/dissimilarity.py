@@ -1,7 +1,5 @@
 # -*- encoding: utf8 -*-
 import numpy as np
-from scipy import spatial
-from scipy.spatial import cKDTree as KDTree
 
 """
 Methods to compute the (dis)similarity between samples
@@ -130,6 +128,8 @@ def seuclidean(x, y):
     21st-century climate-change scenarios. Climatic Change,
     DOI 10.1007/s10584-011-0261-z.
     """
+    from scipy import spatial
+
     x, y = reshape_sample(x, y)
 
     mx = x.mean(0)
@@ -160,6 +160,8 @@ def nearest_neighbor(x, y):
     Henze N. (1988) A Multivariate two-sample test based on the number of
     nearest neighbor type coincidences. Ann. of Stat., Vol. 16, No.2, 772-783.
     """
+    from scipy.spatial import cKDTree as KDTree
+
     x, y = reshape_sample(x, y)
     x, y = standardize(x, y)
 
@@ -200,6 +202,7 @@ def zech_aslan(x, y):
     Aslan B. and Zech G. (2008) A new class of binning-free, multivariate
     goodness-of-fit tests: the energy tests. arXiV:hep-ex/0203010v5.
     """
+    from scipy import spatial
 
     x, y = reshape_sample(x, y)
     nx, d = x.shape
@@ -414,6 +417,7 @@ def kldiv(x, y, k=1):
     Kullback-Leibler Divergence Estimation of Continuous Distributions (2008).
     Fernando Pérez-Cruz.
     """
+    from scipy.spatial import cKDTree as KDTree
 
     mk = np.iterable(k)
     ka = np.atleast_1d(k)
@@ -0,0 +1,451 @@
+"""
+Cheap access to the horizontal grid of netCDF datasets.
+
+The functions in this module only read the coordinate variables of a dataset,
+so they can be called on every input before handing it over to ocgis.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import netCDF4 as nc
+import numpy as np
+import shapely
+from shapely.affinity import translate
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+from flyingpigeon.cache import get_disk_cache, make_key
+
+LOGGER = logging.getLogger("PYWPS")
+
+_LON = ('longitude', ('degrees_east', 'degree_east', 'degrees_E', 'degree_E'), ('lon', 'longitude', 'nav_lon'))
+_LAT = ('latitude', ('degrees_north', 'degree_north', 'degrees_N', 'degree_N'), ('lat', 'latitude', 'nav_lat'))
+_RLON = ('grid_longitude', (), ('rlon',))
+_RLAT = ('grid_latitude', (), ('rlat',))
+
+
+def _first(resource):
+    if isinstance(resource, (list, tuple)):
+        return resource[0]
+    return resource
+
+
+def _find_variable(ds, standard_name, units, names):
+    for var in ds.variables.values():
+        if getattr(var, 'standard_name', None) == standard_name:
+            return var
+    for var in ds.variables.values():
+        if getattr(var, 'units', None) in units:
+            return var
+    for name in names:
+        if name in ds.variables:
+            return ds.variables[name]
+    return None
+
+
+def _rotated_pole(ds):
+    for var in ds.variables.values():
+        if getattr(var, 'grid_mapping_name', None) == 'rotated_latitude_longitude':
+            return var.grid_north_pole_longitude, var.grid_north_pole_latitude
+    raise ValueError('No rotated pole grid mapping found in {}'.format(ds.filepath()))
+
+
+def unrotate(rlon, rlat, pole_lon, pole_lat):
+    """Convert rotated pole coordinates to geographic coordinates.
+
+    :param rlon: rotated longitudes in degrees
+    :param rlat: rotated latitudes in degrees
+    :param pole_lon: longitude of the rotated north pole
+    :param pole_lat: latitude of the rotated north pole
+
+    :returns tuple: geographic longitudes and latitudes
+    """
+    rlon, rlat = np.radians(rlon), np.radians(rlat)
+    theta = np.radians(90. - pole_lat)
+    phi = np.radians(pole_lon + 180.)
+
+    x = np.cos(rlat) * np.cos(rlon)
+    y = np.cos(rlat) * np.sin(rlon)
+    z = np.sin(rlat)
+
+    x, z = np.cos(theta) * x - np.sin(theta) * z, np.sin(theta) * x + np.cos(theta) * z
+    x, y = np.cos(phi) * x - np.sin(phi) * y, np.sin(phi) * x + np.cos(phi) * y
+
+    return np.degrees(np.arctan2(y, x)), np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+
+def get_coordinates(resource):
+    """Return the geographic coordinates of the grid cell centers.
+
+    Rotated pole grids (e.g. CORDEX) are converted to geographic coordinates.
+
+    :param resource: path or OPeNDAP url of a netCDF file, or a list of files sharing the same grid
+
+    :returns tuple: longitude and latitude arrays, 1D for regular grids and 2D otherwise
+    """
+    with nc.Dataset(_first(resource)) as ds:
+        lon = _find_variable(ds, *_LON)
+        lat = _find_variable(ds, *_LAT)
+        if lon is not None and lat is not None:
+            return np.ma.filled(lon[:].astype(float), np.nan), np.ma.filled(lat[:].astype(float), np.nan)
+
+        rlon = _find_variable(ds, *_RLON)
+        rlat = _find_variable(ds, *_RLAT)
+        if rlon is None or rlat is None:
+            raise ValueError('No horizontal coordinates found in {}'.format(_first(resource)))
+        rlon, rlat = np.meshgrid(rlon[:].astype(float), rlat[:].astype(float))
+        return unrotate(rlon, rlat, *_rotated_pole(ds))
+
+
+def get_grid_spacing(lon, lat):
+    """Return the largest distance in degrees between neighbouring grid cell centers."""
+    if lon.ndim == 1:
+        steps = [np.abs(np.diff(lon)), np.abs(np.diff(lat))]
+    else:
+        steps = [np.abs(np.diff(lon, axis=axis)) for axis in (0, 1)] + \
+                [np.abs(np.diff(lat, axis=axis)) for axis in (0, 1)]
+    # Steps across the dateline are not a measure of the grid resolution.
+    steps = [s[s < 180] for s in steps if s.size]
+    return max([float(np.nanmax(s)) for s in steps if s.size] or [0.])
+
+
+def get_extent(resource):
+    """Return the extent of a dataset grid, padded by one grid spacing so that it contains all cell bounds.
+
+    :param resource: path or OPeNDAP url of a netCDF file, or a list of files sharing the same grid
+
+    :returns tuple: (minx, miny, maxx, maxy) in degrees, longitudes in the convention of the dataset
+    """
+    return coordinates_extent(*get_coordinates(resource))
+
+
+def coordinates_extent(lon, lat):
+    """Return the padded extent of a grid given its cell center coordinates, see :func:`get_extent`."""
+    pad = get_grid_spacing(lon, lat)
+    return (float(np.nanmin(lon)) - pad, max(float(np.nanmin(lat)) - pad, -90.),
+            float(np.nanmax(lon)) + pad, min(float(np.nanmax(lat)) + pad, 90.))
+
+
+def _extent_boxes(extent):
+    """Return the extent as boxes shifted by 360 degrees, or None if it covers all longitudes."""
+    minx, miny, maxx, maxy = extent
+    if maxx - minx >= 360:
+        return None
+    return [box(minx + shift, miny, maxx + shift, maxy) for shift in (-360, 0, 360)]
+
+
+def bbox_intersects(extent, bounds):
+    """Return whether geometry bounds intersect the extent of a grid, modulo 360 degrees in longitude.
+
+    :param extent: (minx, miny, maxx, maxy) extent of the grid, see :func:`get_extent`
+    :param bounds: (minx, miny, maxx, maxy) bounds of a geometry in geographic coordinates
+    """
+    boxes = _extent_boxes(extent)
+    if boxes is None:
+        return bounds[1] <= extent[3] and bounds[3] >= extent[1]
+    bbox = box(*bounds)
+    return any(b.intersects(bbox) for b in boxes)
+
+
+def clip_to_extent(geom, extent):
+    """Return the part of a geometry lying within the extent of a grid.
+
+    Grid cells are contained in the padded extent, so the cells intersecting the returned geometry
+    are the same as the ones intersecting the original one, for a fraction of its vertices.
+    """
+    boxes = _extent_boxes(extent)
+    if boxes is None:
+        return geom
+    parts = []
+    for b in boxes:
+        if b.contains(geom):
+            return geom
+        if b.intersects(geom):
+            parts.append(geom.intersection(b))
+    return unary_union(parts)
+
+
+def restrict_to_extent(geoms, extent):
+    """Return the geometry dictionaries intersecting a grid extent, with their geometry clipped to it.
+
+    :param geoms: list of dictionaries with a shapely geometry stored under the `geom` key
+    :param extent: extent of the grid, or None if unknown, in which case geometries are returned unchanged
+
+    :returns list: geometry dictionaries
+    """
+    if extent is None:
+        return geoms
+    return [dict(g, geom=clip_to_extent(g['geom'], extent))
+            for g in geoms if bbox_intersects(extent, g['geom'].bounds)]
+
+
+def _cell_edges(c):
+    mid = (c[1:] + c[:-1]) / 2.
+    return np.concatenate([[2 * c[0] - mid[0]], mid, [2 * c[-1] - mid[-1]]])
+
+
+def _cell_corners(c):
+    # Extrapolate the 2D array by one cell on each side, then average the four neighbours of each corner.
+    c = np.vstack([2 * c[:1] - c[1:2], c, 2 * c[-1:] - c[-2:-1]])
+    c = np.hstack([2 * c[:, :1] - c[:, 1:2], c, 2 * c[:, -1:] - c[:, -2:-1]])
+    return (c[1:, 1:] + c[:-1, 1:] + c[1:, :-1] + c[:-1, :-1]) / 4.
+
+
+def cell_polygons(lon, lat):
+    """Return the polygons of the grid cells, with corners halfway between neighbouring cell centers.
+
+    :returns array: shapely polygons, with the shape of the grid
+    """
+    if lon.ndim == 1:
+        x, y = _cell_edges(lon), _cell_edges(lat)
+        x0, y0 = np.meshgrid(x[:-1], y[:-1])
+        x1, y1 = np.meshgrid(x[1:], y[1:])
+        return shapely.box(x0, y0, x1, y1)
+
+    x, y = _cell_corners(lon), _cell_corners(lat)
+    rings = np.stack([
+        np.stack([x[:-1, :-1], y[:-1, :-1]], axis=-1),
+        np.stack([x[:-1, 1:], y[:-1, 1:]], axis=-1),
+        np.stack([x[1:, 1:], y[1:, 1:]], axis=-1),
+        np.stack([x[1:, :-1], y[1:, :-1]], axis=-1),
+    ], axis=-2)
+    return shapely.polygons(rings)
+
+
+def simplify_tolerance(spacing, factor):
+    """Return a simplification tolerance of about `factor` grid spacings.
+
+    The tolerance is rounded down to a power of two, so that grids of similar resolutions share it.
+    """
+    return 2. ** np.floor(np.log2(spacing * factor))
+
+
+def array_fingerprint(*arrays):
+    """Return a digest of the shapes and values of arrays, e.g. the coordinates of a grid."""
+    sha = hashlib.sha1()
+    for values in arrays:
+        sha.update(str(values.shape).encode('utf-8'))
+        sha.update(np.ascontiguousarray(values, dtype='f8').tobytes())
+    return sha.hexdigest()
+
+
+# Cell polygons and centers of the last grids, see grid_cells.
+MEMORY_GRIDS = 4
+_grid_cells = OrderedDict()
+_grid_cells_lock = threading.Lock()
+
+
+def grid_cells(lon, lat):
+    """Return the flattened cell polygons and cell centers of a grid, built once for the last grids.
+
+    :param lon: longitudes of the cell centers
+    :param lat: latitudes of the cell centers
+    """
+    key = array_fingerprint(lon, lat)
+    with _grid_cells_lock:
+        if key in _grid_cells:
+            _grid_cells.move_to_end(key)
+            return _grid_cells[key]
+    cells = cell_polygons(lon, lat).ravel()
+    centers = shapely.points(*(np.meshgrid(lon, lat) if lon.ndim == 1 else (lon, lat))).ravel()
+    with _grid_cells_lock:
+        _grid_cells[key] = cells, centers
+        while len(_grid_cells) > MEMORY_GRIDS:
+            _grid_cells.popitem(last=False)
+    return cells, centers
+
+
+def selection_preserved(lon, lat, geom, simplified, tolerance):
+    """Return whether a simplified geometry intersects the same grid cells and cell centers as the original.
+
+    The simplified boundary lies within `tolerance` of the original one, so only the cells close to it
+    need to be compared against the original geometry.
+
+    :param lon: longitudes of the cell centers
+    :param lat: latitudes of the cell centers
+    :param geom: original geometry
+    :param simplified: simplified geometry
+    :param tolerance: simplification tolerance
+    """
+    cells, centers = grid_cells(lon, lat)
+    minx, _, maxx, _ = coordinates_extent(lon, lat)
+    margin = 1.01 * tolerance
+
+    for shift in (-360, 0, 360):
+        bounds = geom.bounds
+        if bounds[2] + shift < minx or bounds[0] + shift > maxx:
+            continue
+        g, s = translate(geom, shift), translate(simplified, shift)
+        outer, inner = s.buffer(margin), s.buffer(-margin)
+        band = shapely.intersects(outer, cells) & ~shapely.within(cells, inner)
+        for items in (cells[band], centers[band]):
+            if not np.array_equal(shapely.intersects(g, items), shapely.intersects(s, items)):
+                return False
+    return True
+
+
+def _cell_bounds(ds):
+    """Return the 1D longitude and latitude bounds of a dataset, or None if it has none."""
+    lon = _find_variable(ds, *_LON)
+    lat = _find_variable(ds, *_LAT)
+    if lon is None or lat is None or lon.ndim != 1:
+        return None
+    names = getattr(lon, 'bounds', None), getattr(lat, 'bounds', None)
+    if not all(name in ds.variables for name in names):
+        return None
+    return tuple(np.ma.filled(ds.variables[name][:].astype(float), np.nan) for name in names)
+
+
+def get_cells(resource):
+    """Return the geometries used to select the cells of a grid.
+
+    Like ocgis, cells are represented by their bounds if the dataset defines them, and by their
+    center otherwise.
+
+    :returns array: shapely polygons or points, with the shape of the grid
+    """
+    with nc.Dataset(_first(resource)) as ds:
+        bounds = _cell_bounds(ds)
+    if bounds is not None:
+        xb, yb = bounds
+        x0, y0 = np.meshgrid(xb[:, 0], yb[:, 0])
+        x1, y1 = np.meshgrid(xb[:, 1], yb[:, 1])
+        return shapely.box(x0, y0, x1, y1)
+    lon, lat = get_coordinates(resource)
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    return shapely.points(lon, lat)
+
+
+def grid_fingerprint(resource):
+    """Return a digest of the horizontal coordinates of a dataset, identifying its grid."""
+    lon, lat = get_coordinates(resource)
+    with nc.Dataset(_first(resource)) as ds:
+        bounds = _cell_bounds(ds)
+    return array_fingerprint(lon, lat, *(bounds or ()))
+
+
+def coordinates_fingerprint(resource):
+    """Return a digest of the horizontal coordinate variables of a dataset, identifying its grid.
+
+    Unlike :func:`grid_fingerprint`, coordinates are not converted to geographic coordinates, so this is
+    cheap enough to look up grids in a cache. The values of one dimensional coordinates are hashed. Two
+    dimensional coordinates derived from rotated pole coordinates are identified by their attributes only,
+    while the values of curvilinear coordinates are all hashed, since such grids may only differ by a few
+    cells. Digests are remembered by file, identified by its inode, size and modification time.
+    """
+    path = _first(resource)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return _coordinates_fingerprint(path)
+    return _file_fingerprint(path, (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+
+@lru_cache(maxsize=1024)
+def _file_fingerprint(path, identity):
+    return _coordinates_fingerprint(path)
+
+
+def _coordinates_fingerprint(path):
+    sha = hashlib.sha1()
+    with nc.Dataset(path) as ds:
+        variables = [_find_variable(ds, *spec) for spec in (_LON, _LAT, _RLON, _RLAT)]
+        try:
+            pole = _rotated_pole(ds)
+        except ValueError:
+            pole = None
+        rotated = pole is not None and all(var is not None and var.ndim == 1 for var in variables[2:])
+        for var in variables:
+            if var is None:
+                sha.update(b'\0')
+                continue
+            sha.update('{}{}'.format(var.name, var.shape).encode('utf-8'))
+            if rotated and var.ndim == 2:
+                sha.update(repr(sorted(var.__dict__.items())).encode('utf-8'))
+            else:
+                sha.update(np.ascontiguousarray(np.ma.filled(var[:].astype('f8'), np.nan)).tobytes())
+        sha.update(repr(pole).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def intersects_mask(cells, geoms):
+    """Return the mask of the cells intersecting any of the geometries, modulo 360 degrees in longitude."""
+    mask = np.zeros(cells.shape, dtype=bool)
+    minx, _, maxx, _ = shapely.total_bounds(cells)
+    for geom in geoms:
+        for shift in (-360, 0, 360):
+            if geom.bounds[2] + shift < minx or geom.bounds[0] + shift > maxx:
+                continue
+            moved = translate(geom, shift)
+            shapely.prepare(moved)
+            mask |= shapely.intersects(moved, cells)
+    return mask
+
+
+def clip_weights(cells, geoms):
+    """Return the fraction of the area of each cell within the geometries, modulo 360 degrees in longitude.
+
+    Cells given by their center have a weight of 1 if they intersect a geometry.
+    """
+    weights = np.zeros(cells.shape)
+    area = shapely.area(cells)
+    minx, _, maxx, _ = shapely.total_bounds(cells)
+    for geom in geoms:
+        for shift in (-360, 0, 360):
+            if geom.bounds[2] + shift < minx or geom.bounds[0] + shift > maxx:
+                continue
+            moved = translate(geom, shift)
+            shapely.prepare(moved)
+            selected = shapely.intersects(moved, cells)
+            points = selected & (area == 0)
+            weights[points] = 1
+            polygons = selected & (area > 0)
+            weights[polygons] += shapely.area(shapely.intersection(cells[polygons], moved)) / area[polygons]
+    return np.minimum(weights, 1)
+
+
+def get_mask(resource, geoms, spatial_operation, *key):
+    """Return the cells of a dataset grid selected by the given geometries.
+
+    Masks are stored in the `masks` disk cache, keyed by the grid fingerprint, the spatial operation and `key`,
+    so the intersection is computed once per grid and region.
+
+    :param resource: path or OPeNDAP url of a netCDF file, or a list of files sharing the same grid
+    :param geoms: shapely geometries in geographic coordinates
+    :param spatial_operation: ocgis spatial operation. `intersects` selects the cells intersecting the geometries,
+                              `clip` also weights them by the fraction of their area within the geometries.
+    :param key: values identifying the geometries, e.g. shapefile name and geometry ids
+
+    :returns tuple: (window, mask), where window is the (row start, row stop, column start, column stop) index
+                    bounds of the selected cells and mask the selection within it, as booleans for `intersects`
+                    and weights for `clip`. (None, None) if no cell is selected.
+    """
+    if spatial_operation not in ('intersects', 'clip'):
+        raise ValueError('Unknown spatial operation: {}'.format(spatial_operation))
+    cache = get_disk_cache('masks', 'mask_cache_size')
+    key = make_key(grid_fingerprint(resource), spatial_operation, *key)
+
+    path = cache.get(key, '.npz') if cache else None
+    if path is not None:
+        with np.load(path) as data:
+            window, mask = data['window'], data['mask']
+    else:
+        cells = get_cells(resource)
+        mask = clip_weights(cells, geoms) if spatial_operation == 'clip' else intersects_mask(cells, geoms)
+        rows, cols = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+        if rows.size:
+            window = np.array([rows[0], rows[-1] + 1, cols[0], cols[-1] + 1])
+            mask = mask[window[0]:window[1], window[2]:window[3]]
+        else:
+            window, mask = np.array([], dtype=int), np.array([], dtype=mask.dtype)
+        if cache:
+            cache.put(key, lambda p: np.savez_compressed(p, window=window, mask=mask), '.npz')
+
+    if not window.size:
+        return None, None
+    return tuple(int(i) for i in window), mask
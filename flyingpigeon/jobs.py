@@ -0,0 +1,358 @@
+"""
+Scheduling of Execute requests.
+
+PyWPS starts asynchronous requests while fewer than `parallelprocesses` requests are running, and keeps the
+others in a single first-in first-out queue, so that a few long jobs, e.g. spatial analogs, hold all the
+execution slots while cheap subsets wait behind them. The scheduler replaces this queue:
+
+* processes belong to the `fast` or the `heavy` job class, see the `heavy_processes` option;
+* heavy jobs use at most `heavy_slots` of the `parallelprocesses` slots, so that fast jobs always find a slot;
+* when a slot is free, queued fast jobs start before heavy ones, and within a class, the oldest job of the
+  user with the fewest running jobs starts first (fair share).
+
+The queue is a SQLite database shared by all the processes of the server, which plays the role of a local
+broker: jobs submitted by a server worker may be started by another worker, by a job when it completes, or by
+the periodic dispatch of any worker, which restarts the queue after a job process was killed or while no job was
+running.
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from pywps import configuration
+from pywps.exceptions import ServerBusy
+
+from flyingpigeon import compat
+from flyingpigeon.workdir import check_free_space, has_free_space
+
+LOGGER = logging.getLogger("PYWPS")
+
+FAST = 'fast'
+HEAVY = 'heavy'
+
+# Job classes by decreasing priority.
+JOB_CLASSES = [FAST, HEAVY]
+
+DEFAULT_HEAVY_PROCESSES = ['spatial_analog', 'subset_countries', 'subset_continents']
+
+QUEUED = 'queued'
+RUNNING = 'running'
+
+# Time in seconds after which a job selected to run but whose process did not start is dropped.
+START_TIMEOUT = 600
+
+# Default interval in seconds between the periodic dispatches of the queued jobs.
+DISPATCH_INTERVAL = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    identifier TEXT NOT NULL,
+    job_class TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    started REAL,
+    host TEXT,
+    pid INTEGER,
+    request BLOB
+)
+"""
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue(object):
+    """Queue of jobs stored in a SQLite database.
+
+    :param path: path of the database, created if needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as db:
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            # Transactions lock the database right away, so that concurrent schedulers see consistent slots.
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def submit(self, uuid, identifier, job_class, user, request, max_queued=-1):
+        """Add a job to the queue.
+
+        :param request: JSON description of the request, see :attr:`pywps.app.WPSRequest.WPSRequest.json`
+        :param max_queued: maximum number of queued jobs, -1 for no limit
+        :raises ServerBusy: if the queue is full
+        """
+        with self._transaction() as db:
+            if max_queued != -1:
+                queued, = db.execute('SELECT COUNT(*) FROM jobs WHERE state = ?', (QUEUED,)).fetchone()
+                if queued >= max_queued:
+                    raise ServerBusy('Maximum number of processes in queue reached. Please try later.')
+            db.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (str(uuid), identifier, job_class, user, QUEUED, time.time(), None, None, None, request))
+
+    def acquire(self, uuid, identifier, job_class, user, slots, heavy_slots):
+        """Register a job running in the current process if a slot is free, and return whether it is."""
+        with self._transaction() as db:
+            running = self._running(db)
+            if not self._has_slot(running, job_class, slots, heavy_slots):
+                return False
+            now = time.time()
+            db.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (str(uuid), identifier, job_class, user, RUNNING, now, now, socket.gethostname(),
+                        os.getpid(), None))
+        return True
+
+    def started(self, uuid, pid):
+        """Record the process running a job."""
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET pid = ?, host = ? WHERE uuid = ?', (pid, socket.gethostname(), str(uuid)))
+
+    def finish(self, uuid):
+        """Remove a completed job."""
+        with self._transaction() as db:
+            db.execute('DELETE FROM jobs WHERE uuid = ?', (str(uuid),))
+
+    def _running(self, db):
+        """Return the (class, user) of the running jobs, removing the jobs whose process died on this host,
+        or which never started."""
+        host = socket.gethostname()
+        running = []
+        for uuid, job_class, user, started, pid, job_host in db.execute(
+                'SELECT uuid, job_class, user, started, pid, host FROM jobs WHERE state = ?', (RUNNING,)).fetchall():
+            if pid is None:
+                lost = time.time() - started > START_TIMEOUT
+            else:
+                lost = job_host == host and not _pid_alive(pid)
+            if lost:
+                LOGGER.warning('Job {} ended without completing, removed from the job queue'.format(uuid))
+                db.execute('DELETE FROM jobs WHERE uuid = ?', (uuid,))
+                continue
+            running.append((job_class, user))
+        return running
+
+    @staticmethod
+    def _has_slot(running, job_class, slots, heavy_slots):
+        if slots != -1 and len(running) >= slots:
+            return False
+        if job_class == HEAVY and heavy_slots != -1:
+            return sum(1 for c, _ in running if c == HEAVY) < heavy_slots
+        return True
+
+    def next_jobs(self, slots, heavy_slots):
+        """Mark the jobs to start in the free slots as running, and return their (uuid, request).
+
+        :param slots: total number of slots, -1 for no limit
+        :param heavy_slots: maximum number of running heavy jobs, -1 for no limit
+        """
+        selected = []
+        with self._transaction() as db:
+            running = self._running(db)
+            queued = db.execute('SELECT uuid, job_class, user, request FROM jobs WHERE state = ? '
+                                'ORDER BY submitted', (QUEUED,)).fetchall()
+            while queued:
+                job = None
+                for job_class in JOB_CLASSES:
+                    if not self._has_slot(running, job_class, slots, heavy_slots):
+                        continue
+                    candidates = [j for j in queued if j[1] == job_class]
+                    if candidates:
+                        # Oldest job of the users with the fewest running jobs
+                        job = min(candidates, key=lambda j: sum(1 for _, u in running if u == j[2]))
+                        break
+                if job is None:
+                    break
+                queued.remove(job)
+                running.append((job[1], job[2]))
+                db.execute('UPDATE jobs SET state = ?, started = ?, pid = NULL WHERE uuid = ?',
+                           (RUNNING, time.time(), job[0]))
+                selected.append((job[0], job[3]))
+        return selected
+
+    def jobs(self):
+        """Return the list of (uuid, identifier, class, user, state) of the jobs."""
+        with self._transaction() as db:
+            return db.execute('SELECT uuid, identifier, job_class, user, state FROM jobs '
+                              'ORDER BY submitted').fetchall()
+
+
+class Scheduler(object):
+    """Scheduler of the Execute requests of a service.
+
+    :param queue: job queue, see :class:`JobQueue`
+    :param heavy_processes: identifiers of the processes of the heavy job class
+    :param heavy_slots: maximum number of running heavy jobs, -1 for no limit
+    :param user_header: HTTP header identifying users, the client address is used by default
+    :param interval: interval in seconds between the periodic dispatches of the queued jobs, see :meth:`watch`
+    """
+
+    def __init__(self, queue, heavy_processes=DEFAULT_HEAVY_PROCESSES, heavy_slots=1, user_header=None,
+                 interval=DISPATCH_INTERVAL):
+        self.queue = queue
+        self.heavy_processes = set(heavy_processes)
+        self.heavy_slots = heavy_slots
+        self.user_header = user_header
+        self.interval = interval
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def slots():
+        return int(configuration.get_config_value('server', 'parallelprocesses'))
+
+    def job_class(self, identifier):
+        return HEAVY if identifier in self.heavy_processes else FAST
+
+    def user(self, wps_request):
+        http_request = getattr(wps_request, 'http_request', None)
+        if http_request is None:
+            return ''
+        if self.user_header and http_request.headers.get(self.user_header):
+            return http_request.headers[self.user_header]
+        return http_request.remote_addr or ''
+
+    def attach(self, process):
+        """Schedule the executions of a process prepared for execution."""
+        scheduler = self
+
+        def execute(async_, wps_request, wps_response):
+            return scheduler.execute(process, async_, wps_request, wps_response)
+
+        def run(wps_request, wps_response):
+            scheduler.queue.started(process.uuid, os.getpid())
+            try:
+                return run_process(wps_request, wps_response)
+            finally:
+                scheduler.queue.finish(process.uuid)
+                scheduler.dispatch(process.service)
+
+        compat.override(process, '_execute_process', execute)
+        run_process = compat.override(process, '_run_process', run)
+        # Replaced by the dispatch of the scheduler queue.
+        compat.override(process, 'launch_next_process', lambda: None)
+
+    def execute(self, process, async_, wps_request, wps_response):
+        """Run or queue an Execute request, replaces the `_execute_process` method of PyWPS processes."""
+        job_class = self.job_class(process.identifier)
+        user = self.user(wps_request)
+
+        if not async_:
+            check_free_space()
+            if not self.queue.acquire(process.uuid, process.identifier, job_class, user, self.slots(),
+                                      self.heavy_slots):
+                raise ServerBusy('Maximum number of parallel running processes reached. Please try later.')
+            compat.accept(wps_response)
+            return compat.run(process, wps_request, wps_response)
+
+        maxprocesses = int(configuration.get_config_value('server', 'maxprocesses'))
+        self.queue.submit(process.uuid, process.identifier, job_class, user, request=wps_request.json,
+                          max_queued=maxprocesses)
+        compat.accept(wps_response, u'PyWPS Process stored in job queue')
+        LOGGER.debug('Queued {} job {} of user {}'.format(job_class, process.uuid, user))
+        self.dispatch(process.service, current=(process, wps_request, wps_response))
+        return wps_response
+
+    def dispatch(self, service, current=None):
+        """Start the queued jobs fitting in the free slots.
+
+        :param service: service preparing the processes of the jobs
+        :param current: (process, request, response) of the request being handled, started without preparing
+                        the process again if selected
+        """
+        # Reap the job processes started by this process, whose pids are still alive until then.
+        multiprocessing.active_children()
+        if not has_free_space():
+            LOGGER.warning('Not enough free disk space, jobs kept in the queue')
+            return
+        for uuid, request_json in self.queue.next_jobs(self.slots(), self.heavy_slots):
+            try:
+                if current is not None and str(current[0].uuid) == uuid:
+                    process, wps_request, wps_response = current
+                    compat.accept(wps_response)
+                else:
+                    process, wps_request, wps_response = compat.restore(service, uuid, request_json)
+                LOGGER.debug('Starting job {}'.format(uuid))
+                compat.start(process, wps_request, wps_response)
+            except Exception as e:
+                LOGGER.exception('Could not start job {}: {}'.format(uuid, e))
+                self.queue.finish(uuid)
+
+    def watch(self, service):
+        """Dispatch the queued jobs every `interval` seconds in a thread of the current process.
+
+        Jobs are otherwise only dispatched when a job is queued or completes, so that the jobs queued behind a job
+        whose process was killed, or kept in the queue while the free disk space was too low, would wait for the
+        next Execute request. Threads do not survive the fork of server workers, so the service calls this method
+        for each request, and the thread is started once per process.
+        """
+        if self.interval <= 0:
+            return
+        pid = os.getpid()
+        if self._watcher is not None and self._watcher[0] == pid:
+            return
+        with self._lock:
+            if self._watcher is not None and self._watcher[0] == pid:
+                return
+            stop = threading.Event()
+            thread = threading.Thread(target=self._watch, args=(service, stop), name='job-dispatcher')
+            thread.daemon = True
+            self._watcher = (pid, thread, stop)
+            thread.start()
+        LOGGER.debug('Dispatching queued jobs every {} seconds'.format(self.interval))
+
+    def _watch(self, service, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.dispatch(service)
+            except Exception as e:
+                LOGGER.exception('Could not dispatch the queued jobs: {}'.format(e))
+
+    def stop(self):
+        """Stop the periodic dispatch started by :meth:`watch`."""
+        with self._lock:
+            if self._watcher is not None:
+                self._watcher[2].set()
+                self._watcher[1].join()
+                self._watcher = None
+
+
+def get_scheduler():
+    """Return the scheduler configured by the `job_scheduler` options, or None if it is disabled."""
+    if configuration.get_config_value('extra', 'job_scheduler') is not True:
+        return None
+    path = configuration.get_config_value('extra', 'job_database')
+    if not path:
+        workdir = configuration.get_config_value('server', 'workdir') or '.'
+        path = os.path.join(os.path.abspath(workdir), 'flyingpigeon_jobs.sqlite')
+    heavy = configuration.get_config_value('extra', 'heavy_processes')
+    heavy = [p.strip() for p in heavy.split(',') if p.strip()] if heavy else DEFAULT_HEAVY_PROCESSES
+    heavy_slots = configuration.get_config_value('extra', 'heavy_slots')
+    interval = configuration.get_config_value('extra', 'dispatch_interval')
+    return Scheduler(JobQueue(path), heavy_processes=heavy, heavy_slots=int(heavy_slots) if heavy_slots else 1,
+                     user_header=configuration.get_config_value('extra', 'user_header') or None,
+                     interval=float(interval) if interval else DISPATCH_INTERVAL)
@@ -0,0 +1,254 @@
+"""
+Performance metrics of the processes.
+
+The handler of each process prepared for execution is wrapped by :meth:`MetricsStore.attach`, which records the
+execution in a SQLite database shared by the server workers and by the job processes: number of executions by
+status, time spent in the queue and in the handler, bytes read and written, disk cache hits and misses, and peak
+resident memory. The `/metrics` endpoint of the service exports them in the Prometheus text format.
+
+Asynchronous executions have their own process, whose bytes include those of the threads of the handler, e.g. the
+downloads, and of its worker processes. Synchronous executions run in a thread of a server worker, shared with
+other requests, so only the bytes of the handler thread are counted. The cache statistics of the worker processes
+are returned by :func:`flyingpigeon.parallel.parallel_map`.
+"""
+import datetime
+import logging
+import os
+import resource
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pywps import configuration
+
+from flyingpigeon import cache
+
+LOGGER = logging.getLogger("PYWPS")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the buckets of the histograms, in seconds.
+BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600]
+
+# Metric families: name, type and help text.
+FAMILIES = OrderedDict([
+    ('flyingpigeon_requests_total', ('counter', 'Executions of the processes, by status.')),
+    ('flyingpigeon_queue_wait_seconds', ('histogram', 'Time between the acceptance of a request and the start '
+                                                      'of its process.')),
+    ('flyingpigeon_execution_seconds', ('histogram', 'Duration of the process handlers.')),
+    ('flyingpigeon_read_bytes_total', ('counter', 'Bytes read by the process handlers, with their threads and '
+                                                  'worker processes for asynchronous executions, by the handler '
+                                                  'thread only for synchronous executions.')),
+    ('flyingpigeon_written_bytes_total', ('counter', 'Bytes written by the process handlers, with their threads and '
+                                                     'worker processes for asynchronous executions, by the handler '
+                                                     'thread only for synchronous executions.')),
+    ('flyingpigeon_cache_hits_total', ('counter', 'Disk cache hits of the process handlers, by cache.')),
+    ('flyingpigeon_cache_misses_total', ('counter', 'Disk cache misses of the process handlers, by cache.')),
+    ('flyingpigeon_peak_rss_bytes', ('gauge', 'Largest peak resident set size of the processes running the '
+                                              'executions.')),
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    family TEXT NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (family, name, labels)
+)
+"""
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def io_counters(thread=False):
+    """Return the bytes read and written by the current process, including its terminated threads and reaped
+    children, or by the current thread only, or (0, 0) if the system does not count them."""
+    try:
+        with open('/proc/thread-self/io' if thread else '/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss():
+    """Return the peak resident set size of the current process and of its terminated children, in bytes."""
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def accepted_time(uuid):
+    """Return the time when a request was accepted, recorded by PyWPS, or None if it is unknown."""
+    from pywps import dblog
+    session = dblog.get_session()
+    try:
+        request = session.query(dblog.ProcessInstance).filter_by(uuid=str(uuid)).first()
+        return request.time_start if request is not None else None
+    finally:
+        session.close()
+
+
+class Execution(object):
+    """Resource usage of a process execution, measured between its creation and :meth:`stop`.
+
+    :param uuid: identifier of the request, giving the time spent in the queue
+    :param own_process: whether the execution runs in its own process, as asynchronous executions do. The bytes
+                        of the other threads and of the reaped children of the process are then counted, otherwise
+                        only the bytes of the current thread.
+    """
+
+    def __init__(self, uuid=None, own_process=False):
+        self.queue_wait = None
+        if uuid is not None:
+            try:
+                accepted = accepted_time(uuid)
+                if accepted is not None:
+                    self.queue_wait = max(0, (datetime.datetime.now() - accepted).total_seconds())
+            except Exception as e:
+                LOGGER.debug('Queue wait of {} unknown: {}'.format(uuid, e))
+        self.thread = not own_process
+        self.cache = cache.STATISTICS.copy()
+        self.io = io_counters(self.thread)
+        self.start = time.time()
+
+    def stop(self):
+        """Return the measures of the execution."""
+        duration = time.time() - self.start
+        read, written = io_counters(self.thread)
+        caches = cache.STATISTICS.copy()
+        caches.subtract(self.cache)
+        return dict(queue_wait=self.queue_wait, duration=duration,
+                    bytes_read=max(0, read - self.io[0]), bytes_written=max(0, written - self.io[1]),
+                    cache={key: count for key, count in caches.items() if count > 0}, peak_rss=peak_rss())
+
+
+class MetricsStore(object):
+    """Metrics of the process executions stored in a SQLite database.
+
+    :param path: path of the database, created if needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as db:
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    @staticmethod
+    def _add(db, family, labels, value, name=None):
+        db.execute('INSERT INTO samples VALUES (?, ?, ?, ?) '
+                   'ON CONFLICT (family, name, labels) DO UPDATE SET value = value + excluded.value',
+                   (family, name or family, labels, value))
+
+    @classmethod
+    def _observe(cls, db, family, process, value):
+        for bound in BUCKETS + [float('inf')]:
+            cls._add(db, family, _labels(process=process, le=_format_value(bound)), int(value <= bound),
+                     name=family + '_bucket')
+        cls._add(db, family, _labels(process=process), value, name=family + '_sum')
+        cls._add(db, family, _labels(process=process), 1, name=family + '_count')
+
+    def record(self, identifier, status, queue_wait=None, duration=0, bytes_read=0, bytes_written=0, cache=None,
+               peak_rss=0):
+        """Record an execution.
+
+        :param identifier: identifier of the process
+        :param status: 'succeeded' or 'failed'
+        :param queue_wait: time in seconds between the acceptance of the request and the start of the handler
+        :param duration: duration of the handler in seconds
+        :param cache: number of cache hits and misses by (cache name, 'hits' or 'misses')
+        :param peak_rss: peak resident set size in bytes
+        """
+        process = _labels(process=identifier)
+        with self._transaction() as db:
+            self._add(db, 'flyingpigeon_requests_total', _labels(process=identifier, status=status), 1)
+            if queue_wait is not None:
+                self._observe(db, 'flyingpigeon_queue_wait_seconds', identifier, queue_wait)
+            self._observe(db, 'flyingpigeon_execution_seconds', identifier, duration)
+            self._add(db, 'flyingpigeon_read_bytes_total', process, bytes_read)
+            self._add(db, 'flyingpigeon_written_bytes_total', process, bytes_written)
+            for (name, kind), count in sorted((cache or {}).items()):
+                self._add(db, 'flyingpigeon_cache_{}_total'.format(kind), _labels(process=identifier, cache=name),
+                          count)
+            db.execute('INSERT INTO samples VALUES (?, ?, ?, ?) '
+                       'ON CONFLICT (family, name, labels) DO UPDATE SET value = MAX(value, excluded.value)',
+                       ('flyingpigeon_peak_rss_bytes', 'flyingpigeon_peak_rss_bytes', process, peak_rss))
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self._transaction() as db:
+            rows = db.execute('SELECT family, name, labels, value FROM samples ORDER BY rowid').fetchall()
+        samples = OrderedDict((family, []) for family in FAMILIES)
+        for family, name, labels, value in rows:
+            samples.setdefault(family, []).append((name, labels, value))
+
+        lines = []
+        for family, values in samples.items():
+            kind, text = FAMILIES.get(family, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(family, text))
+            lines.append('# TYPE {} {}'.format(family, kind))
+            for name, labels, value in values:
+                lines.append('{}{{{}}} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def attach(self, process):
+        """Record the executions of a process prepared for execution."""
+        store = self
+        handler = process.handler
+
+        def instrumented(request, response):
+            execution = Execution(process.uuid, own_process=getattr(process, 'async_', False))
+            status = 'failed'
+            try:
+                response = handler(request, response)
+                status = 'succeeded'
+                return response
+            finally:
+                try:
+                    store.record(process.identifier, status, **execution.stop())
+                except Exception as e:
+                    LOGGER.warning('Could not record the metrics of {}: {}'.format(process.uuid, e))
+
+        process.handler = instrumented
+
+
+def get_metrics():
+    """Return the metrics store configured by the `metrics` options, or None if metrics are disabled."""
+    if configuration.get_config_value('extra', 'metrics') is False:
+        return None
+    path = configuration.get_config_value('extra', 'metrics_database')
+    if not path:
+        workdir = configuration.get_config_value('server', 'workdir') or '.'
+        path = os.path.join(os.path.abspath(workdir), 'flyingpigeon_metrics.sqlite')
+    try:
+        return MetricsStore(path)
+    except sqlite3.Error as e:
+        LOGGER.warning('Metrics disabled: {}: {}'.format(path, e))
+        return None
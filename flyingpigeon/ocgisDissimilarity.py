@@ -1,5 +1,6 @@
 from flyingpigeon import dissimilarity as dd
 import numpy as np
+from ocgis import FunctionRegistry
 from ocgis.util.helpers import iter_array
 from ocgis.calc.base import AbstractParameterizedFunction, AbstractFieldFunction
 from ocgis.collection.field import Field
@@ -103,3 +104,7 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         # Replaces the time value on the field.
         self.field.set_time(tgv)
         fill.units = ''
+
+
+# Registered on import, so that ocgis operations accept the 'dissimilarity' function.
+FunctionRegistry.append(Dissimilarity)
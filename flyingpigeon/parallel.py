@@ -0,0 +1,101 @@
+"""
+Parallel processing of the independent parts of a request, e.g. the datasets of a request.
+
+Tasks are run in forked worker processes, since netCDF and HDF5 libraries are not thread-safe. The disk cache
+statistics of the workers are returned with the results, and added to those of the caller.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pywps import configuration
+
+from flyingpigeon import cache
+
+LOGGER = logging.getLogger("PYWPS")
+
+DEFAULT_WORKERS = 4
+
+
+def get_workers():
+    """Return the `file_workers` option, the maximum number of worker processes of a request."""
+    workers = configuration.get_config_value('extra', 'file_workers')
+    if workers == '':
+        return min(DEFAULT_WORKERS, os.cpu_count() or 1)
+    return max(int(workers), 1)
+
+
+def _run(func, args):
+    before = cache.STATISTICS.copy()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, e
+    statistics = cache.STATISTICS.copy()
+    statistics.subtract(before)
+    return result, error, {key: count for key, count in statistics.items() if count > 0}
+
+
+def parallel_map(func, tasks, workers=None, count=None):
+    """Run a function on all tasks and return an iterator of (index, result, exception) tuples,
+    in the order in which the tasks complete.
+
+    All worker processes are started before returning, so that they are not forked while other threads
+    of the caller hold locks.
+
+    :param func: module level function
+    :param tasks: argument tuples. If `count` is given, tasks are taken from the iterable while the previous
+                  ones run, e.g. while the files of the next datasets are extracted.
+    :param workers: number of worker processes, see :func:`get_workers`. With one worker, or a single
+                    task, the tasks are run in the current process.
+    :param count: number of tasks
+    """
+    if count is None:
+        tasks = list(tasks)
+        count = len(tasks)
+    tasks = enumerate(tasks)
+    workers = min(workers or get_workers(), count)
+
+    if workers <= 1:
+        def serial():
+            for i, args in tasks:
+                try:
+                    yield i, func(*args), None
+                except Exception as e:
+                    yield i, None, e
+        return serial()
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    futures = {}
+
+    def submit(task):
+        futures[executor.submit(_run, func, task[1])] = task[0]
+
+    def result(future):
+        i = futures.pop(future)
+        try:
+            value, error, statistics = future.result()
+        except Exception as e:
+            return i, None, e
+        cache.STATISTICS.update(statistics)
+        return i, value, error
+
+    # The first submission forks all worker processes.
+    first = next(tasks, None)
+    if first is not None:
+        submit(first)
+    LOGGER.debug('Tasks submitted to {} worker processes'.format(workers))
+
+    def completed():
+        try:
+            for task in tasks:
+                submit(task)
+                # Completed tasks are returned while the next ones are produced.
+                for future in [future for future in futures if future.done()]:
+                    yield result(future)
+            for future in as_completed(list(futures)):
+                yield result(future)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return completed()
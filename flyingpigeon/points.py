@@ -0,0 +1,498 @@
+"""
+Extraction of time series at many points at once.
+
+The grid cells nearest to all points are found with a KD-tree on the cell centers, and the values of each
+file are read with a single read of the window spanned by these cells, instead of one ocgis operation per
+point. Scattered points are read by tiles of the grid, so that the cost grows with the number of distinct
+cells rather than with the number of points or the size of the grid.
+
+Time series are written as CSV tables, netCDF files following the CF timeSeries discrete sampling
+geometry, or Parquet and Feather tables (requires pandas and pyarrow).
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import netCDF4 as nc
+import numpy as np
+
+from flyingpigeon.cache import get_disk_cache
+from flyingpigeon.grid import get_coordinates, get_grid_spacing, coordinates_fingerprint
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Maximum number of values read at once, larger reads are split along the time axis.
+MAX_READ_SIZE = 2 ** 25
+
+# Size of the tiles in which scattered cells are read, and maximum ratio between the size of a window
+# and its number of cells for the window to be read at once.
+TILE_SIZE = 32
+MAX_WINDOW_RATIO = 4
+
+# Number of nearest cell lookups kept in memory by each process.
+MEMORY_INDEXES = 8
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+_LON_NAMES = ('lon', 'longitude', 'x')
+_LAT_NAMES = ('lat', 'latitude', 'y')
+_LABEL_NAMES = ('id', 'name', 'station', 'label')
+
+# Calendars whose dates are stored as timestamps in Parquet and Feather tables.
+STANDARD_CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+# File name suffixes of the output formats.
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'netcdf': '.nc',
+    'parquet': '.parquet',
+    'feather': '.feather',
+}
+
+
+def _xyz(lon, lat):
+    """Return the cartesian coordinates of points on the unit sphere."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _angle(lon0, lat0, lon1, lat1):
+    """Return the great circle distance in degrees between points."""
+    dot = np.sum(_xyz(lon0, lat0) * _xyz(lon1, lat1), axis=1)
+    return np.degrees(np.arccos(np.clip(dot, -1, 1)))
+
+
+class GridIndex(object):
+    """Lookup of the grid cells nearest to points.
+
+    Regular grids are searched along each axis, longitudes modulo 360 degrees. Other grids (rotated pole
+    or curvilinear) are searched in three dimensions, on the unit sphere.
+
+    :param lon: longitudes of the cell centers, 1D or 2D, see :func:`flyingpigeon.grid.get_coordinates`
+    :param lat: latitudes of the cell centers
+    :param spacing: grid spacing, computed by default
+    :param tree: state of the KD-tree of a two dimensional grid, see :meth:`arrays`, built by default
+    """
+
+    def __init__(self, lon, lat, spacing=None, tree=None):
+        # Imported here, since scipy.spatial is slow to import and not needed to describe the processes.
+        from scipy.spatial import cKDTree
+
+        self.lon = lon
+        self.lat = lat
+        self.shape = lon.shape if lon.ndim == 2 else (len(lat), len(lon))
+        self.spacing = get_grid_spacing(lon, lat) if spacing is None else spacing
+        if lon.ndim == 1:
+            self._rows = cKDTree(lat[:, None])
+            self._cols = cKDTree((lon % 360)[:, None], boxsize=360)
+        else:
+            self._valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+            if tree is None:
+                self._tree = cKDTree(_xyz(lon.flat[self._valid], lat.flat[self._valid]))
+            else:
+                self._tree = cKDTree.__new__(cKDTree)
+                self._tree.__setstate__(tree)
+
+    def arrays(self):
+        """Return the lookup as a dictionary of arrays, which :meth:`from_arrays` turns back into a lookup.
+
+        The KD-tree of two dimensional grids is included, as the arrays and integers of its pickle state, so
+        that it is restored without being built again nor unpickled.
+        """
+        import scipy
+
+        arrays = {'lon': self.lon, 'lat': self.lat, 'spacing': np.float64(self.spacing)}
+        if self.lon.ndim == 2:
+            state = self._tree.__getstate__()
+            arrays['scipy'] = np.str_(scipy.__version__)
+            arrays['tree_size'] = np.int64(len(state))
+            for i, item in enumerate(state):
+                if item is not None:
+                    arrays['tree_{}'.format(i)] = np.asarray(item)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Return the lookup stored by :meth:`arrays`.
+
+        The KD-tree is built again if it was stored by another version of scipy.
+        """
+        import scipy
+
+        lon, lat = arrays['lon'], arrays['lat']
+        tree = None
+        if lon.ndim == 2 and str(arrays['scipy']) == scipy.__version__:
+            tree = tuple(_tree_item(arrays['tree_{}'.format(i)] if 'tree_{}'.format(i) in arrays else None)
+                         for i in range(int(arrays['tree_size'])))
+        return cls(lon, lat, spacing=float(arrays['spacing']), tree=tree)
+
+    def query(self, points):
+        """Return the indices of the grid cells nearest to the points.
+
+        :param points: array of (lon, lat) pairs
+
+        :returns tuple: row and column indices of the cells, and a boolean array telling which points are
+                        within the grid, i.e. less than two grid spacings away from their cell center.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        px, py = points[:, 0], points[:, 1]
+
+        if self.lon.ndim == 1:
+            _, rows = self._rows.query(py[:, None])
+            _, cols = self._cols.query((px % 360)[:, None])
+            clon, clat = self.lon[cols], self.lat[rows]
+        else:
+            _, idx = self._tree.query(_xyz(px, py))
+            rows, cols = np.unravel_index(self._valid[idx], self.shape)
+            clon, clat = self.lon[rows, cols], self.lat[rows, cols]
+
+        inside = _angle(px, py, clon, clat) <= 2 * self.spacing
+        return rows, cols, inside
+
+
+def _tree_item(value):
+    """Return an item of the KD-tree state stored as an array."""
+    if value is None or value.ndim > 0:
+        return value
+    return value.item()
+
+
+def nearest_cells(lon, lat, points):
+    """Return the indices of the grid cells nearest to the points, see :meth:`GridIndex.query`."""
+    return GridIndex(lon, lat).query(points)
+
+
+def get_grid_index(resource):
+    """Return the nearest cell lookup of a dataset grid.
+
+    Lookups are keyed by the fingerprint of the coordinate variables of the dataset. The last ones are kept
+    in memory, and all are stored in the `grid_indexes` disk cache, as plain arrays loaded without
+    unpickling, so that datasets on a known grid skip converting their coordinates and building the lookup.
+
+    :param resource: path of a netCDF file, or a list of files sharing the same grid
+    """
+    key = coordinates_fingerprint(resource)
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+
+    index = _load_grid_index(resource, key)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > MEMORY_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _load_grid_index(resource, key):
+    """Return the lookup of the grid from the disk cache, or build it and store it in the cache."""
+    cache = get_disk_cache('grid_indexes', 'index_cache_size')
+    path = cache.get(key, '.npz') if cache else None
+    if path is not None:
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return GridIndex.from_arrays(data)
+        except Exception as e:
+            LOGGER.warning('Could not read grid index {}: {}'.format(path, e))
+
+    index = GridIndex(*get_coordinates(resource))
+    if cache:
+        def write(path):
+            with open(path, 'wb') as f:
+                np.savez(f, **index.arrays())
+
+        cache.put(key, write, '.npz')
+    return index
+
+
+def nearest_cell(resource, lon, lat):
+    """Return the (row, column) indices of the cell of a dataset nearest to a point, or None if the point
+    is outside of the grid."""
+    rows, cols, inside = get_grid_index(resource).query([(lon, lat)])
+    return (int(rows[0]), int(cols[0])) if inside[0] else None
+
+
+def find_variable(ds, shape):
+    """Return the name of the first data variable defined on the horizontal grid of the given shape."""
+    for name, var in ds.variables.items():
+        if var.ndim >= 3 and var.shape[-2:] == shape and name not in ds.dimensions:
+            return name
+    raise ValueError('No variable defined on the grid in {}'.format(ds.filepath()))
+
+
+def _read_window(var, rows, cols, out, index):
+    """Read the window spanned by the cells and store their values in the columns `index` of `out`."""
+    y0, y1 = int(rows.min()), int(rows.max()) + 1
+    x0, x1 = int(cols.min()), int(cols.max()) + 1
+    nt = var.shape[0]
+    step = max(1, MAX_READ_SIZE // ((y1 - y0) * (x1 - x0)))
+    for t0 in range(0, nt, step):
+        key = (slice(t0, t0 + step),) + (0,) * (var.ndim - 3) + (slice(y0, y1), slice(x0, x1))
+        window = np.ma.filled(np.ma.asarray(var[key], dtype=float), np.nan)
+        out[t0:t0 + step, index] = window[:, rows - y0, cols - x0]
+
+
+def _blocks(rows, cols):
+    """Return groups of cell indices read together: all cells if their window is dense, else grid tiles."""
+    size = (rows.max() - rows.min() + 1) * (cols.max() - cols.min() + 1)
+    if size <= max(MAX_WINDOW_RATIO * len(rows), TILE_SIZE ** 2):
+        return [np.arange(len(rows))]
+    tiles = (rows // TILE_SIZE) * (cols.max() // TILE_SIZE + 1) + cols // TILE_SIZE
+    order = np.argsort(tiles, kind='stable')
+    _, starts = np.unique(tiles[order], return_index=True)
+    return np.split(order, starts[1:])
+
+
+def read_cells(var, rows, cols):
+    """Return the time series of a netCDF variable at the given cells, as an array (time, cells).
+
+    Cells close to each other are read with a single read of the window they span, and picked from it.
+    Masked values are returned as NaN.
+
+    :param var: netCDF variable with dimensions (time, ..., y, x), other dimensions must have size 1
+    :param rows: row (y) indices of the cells
+    :param cols: column (x) indices of the cells
+    """
+    if any(size != 1 for size in var.shape[1:-2]):
+        raise ValueError('Variable {} has more than one level'.format(var.name))
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    out = np.empty((var.shape[0], len(rows)))
+    if len(rows):
+        for index in _blocks(rows, cols):
+            _read_window(var, rows[index], cols[index], out, index)
+    return out
+
+
+def extract(resources, points, variable=None, deduplicate=False):
+    """Return the time series of a variable at the given points, from files sharing the same grid.
+
+    Each grid cell is only read once, however many points it contains.
+
+    :param resources: list of netCDF files, concatenated along time in the given order
+    :param points: array of (lon, lat) pairs
+    :param variable: variable name, by default the first variable defined on the grid
+    :param deduplicate: whether points in the same grid cell share a single column of values
+
+    :returns tuple: values with shape (time, columns), NaN for points outside of the grid, and for each
+                    column the array of indices of the points it holds
+    """
+    if isinstance(resources, str):
+        resources = [resources]
+    index = get_grid_index(resources[0])
+    rows, cols, inside = index.query(points)
+    shape = index.shape
+
+    # Points outside of the grid are all mapped to the cell -1.
+    cells, inverse = np.unique(np.where(inside, rows * shape[1] + cols, -1), return_inverse=True)
+    inverse = inverse.ravel()
+    valid = cells >= 0
+
+    values = []
+    for path in resources:
+        with nc.Dataset(path) as ds:
+            name = variable or find_variable(ds, shape)
+            var = ds.variables[name]
+            if var.shape[-2:] != shape:
+                raise ValueError('Variable {} is not defined on the grid of {}'.format(name, resources[0]))
+            block = np.full((var.shape[0], len(cells)), np.nan)
+            block[:, valid] = read_cells(var, cells[valid] // shape[1], cells[valid] % shape[1])
+            values.append(block)
+    values = np.concatenate(values)
+
+    if deduplicate:
+        order = np.argsort(inverse, kind='stable')
+        columns = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(cells)))[:-1])
+        LOGGER.info('{} points in {} grid cells'.format(len(inverse), len(cells)))
+        return values, columns
+    return values[:, inverse], [np.array([i]) for i in range(len(inverse))]
+
+
+def _find_column(names, candidates):
+    for i, name in enumerate(names):
+        if name.strip().lower() in candidates:
+            return i
+    return None
+
+
+def read_csv_points(text):
+    """Return the points and labels of a CSV table.
+
+    Longitudes and latitudes are read from the columns named lon/longitude/x and lat/latitude/y, and
+    labels from a column named id/name/station/label. Without header, the first two columns are the
+    longitude and latitude.
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t ')
+    except csv.Error:
+        dialect = csv.excel
+    rows = [row for row in csv.reader(io.StringIO(text), dialect) if row and not row[0].startswith('#')]
+    if not rows:
+        raise ValueError('No points found')
+
+    ilon, ilat, ilabel = 0, 1, None
+    try:
+        float(rows[0][0]), float(rows[0][1])
+    except (ValueError, IndexError):
+        header = rows.pop(0)
+        ilon, ilat = _find_column(header, _LON_NAMES), _find_column(header, _LAT_NAMES)
+        ilabel = _find_column(header, _LABEL_NAMES)
+        if ilon is None or ilat is None:
+            raise ValueError('No longitude and latitude columns in {}'.format(header))
+
+    points = np.array([(float(row[ilon]), float(row[ilat])) for row in rows])
+    labels = [row[ilabel].strip() for row in rows] if ilabel is not None else None
+    return points, labels
+
+
+def read_geojson_points(text):
+    """Return the points and labels of a GeoJSON feature collection, labels taken from the feature ids."""
+    data = json.loads(text)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    points, labels = [], []
+    for i, feature in enumerate(features):
+        geometry = feature['geometry'] if feature.get('type') == 'Feature' else feature
+        coords = [geometry['coordinates']] if geometry['type'] == 'Point' else geometry['coordinates']
+        props = feature.get('properties') or {}
+        label = feature.get('id', next((props[k] for k in _LABEL_NAMES if k in props), None))
+        for c in coords:
+            points.append(c[:2])
+            labels.append(None if label is None else str(label))
+    if not points:
+        raise ValueError('No points found')
+    return np.array(points, dtype=float), labels if all(label is not None for label in labels) else None
+
+
+def read_points(path):
+    """Return the points of a CSV or GeoJSON file, as an array of (lon, lat) pairs, and their labels or None."""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('{'):
+        return read_geojson_points(text)
+    return read_csv_points(text)
+
+
+def check_output_format(output_format):
+    """Raise an error if the output format is unknown or its dependencies are not installed."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {}'.format(output_format))
+    if output_format in ('parquet', 'feather'):
+        try:
+            import pandas  # noqa: F401
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('The {} output format requires pandas and pyarrow.'.format(output_format))
+
+
+def describe(resources, variable=None):
+    """Return the name, units and long name of the extracted variable, and the calendar of its time axis."""
+    if isinstance(resources, str):
+        resources = [resources]
+    shape = get_grid_index(resources[0]).shape
+    with nc.Dataset(resources[0]) as ds:
+        var = ds.variables[variable or find_variable(ds, shape)]
+        time = ds.variables.get(var.dimensions[0])
+        return {'variable': var.name,
+                'units': getattr(var, 'units', None),
+                'long_name': getattr(var, 'long_name', None),
+                'calendar': getattr(time, 'calendar', 'standard')}
+
+
+def _unique_labels(labels):
+    """Return the labels with a numeric suffix added to repeated ones."""
+    seen = {}
+    unique = []
+    for label in labels:
+        n = seen.get(label, 0)
+        unique.append(label if n == 0 else '{}_{}'.format(label, n))
+        seen[label] = n + 1
+    return unique
+
+
+def write_csv(path, times, values, labels, compress=False):
+    """Write time series as a CSV table with one column per point, optionally compressed with gzip."""
+    row = '%s,' + ','.join(['%.9g'] * values.shape[1]) + '\n'
+    with (gzip.open(path, 'wt', compresslevel=6) if compress else open(path, 'w')) as f:
+        f.write('# date_time,' + ','.join(labels) + '\n')
+        for t, vals in zip(times, values):
+            f.write(row % ((t,) + tuple(vals)))
+
+
+def write_netcdf(path, times, values, labels, points, variable='values', units=None, long_name=None,
+                 calendar='standard'):
+    """Write time series as a netCDF file following the CF timeSeries discrete sampling geometry."""
+    with nc.Dataset(path, 'w') as ds:
+        ds.Conventions = 'CF-1.7'
+        ds.featureType = 'timeSeries'
+        ds.createDimension('time', len(times))
+        ds.createDimension('station', len(labels))
+
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1850-01-01 00:00:00'
+        time.calendar = calendar
+        time.standard_name = 'time'
+        time[:] = nc.date2num(list(times), time.units, calendar)
+
+        name = ds.createVariable('station_name', str, ('station',))
+        name.cf_role = 'timeseries_id'
+        name.long_name = 'point label'
+        name[:] = np.array(labels, dtype=object)
+
+        for coord, standard_name, units_ in [('lon', 'longitude', 'degrees_east'),
+                                             ('lat', 'latitude', 'degrees_north')]:
+            var = ds.createVariable(coord, 'f8', ('station',))
+            var.standard_name = standard_name
+            var.units = units_
+            var[:] = points[:, 0 if coord == 'lon' else 1]
+
+        var = ds.createVariable(variable, 'f4', ('station', 'time'), zlib=True, fill_value=np.float32(1e20))
+        if units:
+            var.units = units
+        if long_name:
+            var.long_name = long_name
+        var.coordinates = 'time lat lon station_name'
+        var[:] = np.ma.masked_invalid(values.T)
+
+
+def write_table(path, times, values, labels, output_format, calendar='standard'):
+    """Write time series as a Parquet or Feather table with a date_time column and one column per point.
+
+    Dates of the standard calendars are stored as timestamps. Other calendars (e.g. 360_day, noleap) have
+    dates that timestamps cannot represent, such as February 30, so their dates are stored as strings.
+    """
+    import pandas as pd
+
+    table = pd.DataFrame(values, columns=_unique_labels(labels))
+    dates = [str(t) for t in times]
+    table.insert(0, 'date_time', pd.to_datetime(dates) if calendar in STANDARD_CALENDARS else dates)
+    if output_format == 'parquet':
+        table.to_parquet(path, index=False)
+    else:
+        table.to_feather(path)
+
+
+def write_timeseries(prefix, times, values, labels, points, output_format='csv', **attrs):
+    """Write point time series and return the path of the written file.
+
+    :param prefix: path of the file, without suffix
+    :param times: dates of the time steps
+    :param values: array of values with shape (time, points)
+    :param labels: label of each point
+    :param points: array of (lon, lat) pairs
+    :param output_format: one of `OUTPUT_FORMATS`
+    :param attrs: variable description for netCDF files, see :func:`describe`
+    """
+    path = prefix + OUTPUT_FORMATS[output_format]
+    if output_format in ('csv', 'csv.gz'):
+        write_csv(path, times, values, labels, compress=output_format == 'csv.gz')
+    elif output_format == 'netcdf':
+        write_netcdf(path, times, values, labels, np.asarray(points, dtype=float).reshape(-1, 2), **attrs)
+    else:
+        write_table(path, times, values, labels, output_format, attrs.get('calendar', 'standard'))
+    return path
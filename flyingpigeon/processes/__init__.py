@@ -1,3 +1,8 @@
+# Process modules import the computation libraries (ocgis, eggshell, matplotlib, ...) in their handlers only,
+# so that the service starts and describes the processes without loading them.
+from collections import OrderedDict
+
+from pywps import configuration
 
 # from .wps_say_hello import SayHello
 from .wps_subset_wfs_polygon import SubsetWFSPolygonProcess
@@ -9,16 +14,50 @@ from .wps_spatial_analog import SpatialAnalogProcess
 from .wps_plot_spatial_analog import PlotSpatialAnalogProcess
 from .wps_plot_timeseries import PlottimeseriesProcess
 
-
-processes = [
-    # SayHello(),
-    SubsetWFSPolygonProcess(),
-    SubsetBboxProcess(),
-    SubsetcontinentProcess(),
-    SubsetcountryProcess(),
-    PointinspectionProcess(),
-    PlottimeseriesProcess(),
-    SpatialAnalogProcess(),
-    PlottimeseriesProcess(),
-    PlotSpatialAnalogProcess()
+# Process classes, in the order in which the processes are offered.
+PROCESS_CLASSES = [
+    # SayHello,
+    SubsetWFSPolygonProcess,
+    SubsetBboxProcess,
+    SubsetcontinentProcess,
+    SubsetcountryProcess,
+    PointinspectionProcess,
+    PlottimeseriesProcess,
+    SpatialAnalogProcess,
+    PlotSpatialAnalogProcess,
 ]
+
+
+def _register(classes):
+    """Return the process classes by identifier, refusing duplicate identifiers."""
+    registry = OrderedDict()
+    for cls in classes:
+        if cls.identifier in registry:
+            raise ValueError('Duplicate process identifier {} ({} and {})'.format(
+                cls.identifier, registry[cls.identifier].__name__, cls.__name__))
+        registry[cls.identifier] = cls
+    return registry
+
+
+registry = _register(PROCESS_CLASSES)
+
+
+def enabled_processes():
+    """Return the identifiers given by the `processes` option, or None if all processes are enabled."""
+    value = configuration.get_config_value('extra', 'processes')
+    identifiers = [v.strip() for v in value.split(',') if v.strip()] if value else []
+    return identifiers or None
+
+
+def get_processes(identifiers=None):
+    """Instantiate the processes with the given identifiers, in the order of `PROCESS_CLASSES`.
+
+    Only the selected process classes are instantiated.
+
+    :param identifiers: list of process identifiers, by default all processes
+    """
+    if identifiers:
+        unknown = set(identifiers).difference(registry)
+        if unknown:
+            raise ValueError('Unknown processes: {}'.format(', '.join(sorted(unknown))))
+    return [cls() for identifier, cls in registry.items() if not identifiers or identifier in identifiers]
@@ -1,14 +1,20 @@
+import hashlib
 import json
+import logging
+import time
 from pywps import LiteralInput, ComplexInput, ComplexOutput
 from pywps import configuration, FORMATS
-import owslib
-from owslib.wfs import WebFeatureService
-import ocgis
+import owslib.crs
 import netCDF4 as nc
+from shapely import wkb
 from shapely.geometry import shape
-import requests
+from shapely.ops import unary_union
 
-from eggshell.nc.nc_utils import get_variable
+from flyingpigeon.cache import get_disk_cache, make_key
+from flyingpigeon.grid import get_extent, restrict_to_extent, get_mask
+from flyingpigeon.remote import get_session, prefetch, probe_opendap, TIMEOUT
+
+LOGGER = logging.getLogger("PYWPS")
 
 resource = ComplexInput('resource',
                         'NetCDF resource',
@@ -47,16 +53,101 @@ metalink = ComplexOutput('metalink',
                          supported_formats=[FORMATS.META4])
 
 
+# Time in seconds during which WFS features are reused without querying the server again.
+FEATURE_CACHE_TTL = 3600
+
+
+def fetch_feature(url, typename, features):
+    """Return the GeoJSON feature collection of the given features from a WFS server.
+
+    The WFS 1.1.0 GetFeature request is sent directly through the shared HTTP session, without first
+    requesting the capabilities of the server.
+    """
+    params = {'service': 'WFS', 'version': '1.1.0', 'request': 'GetFeature',
+              'typename': typename, 'featureid': ','.join(features),
+              'outputFormat': 'application/json'}
+    resp = get_session().get(url, params=params, timeout=TIMEOUT)
+    resp.raise_for_status()
+    try:
+        return resp.json()
+    except ValueError:
+        raise ValueError('Invalid GetFeature response: {}'.format(resp.text[:500]))
+
+
+def get_feature_cache_ttl():
+    """Return the `feature_cache_ttl` option in seconds."""
+    ttl = configuration.get_config_value('extra', 'feature_cache_ttl')
+    if ttl == '':
+        return FEATURE_CACHE_TTL
+    return float(ttl)
+
+
 def get_feature(url, typename, features):
-    """Return geometry for WFS server."""
-    wfs = WebFeatureService(url, version='2.0.0')
-    resp = wfs.getfeature([typename], featureid=features,
-                          outputFormat='application/json')
-    return json.loads(resp.read())
+    """Return geometry for WFS server.
+
+    Features are stored in the `features` disk cache and reused until they are older than
+    the `feature_cache_ttl` option.
+    """
+    ttl = get_feature_cache_ttl()
+    cache = get_disk_cache('features', 'feature_cache_size') if ttl > 0 else None
+    key = make_key(url, typename, sorted(features))
+
+    path = cache.get(key, '.json') if cache else None
+    if path is not None:
+        with open(path) as f:
+            data = json.load(f)
+        if time.time() - data['time'] < ttl:
+            return data['feature']
+        LOGGER.debug('Cached features of {} expired.'.format(typename))
+
+    feature = fetch_feature(url, typename, features)
+    if cache:
+        data = {'time': time.time(), 'feature': feature}
+
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+        cache.put(key, write, '.json')
+    return feature
+
+
+def get_mosaic(url, typename, features):
+    """Return the union of WFS features as a single feature dictionary.
+
+    Mosaics are stored in the `mosaics` disk cache, so that the features are only fetched and merged once
+    within the `feature_cache_ttl` delay.
+    """
+    ttl = get_feature_cache_ttl()
+    cache = get_disk_cache('mosaics', 'mosaic_cache_size') if ttl > 0 else None
+    key = make_key(url, typename, sorted(features))
+
+    path = cache.get(key, '.json') if cache else None
+    if path is not None:
+        with open(path) as f:
+            data = json.load(f)
+        if time.time() - data.get('time', 0) < ttl:
+            import ocgis
+            crs = ocgis.CoordinateReferenceSystem(epsg=owslib.crs.Crs(data['crs']).code)
+            return {'geom': wkb.loads(data['geom'], hex=True), 'crs': crs, 'properties': data['properties']}
+
+    feature = get_feature(url, typename, features)
+    geom = make_geoms(feature, mosaic=True)
+    if cache:
+        data = {'time': time.time(), 'geom': geom['geom'].wkb_hex, 'crs': feature['crs']['properties']['name'],
+                'properties': geom['properties']}
+
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+        cache.put(key, write, '.json')
+    return geom
 
 
 def make_geoms(feature, mosaic=False):
     """Return list of feature dictionaries."""
+    import ocgis
 
     crs_code = owslib.crs.Crs(
         feature['crs']['properties']['name']).code
@@ -67,34 +158,34 @@ def make_geoms(feature, mosaic=False):
         for f in feature['features']]
 
     if mosaic:
-        new_geom = geoms[0]
-        for merge_geom in geoms[1:]:
-            new_geom['geom'] = new_geom['geom'].union(merge_geom['geom'])
-        new_geom['properties'] = {'bbox': feature['bbox']}
-        return new_geom
+        return {'geom': unary_union([g['geom'] for g in geoms]), 'crs': crs,
+                'properties': {'bbox': feature['bbox']}}
 
     return geoms
 
 
 class Subsetter:
 
-    def parse_resources(self, request):
+    def parse_resources(self, request, response=None):
         """Return a generator returning for all input values an OPeNDAP url of the file path.
 
+        Remote urls are probed concurrently, and OPeNDAP resources are read remotely instead of
+        being downloaded. Other remote files are downloaded concurrently before the first path is returned.
+
         :param request: WPS request object.
+        :param response: WPS response object, whose status reports the download progress.
         :return: path to dataset.
         """
+        inputs = request.inputs['resource']
+        opendap = probe_opendap(input.url for input in inputs)
+        files = iter(prefetch([input for input, remote in zip(inputs, opendap) if not remote], response))
 
-        for input in request.inputs['resource']:
-            url = input.url
-            if url and not url.startswith("file"):
-                r = requests.get(url + ".dds")
-                if r.status_code == 200 and r.content.decode().startswith("Dataset"):
-                    yield url
+        for input, remote in zip(inputs, opendap):
+            if remote:
+                yield input.url
+                continue
 
-            # Accessing the file property loads the data in the data property
-            # and writes it to disk
-            path = input.file
+            path = next(files)
 
             # We need to cleanup the data property, otherwise it will be
             # written in the database and to the output status xml file
@@ -115,8 +206,11 @@ class Subsetter:
             mosaic = request.inputs['mosaic'][0].data
 
             try:
-                feature = get_feature(geoserver, typename, features)
-                geoms = make_geoms(feature, mosaic)
+                if mosaic:
+                    geoms = [get_mosaic(geoserver, typename, features), ]
+                else:
+                    feature = get_feature(geoserver, typename, features)
+                    geoms = make_geoms(feature)
 
             except Exception as e:
                 msg = ('Failed to fetch features.\ngeoserver: {0} \n'
@@ -128,6 +222,42 @@ class Subsetter:
 
         return geoms
 
+    def parse_extent(self, path):
+        """Return the padded grid extent of the dataset, or None if it cannot be read."""
+        try:
+            return get_extent(path)
+        except Exception as e:
+            LOGGER.debug('Could not read grid extent of {}: {}'.format(path, e))
+            return None
+
+    def restrict_geom(self, geom, extent):
+        """Return the geometry clipped to the dataset extent, or None if they do not intersect.
+
+        Only geographic geometries are restricted, others are returned unchanged.
+        """
+        if not getattr(geom['crs'], 'is_geographic', False):
+            return geom
+        geoms = restrict_to_extent([geom, ], extent)
+        return geoms[0] if geoms else None
+
+    def cached_mask(self, path, geom, spatial_operation):
+        """Return the (window, mask) of the dataset grid cells selected by the geometry, see
+        :func:`flyingpigeon.grid.get_mask`, or None if the `mask_cache` option is not set or the mask cannot be
+        computed.
+
+        Masks are stored on disk, so the intersection is only computed once per grid and geometry.
+        """
+        if configuration.get_config_value('extra', 'mask_cache') is not True:
+            return None
+        if not getattr(geom['crs'], 'is_geographic', False):
+            return None
+        try:
+            digest = hashlib.sha1(geom['geom'].wkb).hexdigest()
+            return get_mask(path, [geom['geom']], spatial_operation, digest)
+        except Exception as e:
+            LOGGER.debug('Could not compute grid mask of {}: {}'.format(path, e))
+            return None
+
     def parse_daterange(self, request):
         """Return [start, end] or None."""
         if ('start' in request.inputs) and ('end' in request.inputs):
@@ -158,6 +288,7 @@ class Subsetter:
                     raise ValueError("{} not in {}".format(var, path))
 
         else:
+            from eggshell.nc.nc_utils import get_variable
             var_names = get_variable(ds)
 
         ds.close()
@@ -1,23 +1,25 @@
 from datetime import datetime as dt
 
 # from eggshell.log import init_process_logger
-from matplotlib import pyplot as plt
 from pywps import ComplexInput, ComplexOutput
 from pywps import Format
 from pywps import LiteralInput
 from pywps import Process
 from pywps.app.Common import Metadata
 
-from eggshell.utils import archive, extract_archive
 # from eggshell.utils import rename_complexinputs
-from eggshell.plot.plt_utils import fig2plot
-from eggshell.plot.plt_ncdata import plot_spatial_analog
+from flyingpigeon.archives import iter_extract
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
 
 class PlotSpatialAnalogProcess(Process):
+    identifier = "plot_spatial_analog"
+
     def __init__(self):
         inputs = [
             ComplexInput('resource', 'netCDF dataset',
@@ -67,7 +69,7 @@ class PlotSpatialAnalogProcess(Process):
 
         super(PlotSpatialAnalogProcess, self).__init__(
             self._handler,
-            identifier="plot_spatial_analog",
+            identifier=self.identifier,
             title="Map of dissimilarity values calculated by the spatial_analog process.",
             abstract="Produce map showing the dissimilarity values computed by the "
                      "spatial_analog process as well as indicating by a marker the location of the target site.",
@@ -82,7 +84,13 @@ class PlotSpatialAnalogProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        from matplotlib import pyplot as plt
+        from eggshell.utils import archive
+        from eggshell.plot.plt_utils import fig2plot
+        from eggshell.plot.plt_ncdata import plot_spatial_analog
 
         tic = dt.now()
         # init_process_logger('log.txt')
@@ -95,9 +103,12 @@ class PlotSpatialAnalogProcess(Process):
         # Read inputs
         ######################################
         try:
-            resource = extract_archive(
-                resources=[inpt.file for inpt in request.inputs['resource']],
-                dir_output=self.workdir)[0]
+            # Only the first netCDF file is plotted, the rest of the archive is not extracted.
+            with self.timer.stage('fetch'):
+                resources = prefetch(request.inputs['resource'], response)
+            with self.timer.stage('extract'):
+                resource = next(iter_extract(resources=resources, dir_output=self.workdir))
+            self.files.intermediate(*resources + [resource])
             fmts = [e.data for e in request.inputs['fmt']]
             title = request.inputs['title'][0].data
 
@@ -109,11 +120,14 @@ class PlotSpatialAnalogProcess(Process):
         response.update_status('Input parameters ingested', 2)
 
         try:
-            fig = plot_spatial_analog(resource, title=title)
+            with self.timer.stage('compute'):
+                fig = plot_spatial_analog(resource, title=title)
+            self.files.consumed(*resources + [resource])
             output = []
 
             for fmt in fmts:
-                output.append(fig2plot(fig, fmt, dir_output=self.workdir))
+                with self.timer.stage('write', format=fmt):
+                    output.append(fig2plot(fig, fmt, dir_output=self.workdir))
 
         except Exception as ex:
             msg = "Failed to create figure: {}".format(ex)
@@ -126,7 +140,11 @@ class PlotSpatialAnalogProcess(Process):
         if len(fmts) == 1:
             output = output[0]
         else:
-            output = archive(output, dir_output=self.workdir)
+            # The figures are removed once archived.
+            self.files.intermediate(*output)
+            with self.timer.stage('archive'):
+                output = archive(output, dir_output=self.workdir)
+        self.files.output(output)
 
         response.outputs['output_figure'].file = output
         response.update_status("done", 100)
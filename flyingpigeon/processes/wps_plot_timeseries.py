@@ -6,9 +6,10 @@ from pywps import LiteralInput
 from pywps import Process
 from pywps.app.Common import Metadata
 
-from eggshell.plot import plt_ncdata
-from eggshell.utils import extract_archive
-from eggshell.nc.nc_utils import get_variable
+from flyingpigeon.archives import extract_archive
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 # from eggshell.utils import rename_complexinputs
 # from eggshell.log import init_process_logger
 
@@ -16,6 +17,8 @@ LOGGER = logging.getLogger("PYWPS")
 
 
 class PlottimeseriesProcess(Process):
+    identifier = "plot_timeseries"
+
     def __init__(self):
         inputs = [
             ComplexInput('resource', 'Resource',
@@ -60,7 +63,7 @@ class PlottimeseriesProcess(Process):
 
         super(PlottimeseriesProcess, self).__init__(
             self._handler,
-            identifier="plot_timeseries",
+            identifier=self.identifier,
             title="Graphics (timeseries)",
             version="0.11",
             metadata=[
@@ -74,13 +77,20 @@ class PlottimeseriesProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        from eggshell.plot import plt_ncdata
+        from eggshell.nc.nc_utils import get_variable
+
         # init_process_logger('log.txt')
         # response.outputs['output_log'].file = 'log.txt'
 
-        ncfiles = extract_archive(
-            resources=[inpt.file for inpt in request.inputs['resource']],
-            dir_output=self.workdir)
+        with self.timer.stage('fetch'):
+            resources = prefetch(request.inputs['resource'], response)
+        with self.timer.stage('extract'):
+            ncfiles = extract_archive(resources=resources, dir_output=self.workdir)
+        self.files.intermediate(*ncfiles)
 
         if 'variable' in request.inputs:
             var = request.inputs['variable'][0].data
@@ -91,29 +101,34 @@ class PlottimeseriesProcess(Process):
         response.update_status('plotting variable {}'.format(var), 10)
 
         try:
-            plotout_spagetti_file = plt_ncdata.spaghetti(ncfiles,
-                                                         variable=var,
-                                                         title='Field mean of {}'.format(var),
-                                                         dir_output=self.workdir,
-                                                         )
+            with self.timer.stage('compute', plot='spaghetti'):
+                plotout_spagetti_file = plt_ncdata.spaghetti(ncfiles,
+                                                             variable=var,
+                                                             title='Field mean of {}'.format(var),
+                                                             dir_output=self.workdir,
+                                                             )
             LOGGER.info("spagetti plot done")
             response.update_status('Spagetti plot for %s %s files done' % (len(ncfiles), var), 50)
+            self.files.output(plotout_spagetti_file)
             response.outputs['plotout_spagetti'].file = plotout_spagetti_file
         except Exception as e:
             raise Exception("spagetti plot failed : {}".format(e))
 
         try:
-            plotout_uncertainty_file = plt_ncdata.uncertainty(ncfiles,
-                                                              variable=var,
-                                                              title='Ensemble uncertainty for {}'.format(var),
-                                                              dir_output=self.workdir,
-                                                              )
+            with self.timer.stage('compute', plot='uncertainty'):
+                plotout_uncertainty_file = plt_ncdata.uncertainty(ncfiles,
+                                                                  variable=var,
+                                                                  title='Ensemble uncertainty for {}'.format(var),
+                                                                  dir_output=self.workdir,
+                                                                  )
 
             response.update_status('Uncertainty plot for {} {} files done'.format(len(ncfiles), var), 90)
+            self.files.output(plotout_uncertainty_file)
             response.outputs['plotout_uncertainty'].file = plotout_uncertainty_file
             LOGGER.info("uncertainty plot done")
         except Exception as err:
             raise Exception("uncertainty plot failed {}".format(err.message))
 
+        self.files.consumed(*ncfiles)
         response.update_status('visualisation done', 100)
         return response
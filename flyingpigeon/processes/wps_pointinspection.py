@@ -1,18 +1,19 @@
 import logging
 from os.path import join
 
-from numpy import savetxt, column_stack
 from pywps import ComplexInput, ComplexOutput
 from pywps import Format
 from pywps import LiteralInput
 from pywps import Process
 from pywps.app.Common import Metadata
-from shapely.geometry import Point
 
-from eggshell.nc.ocg_utils import call
-from eggshell.nc.nc_utils import sort_by_filename, get_values, get_time
-
-from eggshell.utils import archive, extract_archive
+from flyingpigeon.archives import DatasetStream, TarWriter
+from flyingpigeon.points import extract, read_points, describe, write_timeseries
+from flyingpigeon.points import OUTPUT_FORMATS, check_output_format
+from flyingpigeon.parallel import parallel_map
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 # from eggshell.utils import rename_complexinputs
 
 
@@ -21,9 +22,11 @@ LOGGER = logging.getLogger("PYWPS")
 
 class PointinspectionProcess(Process):
     """
-    TODO: optionally provide point list as file (csv, geojson) and WFS service
+    TODO: optionally provide point list from a WFS service
     """
 
+    identifier = "pointinspection"
+
     def __init__(self):
         inputs = [
             ComplexInput('resource', 'Resource',
@@ -42,13 +45,45 @@ class PointinspectionProcess(Process):
                          # noqa
                          default="2.356138, 48.846450",
                          data_type='string',
-                         min_occurs=1,
-                         max_occurs=100,
+                         min_occurs=0,
+                         max_occurs=10000,
                          ),
+
+            ComplexInput('points', 'Point file',
+                         abstract="CSV or GeoJSON file of points, used instead of the coordinates. "
+                                  "CSV files have lon and lat columns (or longitude/latitude, x/y) and "
+                                  "optionally an id or name column labelling the points. Without header, "
+                                  "the first two columns are the longitude and latitude.",
+                         min_occurs=0,
+                         max_occurs=1,
+                         supported_formats=[
+                             Format('text/csv', extension='.csv'),
+                             Format('application/vnd.geo+json', extension='.geojson'),
+                             Format('application/json', extension='.json'),
+                         ]),
+
+            LiteralInput('deduplicate', 'Deduplicate points',
+                         data_type='boolean',
+                         abstract="If True, points in the same grid cell share a single column, "
+                                  "labelled with the labels of all these points separated by '|'.",
+                         min_occurs=0,
+                         max_occurs=1,
+                         default=False),
+
+            LiteralInput('output_format', 'Output format',
+                         data_type='string',
+                         abstract="Format of the time series files: CSV table, gzip compressed CSV table, "
+                                  "netCDF file (CF timeSeries discrete sampling geometry), "
+                                  "Parquet or Feather table (with dates as strings for calendars other than "
+                                  "the standard one).",
+                         min_occurs=0,
+                         max_occurs=1,
+                         default='csv',
+                         allowed_values=list(OUTPUT_FORMATS)),
         ]
         outputs = [
             ComplexOutput('tarout', 'Subsets',
-                          abstract="Tar archive containing one CSV file per input file, "
+                          abstract="Tar archive containing one file per dataset in the selected output format, "
                                    "each one storing time series column-wise for all point coordinates.",
                           as_reference=True,
                           supported_formats=[Format('application/x-tar')]
@@ -62,7 +97,7 @@ class PointinspectionProcess(Process):
 
         super(PointinspectionProcess, self).__init__(
             self._handler,
-            identifier="pointinspection",
+            identifier=self.identifier,
             title="Point Inspection",
             abstract='Extract the timeseries at the given coordinates.',
             version="0.10",
@@ -76,57 +111,98 @@ class PointinspectionProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
         # init_process_logger('log.txt')
         # response.outputs['output_log'].file = 'log.txt'
-        ncs = extract_archive(
-            resources=[inpt.file for inpt in request.inputs['resource']],
-            dir_output=self.workdir)
-        LOGGER.info('ncs: {}'.format(ncs))
-
-        coords = []
-        for coord in request.inputs['coords']:
-            coords.append(coord.data)
-
-        LOGGER.info('coords {}'.format(coords))
-        filenames = []
-        nc_exp = sort_by_filename(ncs, historical_concatination=True)
-
-        for key in nc_exp.keys():
-            try:
-                LOGGER.info('start calculation for {}'.format(key))
-                ncs = nc_exp[key]
-                times = get_time(ncs)
-                concat_vals = times
-                header = 'date_time'
-                filename = join(self.workdir, '{}.csv'.format(key))
-                filenames.append(filename)
-
-                for p in coords:
-                    try:
-                        response.update_status('processing point: {}'.format(p), 20)
-                        # define the point:
-                        p = p.split(',')
-                        point = Point(float(p[0]), float(p[1]))
-
-                        # get the values
-                        timeseries = call(resource=ncs, geom=point, select_nearest=True, dir_output=self.workdir)
-                        vals = get_values(timeseries)
-
-                        # concatenation of values
-                        header = header + ',{}-{}'.format(p[0], p[1])
-                        concat_vals = column_stack([concat_vals, vals])
-                    except Exception as e:
-                        LOGGER.debug('failed for point {} {}'.format(p, e))
-                response.update_status('*** all points processed for {0} ****'.format(key), 50)
-
-                # TODO: Ascertain whether this 'savetxt' is a valid command without string formatting argument: '%s'
-                savetxt(filename, concat_vals, fmt='%s', delimiter=',', header=header)
-            except Exception as ex:
-                LOGGER.debug('failed for {}: {}'.format(key, str(ex)))
+        with self.timer.stage('fetch'):
+            resources = prefetch(request.inputs['resource'], response)
+        datasets = DatasetStream(resources, dir_output=self.workdir, historical_concatination=True)
+        keys = datasets.keys()
+        LOGGER.info('datasets: {}'.format(keys))
+
+        if 'points' in request.inputs:
+            points, labels = read_points(request.inputs['points'][0].file)
+            if labels is None:
+                labels = ['{}-{}'.format(*p) for p in points]
+        elif 'coords' in request.inputs:
+            coords = [coord.data for coord in request.inputs['coords']]
+            points = [[float(c) for c in coord.split(',')] for coord in coords]
+            labels = ['{}-{}'.format(*coord.split(',')) for coord in coords]
+        else:
+            raise Exception('Either coords or a point file is required.')
+
+        if 'deduplicate' in request.inputs:
+            deduplicate = request.inputs['deduplicate'][0].data
+        else:
+            deduplicate = False
+
+        if 'output_format' in request.inputs:
+            output_format = request.inputs['output_format'][0].data
+        else:
+            output_format = 'csv'
+        check_output_format(output_format)
+        LOGGER.info('{} points'.format(len(points)))
+
+        # Datasets are processed in parallel as soon as their files are extracted, each one producing its own
+        # file. Tasks are numbered in the order in which the datasets are extracted.
+        ncs, names = [], []
+
+        def tasks():
+            for key, files in self.timer.iterate('extract', datasets, source='archive'):
+                self.files.intermediate(*files)
+                ncs.extend(files)
+                names.append(key)
+                yield files, join(self.workdir, key), points, labels, deduplicate, output_format
+
+        response.update_status('processing {} points in {} datasets'.format(len(points), len(keys)), 5)
+        tar = TarWriter(dir_output=self.workdir, on_added=self.files.consumed)
+
+        # Values are extracted and written by the workers.
+        with self.timer.stage('compute', datasets=len(keys), points=len(points)):
+            results = parallel_map(inspect_dataset, tasks(), count=len(keys))
+            total = len(keys) * len(points)
+            done = 0
+            for i, filename, ex in results:
+                done += len(points)
+                if ex is None:
+                    self.files.intermediate(filename)
+                    tar.add(filename)
+                    msg = '*** all points processed for {0} ****'.format(names[i])
+                else:
+                    LOGGER.debug('failed for {}: {}'.format(names[i], str(ex)))
+                    msg = 'failed for {}'.format(names[i])
+                response.update_status('{} ({}/{} dataset points)'.format(msg, done, total),
+                                       5 + 85 * done // total)
+        # Historical files may belong to several datasets, so the inputs are removed once all are done.
+        self.files.consumed(*ncs)
 
         # set the outputs
         response.update_status('*** creating output tar archive ****', 90)
-        tarout_file = archive(filenames, dir_output=self.workdir)
-        response.outputs['tarout'].file = tarout_file
+        with self.timer.stage('archive'):
+            response.outputs['tarout'].file = tar.close()
+        self.files.output(tar.path)
         return response
+
+
+def inspect_dataset(ncs, prefix, points, labels, deduplicate=False, output_format='csv'):
+    """Extract the time series of a dataset at the given points and return the written file.
+
+    :param ncs: files of the dataset, see :func:`eggshell.nc.nc_utils.sort_by_filename`
+    :param prefix: path of the output file without suffix
+    """
+    from eggshell.nc.nc_utils import get_time
+
+    LOGGER.info('start calculation for {}'.format(prefix))
+    times = get_time(ncs)
+
+    # values of all points, read at once from each file
+    vals, columns = extract(ncs, points, deduplicate=deduplicate)
+
+    return write_timeseries(
+        prefix, times, vals,
+        labels=['|'.join(labels[i] for i in c) for c in columns],
+        points=[points[c[0]] for c in columns],
+        output_format=output_format,
+        **describe(ncs))
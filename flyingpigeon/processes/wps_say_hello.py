@@ -7,6 +7,8 @@ LOGGER = logging.getLogger("PYWPS")
 
 class SayHello(Process):
     """A nice process saying 'hello'."""
+    identifier = 'hello'
+
     def __init__(self):
         inputs = [
             LiteralInput('name', 'Your name',
@@ -21,7 +23,7 @@ class SayHello(Process):
 
         super(SayHello, self).__init__(
             self._handler,
-            identifier='hello',
+            identifier=self.identifier,
             title='Say Hello',
             abstract='Just says a friendly Hello.'
                      'Returns a literal string output with Hello plus the inputed name.',
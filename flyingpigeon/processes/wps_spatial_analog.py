@@ -8,9 +8,6 @@ import logging
 import datetime as dt
 
 import netCDF4 as nc
-import ocgis
-
-from ocgis import FunctionRegistry, RequestDataset, OcgOperations
 from pywps import ComplexInput, ComplexOutput
 from pywps import Format
 from pywps import LiteralInput
@@ -18,19 +15,22 @@ from pywps import Process
 from pywps.app.Common import Metadata
 from shapely.geometry import Point
 
-from eggshell.nc.ocg_utils import call
-from eggshell.utils import extract_archive
 # from eggshell.utils import rename_complexinputs
 # from eggshell.log import init_process_logger
 
-from flyingpigeon.ocgisDissimilarity import Dissimilarity, metrics
+from flyingpigeon.dissimilarity import __all__ as metrics
+from flyingpigeon.archives import extract_archive
+from flyingpigeon.points import nearest_cell
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 
 LOGGER = logging.getLogger("PYWPS")
 
-FunctionRegistry.append(Dissimilarity)
-
 
 class SpatialAnalogProcess(Process):
+    identifier = "spatial_analog"
+
     def __init__(self):
         inputs = [
             ComplexInput('candidate', 'Candidate netCDF dataset',
@@ -126,7 +126,7 @@ class SpatialAnalogProcess(Process):
 
         super(SpatialAnalogProcess, self).__init__(
             self._handler,
-            identifier="spatial_analog",
+            identifier=self.identifier,
             title="Spatial analog of a target climate.",
             abstract="Spatial analogs based on the comparison of climate "
                      "indices. The algorithm compares the distribution of the "
@@ -143,7 +143,14 @@ class SpatialAnalogProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        import ocgis
+        from ocgis import RequestDataset, OcgOperations
+        from eggshell.nc.ocg_utils import call
+        # Registers the dissimilarity function with ocgis.
+        import flyingpigeon.ocgisDissimilarity  # noqa: F401
 
         ocgis.env.DIR_OUTPUT = self.workdir
         ocgis.env.OVERWRITE = True
@@ -156,12 +163,13 @@ class SpatialAnalogProcess(Process):
         # Read inputs
         ######################################
         try:
-            candidate = extract_archive(
-                resources=[inpt.file for inpt in request.inputs['candidate']],
-                dir_output=self.workdir)
-            target = extract_archive(
-                resources=[inpt.file for inpt in request.inputs['target']],
-                dir_output=self.workdir)
+            with self.timer.stage('fetch'):
+                files = prefetch(list(request.inputs['candidate']) + list(request.inputs['target']), response)
+            count = len(request.inputs['candidate'])
+            with self.timer.stage('extract'):
+                candidate = extract_archive(resources=files[:count], dir_output=self.workdir)
+                target = extract_archive(resources=files[count:], dir_output=self.workdir)
+            self.files.intermediate(*candidate + target)
             location = request.inputs['location'][0].data
             indices = [el.data for el in request.inputs['indices']]
             dist = request.inputs['dist'][0].data
@@ -176,8 +184,6 @@ class SpatialAnalogProcess(Process):
             raise Exception(msg)
 
         response.update_status('Parsed input parameters', 2)
-
-        LOGGER.debug("init took {}".format(dt.datetime.now() - tic))
         response.update_status('Processed input parameters', 3)
 
         ######################################
@@ -199,10 +205,24 @@ class SpatialAnalogProcess(Process):
                 trd = RequestDataset(target, variable=indices,
                                      time_range=[start_target, end_target])
 
-                op = OcgOperations(trd, geom=point, select_nearest=True,
-                                   search_radius_mult=1.75, dir_output=self.workdir)
-                out = op.execute()
-                target_ts = out.get_element()
+                # The cell nearest to the target location is looked up in the grid index cache, which
+                # spares ocgis the search over all cells of the grid.
+                try:
+                    cell = nearest_cell(target, point.x, point.y)
+                except Exception as e:
+                    LOGGER.debug('Grid index lookup failed: {}'.format(e))
+                    cell = None
+
+                with self.timer.stage('ocgis', nearest_cell=cell is not None):
+                    if cell is not None:
+                        row, col = cell
+                        op = OcgOperations(trd, slice=[None, None, None, [row, row + 1], [col, col + 1]],
+                                           dir_output=self.workdir)
+                    else:
+                        op = OcgOperations(trd, geom=point, select_nearest=True,
+                                           search_radius_mult=1.75, dir_output=self.workdir)
+                    out = op.execute()
+                    target_ts = out.get_element()
 
         except Exception as ex:
             msg = 'Target extraction failed {}'.format(ex)
@@ -217,35 +237,40 @@ class SpatialAnalogProcess(Process):
 
         response.update_status('Computing spatial analog', 6)
         try:
-            output = call(resource=candidate,
-                          calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
-                                 'kwds': {'dist': dist, 'target': target_ts,
-                                          'candidate': indices}}],
-                          time_range=[start_candidate, end_candidate],
-                          dir_output=self.workdir,
-                          )
+            with self.timer.stage('compute', dist=dist):
+                output = call(resource=candidate,
+                              calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
+                                     'kwds': {'dist': dist, 'target': target_ts,
+                                              'candidate': indices}}],
+                              time_range=[start_candidate, end_candidate],
+                              dir_output=self.workdir,
+                              )
 
         except Exception as ex:
             msg = 'Spatial analog failed: {}'.format(ex)
             LOGGER.exception(msg)
             raise Exception(msg)
 
-        add_metadata(output,
-                     dist=dist,
-                     indices=",".join(indices),
-                     target_location=location,
-                     candidate_time_range="{},{}".format(start_candidate,
-                                                         end_candidate),
-                     target_time_range="{},{}".format(start_target,
-                                                      end_target)
-                     )
+        # The target series is read lazily by ocgis, so the inputs are only removed once the metric is computed.
+        self.files.consumed(*candidate + target)
+        self.files.output(output)
+
+        with self.timer.stage('write'):
+            add_metadata(output,
+                         dist=dist,
+                         indices=",".join(indices),
+                         target_location=location,
+                         candidate_time_range="{},{}".format(start_candidate,
+                                                             end_candidate),
+                         target_time_range="{},{}".format(start_target,
+                                                          end_target)
+                         )
 
         response.update_status('Computed spatial analog', 95)
 
         response.outputs['output'].file = output
 
         response.update_status('Execution completed', 100)
-        LOGGER.debug("Total execution took {}".format(dt.datetime.now() - tic))
         return response
 
 
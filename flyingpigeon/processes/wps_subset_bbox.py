@@ -5,10 +5,11 @@ from pathlib import Path
 from pywps import Process, LiteralInput, FORMATS
 from pywps.inout.outputs import MetaFile, MetaLink4
 
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 from .subset_base import Subsetter, resource, variable, start, end, output, metalink
 from pywps.app.Common import Metadata
 
-import ocgis.exc
 
 LOGGER = logging.getLogger("PYWPS")
 
@@ -16,6 +17,8 @@ LOGGER = logging.getLogger("PYWPS")
 class SubsetBboxProcess(Subsetter, Process):
     """Subset a NetCDF file using bounding box geometry."""
 
+    identifier = 'subset_bbox'
+
     def __init__(self):
         inputs = [resource,
                   LiteralInput('lon0',
@@ -40,7 +43,7 @@ class SubsetBboxProcess(Subsetter, Process):
 
         super(SubsetBboxProcess, self).__init__(
             self._handler,
-            identifier='subset_bbox',
+            identifier=self.identifier,
             title='Subset netCDF file on bounding box',
             version='0.2',
             abstract=('Return the data for which grid cells intersect the '
@@ -58,32 +61,44 @@ class SubsetBboxProcess(Subsetter, Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        import ocgis.exc
 
         geom = self.parse_bbox(request)
         dr = self.parse_daterange(request)
 
         ml = MetaLink4('subset', workdir=self.workdir)
 
-        for res in self.parse_resources(request):
+        with self.timer.stage('fetch'):
+            resources = list(self.parse_resources(request, response))
+        self.files.intermediate(*resources)
+
+        for res in resources:
             variables = self.parse_variable(request, res)
             prefix = Path(res).stem + "_bbox_subset"
             rd = ocgis.RequestDataset(res, variables)
 
             try:
-                ops = ocgis.OcgOperations(
-                    dataset=rd, geom=geom, time_range=dr,
-                    output_format='nc',
-                    interpolate_spatial_bounds=True,
-                    prefix=prefix, dir_output=tempfile.mkdtemp(dir=self.workdir))
-                out = ops.execute()
-
+                with self.timer.stage('ocgis', dataset=Path(res).name):
+                    ops = ocgis.OcgOperations(
+                        dataset=rd, geom=geom, time_range=dr,
+                        output_format='nc',
+                        interpolate_spatial_bounds=True,
+                        prefix=prefix, dir_output=tempfile.mkdtemp(dir=self.workdir))
+                    out = ops.execute()
+
+                self.files.output(out)
                 mf = MetaFile(prefix, fmt=FORMATS.NETCDF)
                 mf.file = out
                 ml.append(mf)
 
             except ocgis.exc.ExtentError:
                 continue
+            finally:
+                # Downloaded files are removed once subset.
+                self.files.consumed(res)
 
         response.outputs['output'].file = ml.files[0].file
         response.outputs['metalink'].data = ml.xml
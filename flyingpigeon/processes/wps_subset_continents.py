@@ -1,11 +1,14 @@
 import logging
 
 from pywps import ComplexInput, ComplexOutput, Format, LiteralInput, Process
+from pywps import configuration
 from pywps.app.Common import Metadata
 
-from flyingpigeon.subset import _CONTINENTS_
-from flyingpigeon.subset import clipping
-from eggshell.utils import archive, extract_archive
+from flyingpigeon.regions import continents
+from flyingpigeon.archives import DatasetStream, TarWriter
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed, QuotaExceeded
 # from eggshell.utils import rename_complexinputs
 from os.path import abspath
 
@@ -17,15 +20,17 @@ class SubsetcontinentProcess(Process):
     TODO: opendap input support, additional metadata to display region names.
     """
 
+    identifier = "subset_continents"
+
     def __init__(self):
         inputs = [
             LiteralInput('region', 'Region',
                          data_type='string',
                          abstract="Continent name.",
                          min_occurs=1,
-                         max_occurs=len(_CONTINENTS_),
+                         max_occurs=len(continents()),
                          default='Africa',
-                         allowed_values=_CONTINENTS_),  # REGION_EUROPE #COUNTRIES
+                         allowed_values=continents()),  # REGION_EUROPE #COUNTRIES
 
             LiteralInput('mosaic', 'Union of multiple regions',
                          data_type='boolean',
@@ -63,7 +68,7 @@ class SubsetcontinentProcess(Process):
 
         super(SubsetcontinentProcess, self).__init__(
             self._handler,
-            identifier="subset_continents",
+            identifier=self.identifier,
             title="Subset Continents",
             version="0.11",
             abstract="Return the data whose grid cells intersect the selected continents for each input dataset.",
@@ -77,14 +82,17 @@ class SubsetcontinentProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        from flyingpigeon.subset import clipping
 
         # input files
         LOGGER.debug("url={}, mime_type={}".format(request.inputs['resource'][0].url,
                      request.inputs['resource'][0].data_format.mime_type))
-        ncs = extract_archive(
-            resources=[inpt.file for inpt in request.inputs['resource']],
-            dir_output=self.workdir)
+        with self.timer.stage('fetch'):
+            resources = prefetch(request.inputs['resource'], response)
+        datasets = DatasetStream(resources, dir_output=self.workdir, historical_concatination=True)
         # mime_type=request.inputs['resource'][0].data_format.mime_type)
         # mosaic option
         # TODO: fix defaults in pywps 4.x
@@ -95,26 +103,52 @@ class SubsetcontinentProcess(Process):
         # regions used for subsetting
         regions = [inp.data for inp in request.inputs['region']]
 
-        LOGGER.info('ncs: {}'.format(ncs))
+        LOGGER.info('datasets: {}'.format(datasets.keys()))
         LOGGER.info('regions: {}'.format(regions))
         LOGGER.info('mosaic: {}'.format(mosaic))
         LOGGER.info('flyingpigeon dir_output : {}'.format(abspath(self.workdir)))
 
         response.update_status("Arguments set for subset process", 0)
-        LOGGER.debug('starting: regions={}, num_files={}'.format(len(regions), len(ncs)))
-
+        LOGGER.debug('starting: regions={}, num_datasets={}'.format(len(regions), len(datasets)))
+
+        def archived(path):
+            # The first clipped file is also the netCDF output, the others are removed once archived.
+            if self.files.outputs:
+                self.files.intermediate(path)
+            else:
+                self.files.output(path)
+            tar.add(path)
+
+        # Datasets are clipped as soon as their files are extracted, and clipped files are appended to the tar
+        # file while the next ones are computed.
+        results, ncs_all = [], []
         try:
-            results = clipping(
-                resource=ncs,
-                polygons=regions,
-                mosaic=mosaic,
-                spatial_wrapping='wrap',
-                # variable=variable,
-                dir_output=self.workdir,
-                # dimension_map=dimension_map,
-            )
+            with TarWriter(dir_output=self.workdir, on_added=self.files.consumed) as tar:
+                for key, ncs in self.timer.iterate('extract', datasets):
+                    self.files.intermediate(*ncs)
+                    with self.timer.stage('ocgis', dataset=key, regions=len(regions)):
+                        results.extend(clipping(
+                            resource=ncs,
+                            polygons=regions,
+                            mosaic=mosaic,
+                            spatial_wrapping='wrap',
+                            # variable=variable,
+                            dir_output=self.workdir,
+                            # dimension_map=dimension_map,
+                            simplify=configuration.get_config_value('extra', 'simplify_geometries') is True,
+                            mask_cache=configuration.get_config_value('extra', 'mask_cache') is True,
+                            callback=archived,
+                        ))
+                    ncs_all.extend(ncs)
+                # Historical files may belong to several datasets, so the inputs are removed once all are clipped.
+                self.files.consumed(*ncs_all)
+                # Waits for the files still being appended.
+                with self.timer.stage('archive'):
+                    tar.close()
             LOGGER.info('results %s' % results)
 
+        except QuotaExceeded:
+            raise
         except Exception as ex:
             msg = 'Clipping failed: {}'.format(str(ex))
             LOGGER.exception(msg)
@@ -123,17 +157,8 @@ class SubsetcontinentProcess(Process):
         if not results:
             raise Exception('No results produced.')
 
-        # prepare tar file
-        try:
-            tarf = archive(results, dir_output=self.workdir)
-            LOGGER.info('Tar file prepared')
-
-        except Exception as ex:
-            msg = 'Tar file preparation failed: {}'.format(str(ex))
-            LOGGER.exception(msg)
-            raise Exception(msg)
-
-        response.outputs['output'].file = tarf
+        self.files.output(tar.path)
+        response.outputs['output'].file = tar.path
 
         i = next((i for i, x in enumerate(results) if x), None)
         response.outputs['ncout'].file = results[i]
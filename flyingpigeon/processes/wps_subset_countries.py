@@ -1,11 +1,14 @@
 import logging
 
 from pywps import ComplexInput, ComplexOutput, Format, LiteralInput, Process
+from pywps import configuration
 from pywps.app.Common import Metadata
 
-from flyingpigeon.subset import clipping
-from flyingpigeon.subset import countries
-from eggshell.utils import archive, extract_archive
+from flyingpigeon.regions import countries
+from flyingpigeon.archives import DatasetStream, TarWriter
+from flyingpigeon.remote import prefetch
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed, QuotaExceeded
 # from eggshell.utils import rename_complexinputs
 
 LOGGER = logging.getLogger("PYWPS")
@@ -17,6 +20,8 @@ class SubsetcountryProcess(Process):
     TODO: opendap input support, additional metadata to display region names.
     """
 
+    identifier = "subset_countries"
+
     def __init__(self):
         inputs = [
             LiteralInput('region', 'Region',
@@ -71,7 +76,7 @@ class SubsetcountryProcess(Process):
 
         super(SubsetcountryProcess, self).__init__(
             self._handler,
-            identifier="subset_countries",
+            identifier=self.identifier,
             title="Subset Countries",
             version="0.11",
             abstract="Return the data whose grid cells intersect the selected countries for each input dataset.",
@@ -84,7 +89,11 @@ class SubsetcountryProcess(Process):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        from flyingpigeon.subset import clipping
+
         # init_process_logger('log.txt')
         # response.outputs['output_log'].file = 'log.txt'
 
@@ -92,9 +101,9 @@ class SubsetcountryProcess(Process):
         LOGGER.debug('url={}, mime_type={}'.format(
             request.inputs['resource'][0].url,
             request.inputs['resource'][0].data_format.mime_type))
-        ncs = extract_archive(
-            resources=[inpt.file for inpt in request.inputs['resource']],
-            dir_output=self.workdir)
+        with self.timer.stage('fetch'):
+            resources = prefetch(request.inputs['resource'], response)
+        datasets = DatasetStream(resources, dir_output=self.workdir, historical_concatination=True)
         # mime_type=request.inputs['resource'][0].data_format.mime_type)
         # mosaic option
         # TODO: fix defaults in pywps 4.x
@@ -105,24 +114,50 @@ class SubsetcountryProcess(Process):
         # regions used for subsetting
         regions = [inp.data for inp in request.inputs['region']]
 
-        LOGGER.info('ncs={}'.format(ncs))
+        LOGGER.info('datasets={}'.format(datasets.keys()))
         LOGGER.info('regions={}'.format(regions))
         LOGGER.info('mosaic={}'.format(mosaic))
 
         response.update_status("Arguments set for subset process", 0)
-        LOGGER.debug('starting: regions={}, num_files={}'.format(len(regions), len(ncs)))
-
+        LOGGER.debug('starting: regions={}, num_datasets={}'.format(len(regions), len(datasets)))
+
+        def archived(path):
+            # The first clipped file is also the netCDF output, the others are removed once archived.
+            if self.files.outputs:
+                self.files.intermediate(path)
+            else:
+                self.files.output(path)
+            tar.add(path)
+
+        # Datasets are clipped as soon as their files are extracted, and clipped files are appended to the tar
+        # file while the next ones are computed.
+        results, ncs_all = [], []
         try:
-            results = clipping(
-                resource=ncs,
-                polygons=regions,  # self.region.getValue(),
-                mosaic=mosaic,
-                spatial_wrapping='wrap',
-                # variable=variable,
-                dir_output=self.workdir,
-                # dimension_map=dimension_map,
-            )
+            with TarWriter(dir_output=self.workdir, on_added=self.files.consumed) as tar:
+                for key, ncs in self.timer.iterate('extract', datasets):
+                    self.files.intermediate(*ncs)
+                    with self.timer.stage('ocgis', dataset=key, regions=len(regions)):
+                        results.extend(clipping(
+                            resource=ncs,
+                            polygons=regions,  # self.region.getValue(),
+                            mosaic=mosaic,
+                            spatial_wrapping='wrap',
+                            # variable=variable,
+                            dir_output=self.workdir,
+                            # dimension_map=dimension_map,
+                            simplify=configuration.get_config_value('extra', 'simplify_geometries') is True,
+                            mask_cache=configuration.get_config_value('extra', 'mask_cache') is True,
+                            callback=archived,
+                        ))
+                    ncs_all.extend(ncs)
+                # Historical files may belong to several datasets, so the inputs are removed once all are clipped.
+                self.files.consumed(*ncs_all)
+                # Waits for the files still being appended.
+                with self.timer.stage('archive'):
+                    tar.close()
             LOGGER.info('results %s' % results)
+        except QuotaExceeded:
+            raise
         except Exception as ex:
             msg = 'Clipping failed: {}'.format(str(ex))
             LOGGER.exception(msg)
@@ -131,16 +166,8 @@ class SubsetcountryProcess(Process):
         if not results:
             raise Exception('No results produced.')
 
-        # prepare tar file
-        try:
-            tarf = archive(results, dir_output=self.workdir)
-            LOGGER.info('Tar file prepared.')
-        except Exception as ex:
-            msg = 'Tar file preparation failed: {}'.format(str(ex))
-            LOGGER.exception(msg)
-            raise Exception(msg)
-
-        response.outputs['output'].file = tarf
+        self.files.output(tar.path)
+        response.outputs['output'].file = tar.path
 
         i = next((i for i, x in enumerate(results) if x), None)
         response.outputs['ncout'].file = results[i]
@@ -1,18 +1,23 @@
+import logging
 import tempfile
 from pathlib import Path
 
 from pywps import Process, LiteralInput, FORMATS
 from pywps.inout.outputs import MetaFile, MetaLink4
 
+from flyingpigeon.stages import timed
+from flyingpigeon.workdir import managed
 from .subset_base import Subsetter, resource, variable, start, end, output, metalink
 
-import ocgis
-import ocgis.exc
+
+LOGGER = logging.getLogger("PYWPS")
 
 
 class SubsetWFSPolygonProcess(Process, Subsetter):
     """Subset a NetCDF file using WFS geometry."""
 
+    identifier = 'subset-wfs-polygon'
+
     def __init__(self):
         inputs = [
             resource,
@@ -47,7 +52,7 @@ class SubsetWFSPolygonProcess(Process, Subsetter):
 
         super(SubsetWFSPolygonProcess, self).__init__(
             self._handler,
-            identifier='subset-wfs-polygon',
+            identifier=self.identifier,
             title='Subset',
             version='0.2',
             abstract=('Return the data for which grid cells intersect the '
@@ -59,33 +64,60 @@ class SubsetWFSPolygonProcess(Process, Subsetter):
             store_supported=True,
         )
 
+    @timed
+    @managed
     def _handler(self, request, response):
+        import ocgis.exc
+        from flyingpigeon.subset import aggregate_by_weights
+
+        spatial_operation = 'clip'
 
-        geoms = self.parse_feature(request)
+        with self.timer.stage('fetch', source='wfs'):
+            geoms = self.parse_feature(request)
         dr = self.parse_daterange(request)
 
         ml = MetaLink4('subset', workdir=self.workdir)
 
-        for res in self.parse_resources(request):
+        with self.timer.stage('fetch'):
+            resources = list(self.parse_resources(request, response))
+        self.files.intermediate(*resources)
+
+        for res in resources:
             variables = self.parse_variable(request, res)
+            extent = self.parse_extent(res)
 
             for geom in geoms:
                 prefix = Path(res).stem
                 if 'featuresids' in request.inputs:
                     prefix += "_feature"
 
+                # Skip regions outside of the grid before starting the ocgis operation.
+                geom = self.restrict_geom(geom, extent)
+                mask = self.cached_mask(res, geom, spatial_operation) if geom is not None else None
+                if geom is None or (mask is not None and mask[0] is None):
+                    LOGGER.info('{} does not intersect the requested region, skipped.'.format(res))
+                    continue
+
                 rd = ocgis.RequestDataset(res, variables)
 
                 try:
-                    ops = ocgis.OcgOperations(
-                        dataset=rd, geom=geom['geom'],
-                        spatial_operation='clip', aggregate=True,
-                        time_range=dr, output_format='nc',
-                        interpolate_spatial_bounds=True,
-                        prefix=prefix, dir_output=tempfile.mkdtemp(dir=self.workdir))
-
-                    out = ops.execute()
-
+                    with self.timer.stage('ocgis', dataset=Path(res).name, mask_cache=mask is not None):
+                        dir_output = tempfile.mkdtemp(dir=self.workdir)
+                        if mask is not None:
+                            # The cached cell weights replace the intersection of the grid with the region.
+                            out = aggregate_by_weights(res, variables, *mask, prefix=prefix, time_range=dr,
+                                                       dir_output=dir_output)
+                        else:
+                            ops = ocgis.OcgOperations(
+                                dataset=rd, geom=geom['geom'],
+                                spatial_operation=spatial_operation, aggregate=True,
+                                time_range=dr, output_format='nc',
+                                interpolate_spatial_bounds=True,
+                                prefix=prefix, dir_output=dir_output)
+
+                            out = ops.execute()
+
+                    self.files.output(out)
                     mf = MetaFile(prefix, fmt=FORMATS.NETCDF)
                     mf.file = out
                     ml.append(mf)
@@ -93,6 +125,9 @@ class SubsetWFSPolygonProcess(Process, Subsetter):
                 except ocgis.exc.ExtentError:
                     continue
 
+            # Downloaded files are removed once subset.
+            self.files.consumed(res)
+
         response.outputs['output'].file = ml.files[0].file
         response.outputs['metalink'].data = ml.xml
         response.update_status("Completed", 100)
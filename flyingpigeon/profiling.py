@@ -0,0 +1,161 @@
+"""
+Profiling of individual Execute requests.
+
+If the `profiling` option is set, Execute requests sent with the `profiling_header` HTTP header set to the
+secret `profiling_token` are profiled. The handler of the process runs under cProfile, while a thread samples
+its call stack. Two files are written to the output directory of the job: ``profile.pstats``, to be read with
+:mod:`pstats` or snakeviz, and ``profile.collapsed``, the sampled stacks in the collapsed format of
+flamegraph.pl, speedscope and inferno.
+
+Requests waiting in the queue are restored from the database without their HTTP headers, so profiled requests
+are marked by their uuid when they are accepted.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+
+from pywps import configuration
+
+from flyingpigeon import compat
+
+LOGGER = logging.getLogger("PYWPS")
+
+DEFAULT_HEADER = 'X-Flyingpigeon-Profile'
+
+PROFILE_FILENAME = 'profile.pstats'
+STACKS_FILENAME = 'profile.collapsed'
+
+# Time in seconds between two samples of the call stack.
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler(object):
+    """Sample the call stack of a thread at regular intervals.
+
+    :param thread_id: identifier of the sampled thread, by default the current thread
+    :param interval: time between two samples in seconds
+    """
+
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Write the sampled stacks in the collapsed format, one "stack count" line per stack."""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+
+class Profiler(object):
+    """Profiler of the Execute requests asking for it.
+
+    :param token: secret value of the header
+    :param header: HTTP header of the requests to profile
+    :param marker_dir: directory of the markers of the profiled requests
+    """
+
+    def __init__(self, token, header=DEFAULT_HEADER, marker_dir=None):
+        self.token = token
+        self.header = header
+        self.marker_dir = marker_dir or os.path.join(
+            configuration.get_config_value('server', 'workdir') or '.', 'flyingpigeon_profiles')
+        os.makedirs(self.marker_dir, exist_ok=True)
+
+    def requested(self, wps_request):
+        """Return whether a request asks to be profiled with the right token."""
+        http_request = getattr(wps_request, 'http_request', None)
+        if http_request is None:
+            return False
+        value = http_request.headers.get(self.header)
+        if not value:
+            return False
+        if not hmac.compare_digest(value.encode('utf-8'), self.token.encode('utf-8')):
+            LOGGER.warning('Profiling refused: invalid {} header'.format(self.header))
+            return False
+        return True
+
+    def _marker(self, uuid):
+        return os.path.join(self.marker_dir, str(uuid))
+
+    def attach(self, process):
+        """Profile the executions of a process prepared for execution, if their request asks for it."""
+        profiler = self
+        handler = process.handler
+
+        def execute(async_, wps_request, wps_response):
+            if profiler.requested(wps_request):
+                open(profiler._marker(process.uuid), 'w').close()
+            return execute_process(async_, wps_request, wps_response)
+
+        def profiled(request, response):
+            try:
+                os.remove(profiler._marker(process.uuid))
+            except OSError:
+                return handler(request, response)
+            return profiler.profile(process, handler, request, response)
+
+        execute_process = compat.override(process, '_execute_process', execute)
+        process.handler = profiled
+
+    @staticmethod
+    def profile(process, handler, request, response):
+        """Run a handler under cProfile and the stack sampler, and write the profiles next to the outputs."""
+        profile = cProfile.Profile()
+        sampler = StackSampler()
+        sampler.start()
+        profile.enable()
+        try:
+            return handler(request, response)
+        finally:
+            profile.disable()
+            sampler.stop()
+            try:
+                path = os.path.join(configuration.get_config_value('server', 'outputpath'), str(process.uuid))
+                os.makedirs(path, exist_ok=True)
+                profile.dump_stats(os.path.join(path, PROFILE_FILENAME))
+                sampler.write(os.path.join(path, STACKS_FILENAME))
+                LOGGER.info('Profile of {} written to {}'.format(process.uuid, path))
+            except (IOError, OSError) as e:
+                LOGGER.warning('Could not write the profile of {}: {}'.format(process.uuid, e))
+
+
+def get_profiler():
+    """Return the profiler configured by the `profiling` options, or None if profiling is disabled."""
+    if configuration.get_config_value('extra', 'profiling') is not True:
+        return None
+    token = configuration.get_config_value('extra', 'profiling_token')
+    if not token:
+        LOGGER.warning('Profiling disabled: the profiling_token option is not set')
+        return None
+    return Profiler(token, header=configuration.get_config_value('extra', 'profiling_header') or DEFAULT_HEADER)
@@ -0,0 +1,74 @@
+"""
+Regions of the shapefiles distributed with flyingpigeon.
+
+The attribute tables (dBase files) of the shapefiles are read directly, without ocgis, so that the processes
+can list the available regions without loading the geometry libraries.
+"""
+import os
+import struct
+from functools import lru_cache
+
+SHAPEFILES = os.path.join(os.path.dirname(__file__), 'data', 'shapefiles')
+
+
+def _encoding(name):
+    """Return the encoding of the attribute table of a shapefile, given by its .cpg file."""
+    try:
+        with open(os.path.join(SHAPEFILES, name + '.cpg')) as f:
+            return f.read().strip() or 'latin-1'
+    except IOError:
+        return 'latin-1'
+
+
+@lru_cache(maxsize=None)
+def read_attributes(name):
+    """Return the attributes of the features of a shapefile, as a list of dictionaries.
+
+    :param name: name of the shapefile, e.g. 'countries'
+    """
+    encoding = _encoding(name)
+    with open(os.path.join(SHAPEFILES, name + '.dbf'), 'rb') as f:
+        nrecords, header_size, record_size = struct.unpack('<4xIHH20x', f.read(32))
+        fields = []
+        while f.tell() < header_size - 1:
+            desc = f.read(32)
+            if desc[:1] == b'\r':
+                break
+            # name, type, size and number of decimals of the field
+            fields.append((desc[:11].split(b'\0')[0].decode('ascii'), desc[11:12], desc[16], desc[17]))
+
+        f.seek(header_size)
+        records = []
+        for _ in range(nrecords):
+            data = f.read(record_size)
+            # Deleted records are flagged with an asterisk.
+            if data[:1] == b'*':
+                continue
+            record, pos = {}, 1
+            for field, kind, size, decimals in fields:
+                value = data[pos:pos + size].decode(encoding).strip()
+                pos += size
+                if kind in (b'N', b'F') and value:
+                    value = float(value) if decimals or kind == b'F' else int(value)
+                record[field] = value
+            records.append(record)
+    return records
+
+
+def column_values(name, column):
+    """Return the values of an attribute of all features of a shapefile.
+
+    :param name: name of the shapefile
+    :param column: name of the attribute
+    """
+    return [record[column] for record in read_attributes(name)]
+
+
+def continents():
+    """Return the names of the continents."""
+    return column_values('continents', 'CONTINENT')
+
+
+def countries():
+    """Return the ISO 3166 alpha-3 codes of the countries."""
+    return column_values('countries', 'ADM0_A3')
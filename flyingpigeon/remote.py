@@ -0,0 +1,272 @@
+"""
+Access to remote services and files.
+
+All HTTP requests of a server process go through a single :class:`requests.Session`, so that connections to
+the same host are kept alive and reused between requests.
+"""
+import itertools
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import requests
+from pywps import configuration
+from pywps.inout.basic import UrlHandler
+from requests.adapters import HTTPAdapter
+
+from flyingpigeon import compat
+from flyingpigeon.cache import get_disk_cache, make_key
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Timeout in seconds for connecting to and reading from remote servers.
+TIMEOUT = (10, 60)
+
+POOL_SIZE = 10
+
+# Maximum number of concurrent downloads from the same host.
+HOST_LIMIT = 4
+
+CHUNK_SIZE = 1024 ** 2
+
+# Mode of the files of the input cache, which are shared by hardlinks with the working directories of the jobs.
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+_session = None
+_lock = threading.Lock()
+
+# OPeNDAP verdicts by (host, path) of the probed urls.
+_opendap = {}
+MAX_OPENDAP_ENTRIES = 10000
+
+
+def get_session():
+    """Return the HTTP session shared by all requests of this process."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def is_remote(url):
+    """Return whether the url points to a HTTP server."""
+    return bool(url) and urlsplit(url).scheme in ('http', 'https')
+
+
+def _opendap_key(url):
+    parts = urlsplit(url)
+    return parts.netloc, parts.path
+
+
+def is_opendap(url):
+    """Return whether the url is an OPeNDAP endpoint.
+
+    The url is probed by reading the beginning of its DDS response, and the verdict is remembered for
+    the host and path of the url. Servers that cannot be reached within the timeout are not considered
+    OPeNDAP servers, and are probed again at the next call.
+    """
+    if not is_remote(url):
+        return False
+    key = _opendap_key(url)
+    if key in _opendap:
+        return _opendap[key]
+
+    try:
+        with get_session().get(url + '.dds', stream=True, timeout=TIMEOUT) as resp:
+            head = next(resp.iter_content(64), b'') if resp.status_code == 200 else b''
+    except requests.RequestException as e:
+        LOGGER.debug('OPeNDAP probe of {} failed: {}'.format(url, e))
+        return False
+    verdict = head.lstrip().startswith(b'Dataset')
+
+    with _lock:
+        if len(_opendap) >= MAX_OPENDAP_ENTRIES:
+            _opendap.clear()
+        _opendap[key] = verdict
+    return verdict
+
+
+def probe_opendap(urls):
+    """Return a list telling for each url whether it is an OPeNDAP endpoint, probing the urls concurrently."""
+    urls = list(urls)
+    pending = list({url for url in urls if is_remote(url) and _opendap_key(url) not in _opendap})
+    verdicts = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(len(pending), POOL_SIZE)) as executor:
+            verdicts = dict(zip(pending, executor.map(is_opendap, pending)))
+    return [verdicts[url] if url in verdicts else is_opendap(url) for url in urls]
+
+
+def download(url, path, max_size=None, data=None):
+    """Stream the content of a url to a file and return the response headers.
+
+    :param url: url of the file
+    :param path: destination file
+    :param max_size: maximum size of the file in bytes
+    :param data: body of a POST request, by default the file is fetched with a GET request
+    """
+    size = 0
+    method = 'GET' if data is None else 'POST'
+    with get_session().request(method, url, data=data, stream=True, timeout=TIMEOUT) as resp:
+        resp.raise_for_status()
+        if max_size and int(resp.headers.get('Content-Length', 0)) > max_size:
+            raise IOError('File size of {} exceeds {} bytes'.format(url, max_size))
+        with open(path, 'wb') as f:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise IOError('File size of {} exceeds {} bytes'.format(url, max_size))
+                f.write(chunk)
+    return resp.headers
+
+
+def _validator(headers):
+    """Return the ETag or Last-Modified header identifying the version of a remote file."""
+    return headers.get('ETag') or headers.get('Last-Modified')
+
+
+def link(src, dst):
+    """Hardlink `src` to `dst`, or copy it if they are on different file systems."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def get_input_cache():
+    """Return the cache of input files, or None if the `input_cache` option is not set."""
+    if configuration.get_config_value('extra', 'input_cache') is not True:
+        return None
+    return get_disk_cache('inputs', 'input_cache_size')
+
+
+def fetch(url, path, max_size=None, cache=None, data=None):
+    """Fetch a remote file, reusing the version stored in the input cache if there is one.
+
+    Cached files are identified by their url and their ETag or Last-Modified header, and linked to `path`.
+    Files without any of these headers, and the responses to POST requests, are not cached.
+
+    Hardlinks avoid copying the cached files into the working directory of each job, but share the file with the
+    cache and the other jobs. Cached files, and therefore `path`, are thus made read-only, so that writing an
+    input in place fails instead of corrupting the cache. Processes running as root are not stopped by the file
+    permissions, and must not modify their inputs.
+
+    :param url: url of the file
+    :param path: destination file
+    :param max_size: maximum size of the file in bytes
+    :param cache: cache of input files, see :func:`get_input_cache`
+    :param data: body of a POST request
+    :return: number of downloaded bytes, 0 if the file was found in the cache
+    """
+    if data is not None:
+        cache = None
+    if cache is not None:
+        try:
+            head = get_session().head(url, allow_redirects=True, timeout=TIMEOUT)
+            validator = _validator(head.headers) if head.ok else None
+        except requests.RequestException:
+            validator = None
+        cached = cache.get(make_key(url, validator)) if validator else None
+        if cached is not None:
+            if max_size and os.path.getsize(cached) > max_size:
+                raise IOError('File size of {} exceeds {} bytes'.format(url, max_size))
+            os.chmod(cached, READ_ONLY)
+            link(cached, path)
+            return 0
+
+    headers = download(url, path, max_size, data)
+
+    validator = _validator(headers)
+    if cache is not None and validator:
+        def write(tmp):
+            link(path, tmp)
+            os.chmod(tmp, READ_ONLY)
+        cache.put(make_key(url, validator), write)
+    return os.path.getsize(path)
+
+
+def reserve_path(workdir, url):
+    """Create an empty file named after a url in a directory and return its path.
+
+    A number is appended to the name if the file already exists, so that urls with identical names, e.g. the
+    same file of different datasets, are not written to the same file.
+    """
+    name = os.path.basename(urlsplit(url).path) or 'input'
+    root, dot, ext = name.partition('.')
+    for i in itertools.count():
+        path = os.path.join(workdir, name if i == 0 else '{}_{}{}{}'.format(root, i, dot, ext))
+        try:
+            open(path, 'x').close()
+            return path
+        except FileExistsError:
+            continue
+
+
+def prefetch(inputs, response=None):
+    """Download concurrently the remote files of complex inputs into their working directory.
+
+    The files are downloaded with at most `POOL_SIZE` concurrent connections, and `HOST_LIMIT` connections
+    per host. If the `input_cache` option is set, files already fetched by previous requests are reused.
+    The files of the other inputs, e.g. local files, are returned by their `file` property.
+
+    Accessing the `file` property of a remote input would download it again, so the returned paths must be used
+    instead.
+
+    :param inputs: complex inputs
+    :param response: WPS response, whose status reports the download throughput
+    :return: list of the files of the inputs
+    """
+    inputs = list(inputs)
+    files = [None] * len(inputs)
+    pending = []
+    for i, inpt in enumerate(inputs):
+        if isinstance(inpt, UrlHandler) and is_remote(inpt.url):
+            # File names are reserved before starting the downloads.
+            pending.append((i, reserve_path(inpt.workdir, inpt.url)))
+        else:
+            files[i] = inpt.file
+
+    if pending:
+        cache = get_input_cache()
+        hosts = {urlsplit(inputs[i].url).netloc: threading.Semaphore(HOST_LIMIT) for i, _ in pending}
+
+        def fetch_input(inpt, path):
+            with hosts[urlsplit(inpt.url).netloc]:
+                return fetch(inpt.url, path, int(inpt.max_input_size()), cache, compat.post_data(inpt))
+
+        tic = time.time()
+        total = 0
+        with ThreadPoolExecutor(max_workers=min(len(pending), POOL_SIZE)) as executor:
+            futures = {executor.submit(fetch_input, inputs[i], path): (i, path) for i, path in pending}
+            for n, future in enumerate(as_completed(futures), 1):
+                i, path = futures[future]
+                try:
+                    total += future.result()
+                except Exception as e:
+                    for f in futures:
+                        f.cancel()
+                    raise Exception('File reference error for {}: {}'.format(inputs[i].url, e))
+                files[i] = path
+                rate = total / max(time.time() - tic, 1e-3) / 1024 ** 2
+                msg = 'Fetched {}/{} input files ({:.1f} MB, {:.1f} MB/s)'.format(
+                    n, len(pending), total / 1024 ** 2, rate)
+                LOGGER.info(msg)
+                if response is not None:
+                    response.update_status(msg)
+
+        if cache is not None:
+            LOGGER.info('Input cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+
+    return files
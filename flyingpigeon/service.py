@@ -0,0 +1,151 @@
+"""
+PyWPS service of flyingpigeon.
+
+GetCapabilities and DescribeProcess documents only depend on the configuration and on the processes, which
+do not change during the lifetime of a service. They are rendered once and served from memory, with an ETag
+header so that clients sending If-None-Match get an empty 304 response. A new service, e.g. created when the
+server reloads its configuration, starts with new documents.
+
+Execute requests are scheduled by :mod:`flyingpigeon.jobs` if the `job_scheduler` option is set, and their
+performance metrics recorded by :mod:`flyingpigeon.metrics` are served at the `/metrics` path. Requests may
+ask to be profiled, see :mod:`flyingpigeon.profiling`.
+"""
+import hashlib
+import logging
+import threading
+
+from pywps.app.Service import Service as PyWPSService
+from pywps.app.WPSRequest import WPSRequest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from flyingpigeon import compat
+from flyingpigeon.jobs import get_scheduler
+from flyingpigeon.metrics import CONTENT_TYPE, get_metrics
+from flyingpigeon.profiling import get_profiler
+from flyingpigeon.workdir import guard
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Maximum number of cached documents, which may be requested for any combination of processes.
+MAX_DOCUMENTS = 100
+
+# Documents rendered when the service is created.
+PREBUILT_DOCUMENTS = [
+    {'service': 'WPS', 'request': 'GetCapabilities', 'version': '1.0.0'},
+    {'service': 'WPS', 'request': 'DescribeProcess', 'version': '1.0.0', 'identifier': 'all'},
+]
+
+
+class Document(object):
+    """Rendered XML document with its ETag."""
+
+    def __init__(self, body):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+    def response(self, http_request):
+        """Return the document, or a 304 response if the client already has it."""
+        response = Response(self.body, content_type='text/xml')
+        response.set_etag(self.etag)
+        return response.make_conditional(http_request)
+
+
+class Service(PyWPSService):
+    """PyWPS service serving cached GetCapabilities and DescribeProcess documents.
+
+    :param processes: list of processes
+    :param cfgfiles: list of configuration files
+    :param prebuild: whether the documents of `PREBUILT_DOCUMENTS` are rendered right away
+    :raises RuntimeError: if the installed PyWPS is not supported, see :func:`flyingpigeon.compat.check`
+    """
+
+    def __init__(self, processes=[], cfgfiles=None, prebuild=True):
+        # The private PyWPS methods replaced by flyingpigeon must exist before any request is accepted.
+        compat.check()
+        super(Service, self).__init__(processes=processes, cfgfiles=cfgfiles)
+        self.scheduler = get_scheduler()
+        self.metrics = get_metrics()
+        self.profiler = get_profiler()
+        self.documents = {}
+        self._lock = threading.Lock()
+        if prebuild:
+            for args in PREBUILT_DOCUMENTS:
+                self.get_document(WPSRequest(Request(EnvironBuilder(query_string=args).get_environ())))
+
+    @staticmethod
+    def document_key(wps_request):
+        """Return the key of the document answering a request, or None if it is not cached."""
+        if wps_request.operation == 'getcapabilities':
+            return 'getcapabilities', wps_request.version, wps_request.language
+        if wps_request.operation == 'describeprocess':
+            return 'describeprocess', wps_request.version, wps_request.language, tuple(wps_request.identifiers)
+        return None
+
+    def get_document(self, wps_request):
+        """Return the document answering a GetCapabilities or DescribeProcess request, rendering it if needed.
+
+        :raises: the exception of the request if the document cannot be rendered, e.g. for unknown processes
+        """
+        key = self.document_key(wps_request)
+        document = self.documents.get(key)
+        if document is None:
+            if key[0] == 'getcapabilities':
+                response = self.get_capabilities(wps_request, None)
+            else:
+                response = self.describe(wps_request, None, wps_request.identifiers)
+            # Rendered without get_response_doc, which records the request status in the database.
+            document = Document(response._construct_doc())
+            with self._lock:
+                if len(self.documents) >= MAX_DOCUMENTS:
+                    self.documents.clear()
+                self.documents[key] = document
+            LOGGER.debug('Rendered {} document'.format(key[0]))
+        return document
+
+    def prepare_process_for_execution(self, identifier):
+        process = super(Service, self).prepare_process_for_execution(identifier)
+        # The scheduler keeps asynchronous jobs in its queue while the free disk space is too low.
+        if self.scheduler is not None:
+            self.scheduler.attach(process)
+        else:
+            guard(process)
+        if self.profiler is not None:
+            self.profiler.attach(process)
+        if self.metrics is not None:
+            self.metrics.attach(process)
+        return process
+
+    def call(self, http_request):
+        if http_request.path.rstrip('/').endswith('/metrics'):
+            if self.metrics is None:
+                return Response('Metrics are disabled\n', status=404, content_type='text/plain')
+            return Response(self.metrics.render(), content_type=CONTENT_TYPE)
+
+        if self.scheduler is not None:
+            self.scheduler.watch(self)
+
+        wps_request = None
+        if _get_operation(http_request) in ('getcapabilities', 'describeprocess'):
+            try:
+                wps_request = WPSRequest(http_request)
+            except Exception:
+                # Invalid requests are reported by PyWPS.
+                pass
+
+        if wps_request is not None:
+            try:
+                return self.get_document(wps_request).response(http_request)
+            except Exception as e:
+                LOGGER.debug('Document not cached: {}'.format(e))
+        return super(Service, self).call(http_request)
+
+
+def _get_operation(http_request):
+    """Return the operation of a GET request in lower case, without parsing the request."""
+    if http_request.method != 'GET':
+        return None
+    for key, value in http_request.args.items():
+        if key.lower() == 'request':
+            return value.lower()
+    return None
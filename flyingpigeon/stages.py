@@ -0,0 +1,169 @@
+"""
+Timing of the stages of process executions.
+
+Handlers decorated with :func:`timed` time their stages with ``with self.timer.stage('fetch'):``. The stages
+used by the processes are:
+
+* `fetch`: download of the input files;
+* `extract`: extraction of input archives, or of the variables of the datasets;
+* `ocgis`: ocgis operations;
+* `compute`: computation of metrics, plots and time series;
+* `write`: writing of the output files;
+* `archive`: creation of the output archives.
+
+Stages may be nested, e.g. the extraction of archives while the time series of the extracted datasets are
+computed, in which case the enclosing stage includes the time of the nested ones. A stage nested in a stage of
+the same name is not counted again in the summary.
+
+The wall time, the CPU time of the process and of its terminated child processes, and the resident memory of
+each stage are logged as JSON records. If the `stage_trace` option is set, they are also written to a
+``trace.json`` file in the output directory of the job, in the Trace Event format read by chrome://tracing
+and Perfetto.
+"""
+import functools
+import json
+import logging
+import os
+import resource
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from pywps import configuration
+
+from flyingpigeon.metrics import peak_rss
+
+LOGGER = logging.getLogger("PYWPS")
+
+TRACE_FILENAME = 'trace.json'
+
+
+def current_rss():
+    """Return the resident set size of the current process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return peak_rss()
+
+
+def cpu_time():
+    """Return the CPU time used by the current process and its terminated child processes, in seconds."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class StageTimer(object):
+    """Wall time, CPU time and memory of the stages of a process execution.
+
+    :param identifier: identifier of the process
+    :param uuid: identifier of the request
+    """
+
+    def __init__(self, identifier, uuid=None):
+        self.identifier = identifier
+        self.uuid = uuid
+        self.records = []
+        self._open = Counter()
+        self._start = time.time()
+        self._cpu = cpu_time()
+
+    def _record(self, stage, start, wall, cpu, **attributes):
+        record = OrderedDict([
+            ('process', self.identifier),
+            ('uuid', str(self.uuid) if self.uuid is not None else None),
+            ('stage', stage),
+            ('start', round(start - self._start, 6)),
+            ('wall', round(wall, 6)),
+            ('cpu', round(cpu, 6)),
+            ('rss', current_rss()),
+            ('peak_rss', peak_rss()),
+        ])
+        record.update(attributes)
+        LOGGER.info(json.dumps(record))
+        return record
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        """Time the enclosed code as stage `name`.
+
+        :param attributes: values added to the record of the stage, e.g. the processed dataset
+        """
+        if self._open[name]:
+            attributes['nested'] = True
+        self._open[name] += 1
+        start, wall, cpu = time.time(), time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self._open[name] -= 1
+            self.records.append(self._record(name, start, time.perf_counter() - wall, cpu_time() - cpu,
+                                             **attributes))
+
+    def iterate(self, name, iterable, **attributes):
+        """Yield the items of an iterable, timing the production of each item as stage `name`, e.g. the
+        extraction of the files of the next dataset."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, **attributes):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        """Return the total wall and CPU time and the number of occurrences of each stage."""
+        summary = OrderedDict()
+        for record in self.records:
+            if record.get('nested'):
+                continue
+            total = summary.setdefault(record['stage'], OrderedDict([('wall', 0), ('cpu', 0), ('count', 0)]))
+            total['wall'] = round(total['wall'] + record['wall'], 6)
+            total['cpu'] = round(total['cpu'] + record['cpu'], 6)
+            total['count'] += 1
+        return summary
+
+    def trace(self):
+        """Return the stages as a Trace Event document."""
+        events = []
+        for record in self.records:
+            args = {key: value for key, value in record.items() if key not in ('process', 'uuid', 'stage',
+                                                                               'start', 'wall')}
+            events.append({'name': record['stage'], 'cat': 'stage', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                           'ts': int(record['start'] * 1e6), 'dur': int(record['wall'] * 1e6), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'process': self.identifier, 'uuid': str(self.uuid)}}
+
+    def write_trace(self, path):
+        """Write the trace of the stages to a file."""
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+        return path
+
+    def finish(self, status='succeeded'):
+        """Log the total of the execution, and write the trace file if the `stage_trace` option is set."""
+        self._record('total', self._start, time.time() - self._start, cpu_time() - self._cpu, status=status,
+                     stages=self.summary())
+        if configuration.get_config_value('extra', 'stage_trace') is True and self.uuid is not None:
+            try:
+                path = os.path.join(configuration.get_config_value('server', 'outputpath'), str(self.uuid))
+                os.makedirs(path, exist_ok=True)
+                LOGGER.info('Stage trace written to {}'.format(
+                    self.write_trace(os.path.join(path, TRACE_FILENAME))))
+            except (IOError, OSError) as e:
+                LOGGER.warning('Could not write the stage trace: {}'.format(e))
+
+
+def timed(handler):
+    """Decorate a process handler, whose stages are timed by the :class:`StageTimer` `self.timer`."""
+    @functools.wraps(handler)
+    def wrapper(self, request, response):
+        self.timer = StageTimer(self.identifier, self.uuid)
+        status = 'failed'
+        try:
+            response = handler(self, request, response)
+            status = 'succeeded'
+            return response
+        finally:
+            self.timer.finish(status)
+    return wrapper
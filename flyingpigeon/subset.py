@@ -1,10 +1,21 @@
+from functools import lru_cache
+import os
+
 from eggshell.nc.ocg_utils import call, get_variable
 from eggshell.nc.nc_utils import sort_by_filename
-from ocgis import env, ShpCabinetIterator, ShpCabinet
+import netCDF4 as nc
+import numpy as np
+from ocgis import env, ShpCabinetIterator, ShpCabinet, RequestDataset, OcgOperations
+from ocgis.crs import WGS84
+from shapely.ops import unary_union
 
 
 from eggshell.config import Paths
 import flyingpigeon as fp
+from flyingpigeon.grid import get_coordinates, get_grid_spacing, coordinates_extent, restrict_to_extent
+from flyingpigeon.grid import simplify_tolerance, selection_preserved, get_mask, array_fingerprint
+from flyingpigeon import regions
+from flyingpigeon.workdir import QuotaExceeded
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
@@ -12,6 +23,13 @@ paths = Paths(fp)
 
 env.DIR_SHPCABINET = paths.shapefiles
 
+# Whether the simplified geometries select the same cells, by grid, shapefile, geometry ids and tolerance.
+_preserved = {}
+MAX_PRESERVED = 4096
+
+# Simplification tolerance, as a fraction of the grid spacing.
+SIMPLIFY_FACTOR = 0.1
+
 
 def countries():
     """
@@ -77,7 +95,8 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
              calc_grouping=None, time_range=None, time_region=None,
              historical_concatination=True, prefix=None,
              spatial_wrapping='wrap', polygons=None, mosaic=False,
-             dir_output=None, memory_limit=None):
+             dir_output=None, memory_limit=None, simplify=False, mask_cache=False, callback=None,
+             spatial_operation='intersects'):
     """ returns list of clipped netCDF files
 
     :param resource: list of input netCDF files
@@ -94,6 +113,17 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
     :param dir_output: specify an output location
     :param time_range: [start, end] of time subset
     :param time_region: year, months or days to be extracted in the timeseries
+    :param simplify: Whether polygons are simplified according to the grid spacing of each dataset.
+                     Simplified polygons are only used if they select the same grid cells.
+    :param mask_cache: Whether the grid cells selected by the polygons are stored in a disk cache and
+                       reused for datasets on the same grid, instead of intersecting the polygons each time.
+                       Only used for plain netCDF subsets (no calculation).
+    :param callback: function called with the path of each clipped file as soon as it is written,
+                     e.g. :meth:`flyingpigeon.archives.TarWriter.add`.
+    :param spatial_operation: ocgis spatial operation, `intersects` or `clip`
+
+    Polygons are clipped to the grid extent of each dataset before the ocgis operation, and
+    datasets not intersecting any polygon are skipped.
 
     :returns list: path to clipped files
     """
@@ -108,6 +138,7 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
 
     geoms = set()
     ncs = sort_by_filename(resource, historical_concatination=historical_concatination)  # historical_concatenation=True
+    grids = {key: _get_grid(ncs[key]) for key in ncs.keys()}
     geom_files = []
     if mosaic is True:
         try:
@@ -120,6 +151,7 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
             else:
                 geom = geoms.pop()
             ugids = get_ugid(polygons=polygons, geom=geom)
+            shapes = [get_mosaic(geom, tuple(ugids))]
         except Exception as ex:
             LOGGER.exception('geom identification failed {}'.format(str(ex)))
         for i, key in enumerate(ncs.keys()):
@@ -131,14 +163,23 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
                     name = key + nameadd
                 else:
                     name = prefix[i]
-                geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                 output_format=output_format, prefix=name,
-                                 geom=geom, select_ugid=ugids, time_range=time_range,
-                                 time_region=time_region,
-                                 spatial_wrapping=spatial_wrapping, memory_limit=memory_limit,
-                                 dir_output=dir_output, dimension_map=dimension_map)
+                geom_file = _clip_dataset(ncs[key], variable, shapes, geom, ugids, grids[key], name,
+                                          simplify=simplify, mask_cache=mask_cache,
+                                          calc=calc, calc_grouping=calc_grouping,
+                                          output_format=output_format, time_range=time_range,
+                                          time_region=time_region,
+                                          spatial_wrapping=spatial_wrapping, memory_limit=memory_limit,
+                                          dir_output=dir_output, dimension_map=dimension_map,
+                                          spatial_operation=spatial_operation)
+                if geom_file is None:
+                    LOGGER.info('polygons do not intersect %s, skipped' % (key))
+                    continue
                 geom_files.append(geom_file)
+                if callback is not None:
+                    callback(geom_file)
                 LOGGER.info('ocgis mosaik clipping done for %s' % (key))
+            except QuotaExceeded:
+                raise
             except Exception as ex:
                 msg = 'ocgis mosaik clipping failed for %s, %s ' % (key, ex)
                 LOGGER.exception(msg)
@@ -147,6 +188,7 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
             try:
                 geom = get_geom(polygon)
                 ugid = get_ugid(polygons=polygon, geom=geom)
+                shapes = get_geometries(geom, ugid)
                 for key in ncs.keys():
                     try:
                         # if variable is None:
@@ -156,22 +198,179 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
                             name = key + '_' + polygon.replace(' ', '')
                         else:
                             name = prefix[i]
-                        geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                         output_format=output_format,
-                                         prefix=name, geom=geom, select_ugid=ugid, dir_output=dir_output,
-                                         dimension_map=dimension_map, spatial_wrapping=spatial_wrapping,
-                                         memory_limit=memory_limit, time_range=time_range, time_region=time_region,
-                                         )
+                        geom_file = _clip_dataset(ncs[key], variable, shapes, geom, ugid, grids[key], name,
+                                                  simplify=simplify, mask_cache=mask_cache,
+                                                  calc=calc, calc_grouping=calc_grouping,
+                                                  output_format=output_format, dir_output=dir_output,
+                                                  dimension_map=dimension_map, spatial_wrapping=spatial_wrapping,
+                                                  memory_limit=memory_limit, time_range=time_range,
+                                                  time_region=time_region, spatial_operation=spatial_operation,
+                                                  )
+                        if geom_file is None:
+                            LOGGER.info('%s does not intersect %s, skipped' % (polygon, key))
+                            continue
                         geom_files.append(geom_file)
+                        if callback is not None:
+                            callback(geom_file)
                         LOGGER.info('ocgis clipping done for %s' % (key))
+                    except QuotaExceeded:
+                        raise
                     except Exception as ex:
                         msg = 'ocgis clipping failed for %s: %s ' % (key, ex)
                         LOGGER.exception(msg)
+            except QuotaExceeded:
+                raise
             except Exception as ex:
                 LOGGER.exception('geom identification failed {}'.format(str(ex)))
     return geom_files
 
 
+def _get_grid(resource):
+    """Return the cell center coordinates and padded extent of a resource grid, or None if they cannot be read."""
+    try:
+        lon, lat = get_coordinates(resource)
+        return lon, lat, coordinates_extent(lon, lat)
+    except Exception as ex:
+        LOGGER.debug('grid of %s could not be read: %s' % (resource, ex))
+        return None
+
+
+def _clip_dataset(resource, variable, shapes, geom, ugids, grid, name, simplify=False, mask_cache=False,
+                  **kwargs):
+    """Return the dataset clipped by shapefile records, or None if they do not intersect it.
+
+    :param kwargs: arguments of the ocgis operation, see :func:`eggshell.nc.ocg_utils.call`
+    """
+    selection = _select_geometries(shapes, geom, grid, simplify)
+    if not selection:
+        return None
+
+    if mask_cache and grid is not None and kwargs.get('calc') is None and kwargs.get('output_format') == 'nc':
+        window, mask = get_mask(resource, [s['geom'] for s in shapes], kwargs.get('spatial_operation', 'intersects'),
+                                geom, sorted(ugids))
+        if window is None:
+            return None
+        path = subset_by_mask(resource, variable, window, mask > 0, prefix=name, grid=grid, **kwargs)
+        if path is not None:
+            return path
+
+    return call(resource=resource, variable=variable, prefix=name, geom=selection, **kwargs)
+
+
+def subset_by_mask(resource, variable, window, mask, prefix, grid=None, dir_output=None, time_range=None,
+                   time_region=None, spatial_wrapping='wrap', dimension_map=None, **kwargs):
+    """
+    returns the subset of a dataset selected by a precomputed grid cell mask, see :func:`flyingpigeon.grid.get_mask`.
+
+    The dataset is sliced to the window of the selected cells by ocgis, then cells outside of the mask
+    are masked in the output file, so no geometric operation is needed.
+
+    :param resource: netCDF file(s) of the dataset
+    :param variable: variable name(s)
+    :param window: (row start, row stop, column start, column stop) index bounds of the selected cells
+    :param mask: selected cells within the window
+    :param prefix: prefix for output file name
+    :param grid: cell center coordinates and extent of the dataset grid, see :func:`_get_grid`
+
+    :returns str: path to the netCDF file, or None if the mask cannot be applied
+    """
+    y0, y1, x0, x1 = window
+    if spatial_wrapping == 'wrap' and grid is not None and grid[0].ndim == 1:
+        lon = grid[0][x0:x1]
+        if lon.min() < 180 < lon.max():
+            # Wrapping the longitudes would reorder the columns of the window.
+            return None
+
+    rd = RequestDataset(resource, variable=variable, time_range=time_range, time_region=time_region,
+                        dimension_map=dimension_map)
+    ops = OcgOperations(dataset=rd, slice=[None, None, None, [y0, y1], [x0, x1]],
+                        spatial_wrapping=spatial_wrapping, output_format='nc',
+                        prefix=prefix, dir_output=dir_output)
+    path = ops.execute()
+
+    variables = variable if isinstance(variable, list) else [variable]
+    with nc.Dataset(path, 'a') as ds:
+        for name in variables:
+            var = ds.variables[name]
+            var[:] = np.ma.masked_where(np.broadcast_to(~mask, var.shape), var[:])
+    return path
+
+
+def aggregate_by_weights(resource, variable, window, weights, prefix, dir_output=None, **kwargs):
+    """
+    returns the average of a dataset over a region, weighted by precomputed cell weights, see
+    :func:`flyingpigeon.grid.get_mask`.
+
+    Like an ocgis clip operation with `aggregate=True`, cells are weighted by the fraction of their area within
+    the region, but the window of the selected cells is sliced by ocgis and averaged with numpy, without any
+    geometric operation. The horizontal dimensions of the output have a single cell, at the weighted center of
+    the selected cells.
+
+    :param resource: netCDF file(s) of the dataset
+    :param variable: variable name(s)
+    :param window: (row start, row stop, column start, column stop) index bounds of the selected cells
+    :param weights: weights of the cells within the window
+    :param prefix: prefix for output file name
+    :param kwargs: arguments of :func:`subset_by_mask`
+
+    :returns str: path to the netCDF file
+    """
+    kwargs['spatial_wrapping'] = None
+    window_path = subset_by_mask(resource, variable, window, weights > 0, prefix=prefix + '_window',
+                                 dir_output=dir_output, **kwargs)
+    path = os.path.join(os.path.dirname(window_path), prefix + '.nc')
+    variables = variable if isinstance(variable, list) else [variable]
+
+    with nc.Dataset(window_path) as src, nc.Dataset(path, 'w') as dst:
+        ydim, xdim = src.variables[variables[0]].dimensions[-2:]
+        bounds = set(getattr(var, 'bounds', None) for var in src.variables.values())
+        dst.setncatts(src.__dict__)
+        for name, dim in src.dimensions.items():
+            size = 1 if name in (ydim, xdim) else (None if dim.isunlimited() else len(dim))
+            dst.createDimension(name, size)
+        for name, var in src.variables.items():
+            spatial = ydim in var.dimensions or xdim in var.dimensions
+            if spatial and name in bounds:
+                # Bounds of the cells are meaningless once averaged.
+                continue
+            attrs = {key: value for key, value in var.__dict__.items() if key != '_FillValue'}
+            if spatial:
+                attrs.pop('bounds', None)
+            out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=getattr(var, '_FillValue', None))
+            out.setncatts(attrs)
+            values = var[:]
+            if spatial and np.issubdtype(var.dtype, np.number):
+                values = _weighted_mean(values, var.dimensions, ydim, xdim, weights)
+            out[:] = values
+    os.remove(window_path)
+    return path
+
+
+def _weighted_mean(values, dimensions, ydim, xdim, weights):
+    """Return the weighted mean of an array over its horizontal dimensions, keeping them with a size of 1."""
+    if ydim in dimensions and xdim in dimensions:
+        w = weights if dimensions.index(ydim) < dimensions.index(xdim) else weights.T
+    elif ydim in dimensions:
+        w = weights.sum(axis=1)
+    else:
+        w = weights.sum(axis=0)
+    axes = tuple(i for i, dim in enumerate(dimensions) if dim in (ydim, xdim))
+    shape = [values.shape[i] if i in axes else 1 for i in range(values.ndim)]
+    values = np.ma.masked_invalid(values)
+    w = np.ma.array(np.broadcast_to(w.reshape(shape), values.shape), mask=np.ma.getmaskarray(values))
+    return (values * w).sum(axis=axes, keepdims=True) / w.sum(axis=axes, keepdims=True)
+
+
+def _select_geometries(shapes, geom, grid, simplify=False):
+    """Return the geometries to clip a dataset with, restricted to its extent and optionally simplified."""
+    if grid is None:
+        return shapes
+    lon, lat, extent = grid
+    if simplify:
+        shapes = simplify_geometries(shapes, geom, lon, lat)
+    return restrict_to_extent(shapes, extent)
+
+
 def get_dimension_map(resource):
     """ returns the dimension map for a file, required for ocgis processing.
     file must have a DRS-conformant filename (see: utils.drs_filename())
@@ -283,6 +482,94 @@ def get_ugid(polygons=None, geom=None):
     return result
 
 
+def get_geometries(geom, ugids):
+    """
+    returns the shapefile records of the given geometry ids.
+
+    :param geom: name of the shapefile
+    :param ugids: list of geometry ids, see :func:`get_ugid`
+
+    :returns list: geometry dictionaries ('geom', 'properties', 'crs') as accepted by ocgis
+    """
+    crs = WGS84()
+    return [{'geom': row['geom'], 'properties': row['properties'], 'crs': crs}
+            for row in ShpCabinetIterator(geom, select_uid=ugids)]
+
+
+@lru_cache(maxsize=128)
+def get_mosaic(geom, ugids):
+    """
+    returns the union of shapefile records as a single geometry dictionary. Results are cached.
+
+    :param geom: name of the shapefile
+    :param ugids: tuple of geometry ids
+
+    :returns dict: geometry dictionary, whose `UGIDS` property lists the merged geometry ids
+    """
+    shapes = get_geometries(geom, list(ugids))
+    return {'geom': unary_union([shape['geom'] for shape in shapes]),
+            'properties': {'UGID': 1, 'UGIDS': ','.join(str(ugid) for ugid in ugids)},
+            'crs': WGS84()}
+
+
+def _shape_ugids(shape):
+    """Return the tuple of shapefile geometry ids a geometry dictionary was built from."""
+    ugids = shape['properties'].get('UGIDS', shape['properties']['UGID'])
+    return tuple(int(ugid) for ugid in str(ugids).split(','))
+
+
+@lru_cache(maxsize=512)
+def simplified_geometry(geom, ugids, tolerance):
+    """
+    returns the simplified geometry of shapefile records, merged if there are several. Results are cached.
+
+    :param geom: name of the shapefile
+    :param ugids: tuple of geometry ids
+    :param tolerance: simplification tolerance in degrees
+
+    :returns: shapely geometry
+    """
+    if len(ugids) > 1:
+        shape = get_mosaic(geom, ugids)
+    else:
+        [shape] = get_geometries(geom, list(ugids))
+    return shape['geom'].simplify(tolerance, preserve_topology=True)
+
+
+def simplify_geometries(shapes, geom, lon, lat):
+    """
+    returns shapefile records with geometries simplified to a tolerance derived from the grid spacing.
+    Records are left unchanged if the simplified geometry would not select the same grid cells. The verdicts
+    are remembered by grid, shapefile, geometry ids and tolerance.
+
+    :param shapes: geometry dictionaries, see :func:`get_geometries` and :func:`get_mosaic`
+    :param geom: name of the shapefile
+    :param lon: longitudes of the grid cell centers
+    :param lat: latitudes of the grid cell centers
+
+    :returns list: geometry dictionaries
+    """
+    tolerance = simplify_tolerance(get_grid_spacing(lon, lat), SIMPLIFY_FACTOR)
+    grid = array_fingerprint(lon, lat)
+    result = []
+    for shape in shapes:
+        ugids = _shape_ugids(shape)
+        simplified = simplified_geometry(geom, ugids, tolerance)
+        key = (grid, geom, ugids, tolerance)
+        preserved = _preserved.get(key)
+        if preserved is None:
+            preserved = selection_preserved(lon, lat, shape['geom'], simplified, tolerance)
+            if len(_preserved) >= MAX_PRESERVED:
+                _preserved.clear()
+            _preserved[key] = preserved
+        if preserved:
+            shape = dict(shape, geom=simplified)
+        else:
+            LOGGER.debug('simplification of UGID %s changes the grid cell selection' % (ugids, ))
+        result.append(shape)
+    return result
+
+
 def get_geom(polygon=None):
     """ returns the appropriate shapefile (geom) for a given polygon abbreviation
 
@@ -308,15 +595,15 @@ def get_geom(polygon=None):
 
 
 # === Available Polygons
-_CONTINENTS_ = get_shp_column_values(geom='continents', columnname='CONTINENT')
+_CONTINENTS_ = regions.continents()
 
 _COUNTRIES_ = {}
 # _COUNTRIES_Europe_ = {}
 
 # === populate polygon dictionaries
-ADM0_A3 = get_shp_column_values(geom='countries', columnname='ADM0_A3')
-NAMELONG = get_shp_column_values(geom='countries', columnname='NAME_LONG')
-CONTINENT = get_shp_column_values(geom='countries', columnname='CONTINENT')
+ADM0_A3 = regions.countries()
+NAMELONG = regions.column_values('countries', 'NAME_LONG')
+CONTINENT = regions.column_values('countries', 'CONTINENT')
 
 for c, key in enumerate(ADM0_A3):
     _COUNTRIES_[key] = dict(longname=NAMELONG[c])
@@ -0,0 +1,185 @@
+"""
+Lifecycle of the files of the process working directories.
+
+PyWPS creates a working directory for each job and only removes it when the job completes, so that the input
+copies, extracted archives and clipped files of a job use disk space until its end. Handlers decorated with
+:func:`managed` register the files they write in `self.files`:
+
+* intermediate files are removed as soon as they are consumed, or when the handler returns;
+* output files are kept until PyWPS copies them to the output directory;
+* each registration checks the disk quota of the job, given by the `workdir_quota` option.
+
+Jobs are not started while the free space of the working or output directories is below the `min_free_space`
+option: synchronous requests are refused, and asynchronous requests are kept in the queue of the job
+scheduler if it is enabled, or refused otherwise. Requests already stored in the PyWPS queue stay there until
+a job ends with enough free space.
+"""
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from pywps import configuration
+from pywps.app.exceptions import ProcessError
+from pywps.exceptions import ServerBusy
+
+from flyingpigeon import compat
+
+LOGGER = logging.getLogger("PYWPS")
+
+
+class QuotaExceeded(ProcessError):
+    """Raised when the files of a job exceed its disk quota."""
+
+
+def _get_size(option):
+    """Return the size in bytes given by an `[extra]` option, or None if it is not set."""
+    value = configuration.get_config_value('extra', option)
+    if not value:
+        return None
+    return int(configuration.get_size_mb(value) * 1024 ** 2)
+
+
+def disk_usage(path):
+    """Return the size in bytes of the files in a directory, not following symbolic links."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Workdir(object):
+    """Intermediate and output files of the working directory of a job.
+
+    :param path: working directory of the job
+    :param quota: maximum size of the files of the job in bytes, or None for no limit
+    """
+
+    def __init__(self, path, quota=None):
+        self.path = os.path.realpath(path)
+        self.quota = quota
+        self.intermediates = set()
+        self.outputs = set()
+        # Files may be consumed by other threads, e.g. the thread of a tar writer.
+        self._lock = threading.Lock()
+
+    def _inside(self, path):
+        """Return whether a file is in the working directory, and not e.g. a local input or an url."""
+        if not path or '://' in path:
+            return False
+        return os.path.realpath(path).startswith(self.path + os.sep)
+
+    def intermediate(self, *paths):
+        """Register files or directories removed once consumed. Files outside of the working directory are
+        ignored."""
+        with self._lock:
+            for path in paths:
+                if self._inside(path) and path not in self.outputs:
+                    self.intermediates.add(path)
+        self.check()
+
+    def output(self, *paths):
+        """Register output files, which are kept."""
+        with self._lock:
+            for path in paths:
+                self.outputs.add(path)
+                self.intermediates.discard(path)
+        self.check()
+
+    def consumed(self, *paths):
+        """Remove intermediate files or directories which are not needed anymore."""
+        for path in paths:
+            with self._lock:
+                if path not in self.intermediates:
+                    continue
+                self.intermediates.discard(path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                LOGGER.debug('Could not remove {}: {}'.format(path, e))
+
+    def mkdtemp(self, **kwargs):
+        """Create an intermediate directory in the working directory."""
+        path = tempfile.mkdtemp(dir=self.path, **kwargs)
+        self.intermediate(path)
+        return path
+
+    def usage(self):
+        return disk_usage(self.path)
+
+    def check(self):
+        """Raise :class:`QuotaExceeded` if the files of the job exceed its quota."""
+        if self.quota is None:
+            return
+        usage = self.usage()
+        if usage > self.quota:
+            raise QuotaExceeded('The job uses {:.0f} MB of disk space, more than its quota of {:.0f} MB.'.format(
+                usage / 1024. ** 2, self.quota / 1024. ** 2))
+
+    def cleanup(self):
+        """Remove the remaining intermediate files."""
+        self.consumed(*sorted(self.intermediates))
+
+
+def managed(handler):
+    """Decorate a process handler, whose files are registered in the :class:`Workdir` `self.files`."""
+    @functools.wraps(handler)
+    def wrapper(self, request, response):
+        self.files = Workdir(self.workdir, quota=_get_size('workdir_quota'))
+        try:
+            return handler(self, request, response)
+        finally:
+            self.files.cleanup()
+    return wrapper
+
+
+def guard(process):
+    """Refuse the executions of a process prepared for execution while the free disk space is too low.
+
+    Stored requests are not launched when the process ends while the free disk space is too low, like the
+    dispatch of the job scheduler.
+    """
+    def execute(async_, wps_request, wps_response):
+        check_free_space()
+        return execute_process(async_, wps_request, wps_response)
+
+    def launch_next():
+        if not has_free_space():
+            LOGGER.warning('Not enough free disk space, stored requests kept in the queue')
+            return
+        return launch_next_process()
+
+    execute_process = compat.override(process, '_execute_process', execute)
+    launch_next_process = compat.override(process, 'launch_next_process', launch_next)
+
+
+def has_free_space():
+    """Return whether the working and output directories have more free space than `min_free_space`."""
+    threshold = _get_size('min_free_space')
+    if threshold is None:
+        return True
+    for option in ('workdir', 'outputpath'):
+        path = configuration.get_config_value('server', option) or tempfile.gettempdir()
+        try:
+            free = shutil.disk_usage(path).free
+        except OSError:
+            continue
+        if free < threshold:
+            LOGGER.warning('Free space of {} is {:.0f} MB, below min_free_space'.format(path, free / 1024. ** 2))
+            return False
+    return True
+
+
+def check_free_space():
+    """Raise :class:`pywps.exceptions.ServerBusy` if the free disk space is too low to start a job."""
+    if not has_free_space():
+        raise ServerBusy('Not enough free disk space to start the process. Please try later.')
@@ -1,7 +1,9 @@
 import os
-from pywps.app.Service import Service
 
-from .processes import processes
+from pywps import configuration
+
+from .processes import enabled_processes, get_processes
+from .service import Service
 
 
 def create_app(cfgfiles=None):
@@ -10,7 +12,9 @@ def create_app(cfgfiles=None):
         config_files.extend(cfgfiles)
     if 'PYWPS_CFG' in os.environ:
         config_files.append(os.environ['PYWPS_CFG'])
-    service = Service(processes=processes, cfgfiles=config_files)
+    # The configuration selects the processes offered by the service.
+    configuration.load_configuration(config_files)
+    service = Service(processes=get_processes(enabled_processes()), cfgfiles=config_files)
     return service
 
 
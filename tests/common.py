@@ -1,7 +1,11 @@
 from pywps import get_ElementMakerForVersion
 from pywps.app.basic import get_xpath_ns
 from pywps.tests import WpsClient, WpsTestResponse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
 import os
+import threading
 
 VERSION = "1.0.0"
 WPS, OWS = get_ElementMakerForVersion(VERSION)
@@ -71,6 +75,11 @@ TESTDATA = {
         'testdata',
         'spatial_analog',
         'dissimilarity.nc')),
+    'stations_csv': "file://{0}".format(os.path.join(
+        TESTS_HOME,
+        'testdata',
+        'points',
+        'stations.csv')),
 }
 
 
@@ -108,3 +117,112 @@ def get_output(doc):
             output[identifier_el.text] = data_el[0].text
 
     return output
+
+
+# CMIP5 names of a historical run and of the scenario continuing it.
+HISTORICAL_PAIR = ['tasmax_Amon_MPI-ESM-MR_historical_r1i1p1_200001-200512.nc',
+                   'tasmax_Amon_MPI-ESM-MR_rcp45_r1i1p1_200601-200612.nc']
+
+
+def historical_archive(path):
+    """Write a tar archive of a historical and a scenario file, and return its path."""
+    import tarfile
+    with tarfile.open(path, 'w') as tf:
+        for name in HISTORICAL_PAIR:
+            tf.add(TESTDATA['cmip5_tasmax_2006_nc'][7:], arcname=name)
+    return path
+
+
+def fake_clipping(calls):
+    """Return a stand-in of :func:`flyingpigeon.subset.clipping` recording the files of each call."""
+    import shutil
+
+    def clipping(resource, dir_output, callback, **kwargs):
+        # Inputs are only removed once all datasets are clipped.
+        assert all(os.path.exists(path) for path in resource)
+        calls.append(sorted(os.path.basename(path) for path in resource))
+        out = os.path.join(dir_output, 'clipped_{}.nc'.format(len(calls)))
+        shutil.copy(resource[0], out)
+        callback(out)
+        return [out]
+    return clipping
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler of :class:`StandInServer`."""
+
+    def _answer(self, body=None):
+        self.server.requests.append((self.command, self.path, body))
+        status, headers, content = self.server.respond(self.command, self.path, body)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def do_HEAD(self):
+        self._answer()
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        self._answer(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(HTTPServer):
+    """Stand-in HTTP server, e.g. of a WFS or OPeNDAP service, running in a thread within a `with` block.
+
+    :param respond: function of the method, path and body of a request, returning the status, headers and body
+                    of the response
+    """
+
+    def __init__(self, respond):
+        super(StandInServer, self).__init__(('127.0.0.1', 0), StandInHandler)
+        self.respond = respond
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+        # (method, path, body) of the requests
+        self.requests = []
+
+    def paths(self, *methods):
+        """Return the paths of the requests, with one of the given methods if any."""
+        return [path for method, path, _ in self.requests if not methods or method in methods]
+
+    def queries(self):
+        """Return the parsed query strings of the requests."""
+        return [parse_qs(urlsplit(path).query) for _, path, _ in self.requests]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def feature_collection(geometries, ids=None):
+    """Return a GeoJSON feature collection in EPSG:4326 of GeoJSON polygons."""
+    points = [point for g in geometries for ring in g['coordinates'] for point in ring]
+    return {
+        'type': 'FeatureCollection',
+        'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:EPSG::4326'}},
+        'bbox': [min(p[0] for p in points), min(p[1] for p in points),
+                 max(p[0] for p in points), max(p[1] for p in points)],
+        'features': [{'type': 'Feature', 'id': ids[i] if ids else str(i), 'geometry': g, 'properties': {'id': i}}
+                     for i, g in enumerate(geometries)]}
+
+
+def wfs_respond(geometries):
+    """Return the `respond` function of a stand-in WFS server, answering GetFeature requests with a GeoJSON
+    feature collection of the polygons returned by `geometries(ids)` for the requested feature ids."""
+    def respond(method, path, body):
+        ids = parse_qs(urlsplit(path).query)['featureid'][0].split(',')
+        content = json.dumps(feature_collection(geometries(ids), ids)).encode()
+        return 200, {'Content-Type': 'application/json'}, content
+    return respond
@@ -0,0 +1,111 @@
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from flyingpigeon import archives
+from .common import TESTDATA
+
+
+def test_iter_extract(tmp_path):
+    nc = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    tar = str(tmp_path / 'input.tar.gz')
+    with tarfile.open(tar, 'w:gz') as tf:
+        tf.add(nc, arcname='a/tasmax.nc')
+        tf.add(nc, arcname='b/tasmax.nc')
+        tf.add(__file__, arcname='README')
+    zip_path = str(tmp_path / 'input.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.write(nc, arcname='pr.nc')
+
+    listed = archives.list_netcdf([tar, zip_path, nc], dir_output=str(tmp_path))
+    files = archives.extract_archive([tar, zip_path, nc], dir_output=str(tmp_path))
+    assert files == listed
+    # Members are written to a directory per archive, keeping their names.
+    assert files[:3] == [str(tmp_path / 'input_tar_gz' / 'a' / 'tasmax.nc'),
+                         str(tmp_path / 'input_tar_gz' / 'b' / 'tasmax.nc'),
+                         str(tmp_path / 'input_zip' / 'pr.nc')]
+    assert files[3] == os.path.realpath(nc)
+    for path in files[:3]:
+        assert os.path.getsize(path) == os.path.getsize(nc)
+    # Extracted archives of the working directory are removed.
+    assert not os.path.exists(tar) and not os.path.exists(zip_path)
+
+
+def test_iter_extract_first(tmp_path):
+    nc = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    tar = str(tmp_path / 'input.tar')
+    with tarfile.open(tar, 'w') as tf:
+        tf.add(nc, arcname='tasmax_2006.nc')
+        tf.add(nc, arcname='tasmax_2007.nc')
+
+    out = tmp_path / 'out'
+    out.mkdir()
+    first = next(archives.iter_extract(tar, dir_output=str(out)))
+    assert os.listdir(os.path.dirname(first)) == ['tasmax_2006.nc']
+    assert os.path.exists(tar)
+
+
+def test_dataset_stream(tmp_path):
+    nc = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    tar = str(tmp_path / 'input.tar')
+    with tarfile.open(tar, 'w') as tf:
+        for name in ('tas_A_2006.nc', 'pr_A_2006.nc', 'tas_A_2007.nc', '../pr_A_2007.nc'):
+            tf.add(nc, arcname=name)
+
+    datasets = archives.DatasetStream([tar], dir_output=str(tmp_path))
+    assert sorted(datasets.keys()) == ['pr_A', 'tas_A']
+    assert not os.path.exists(str(tmp_path / 'input_tar'))
+
+    # A dataset is returned as soon as all its files are extracted.
+    stream = iter(datasets)
+    key, files = next(stream)
+    assert key == 'tas_A'
+    assert [os.path.basename(path) for path in files] == ['tas_A_2006.nc', 'tas_A_2007.nc']
+    assert not os.path.exists(str(tmp_path / 'input_tar' / 'pr_A_2007.nc'))
+    key, files = next(stream)
+    assert key == 'pr_A' and all(os.path.exists(path) for path in files)
+    assert list(stream) == []
+
+
+def test_tar_writer(tmp_path):
+    with archives.TarWriter(dir_output=str(tmp_path)) as tar:
+        for i in range(3):
+            path = tmp_path / 'out_{}.nc'.format(i)
+            path.write_bytes(b'x' * 1000 * i)
+            tar.add(str(path))
+
+    with tarfile.open(tar.path) as tf:
+        assert tf.getnames() == ['out_0.nc', 'out_1.nc', 'out_2.nc']
+        assert tf.extractfile('out_2.nc').read() == b'x' * 2000
+
+
+def test_tar_writer_error(tmp_path):
+    tar = archives.TarWriter(dir_output=str(tmp_path), compress=True)
+    tar.add(str(tmp_path / 'missing.nc'))
+    with pytest.raises(IOError):
+        tar.close()
+
+
+def test_tar_writer_on_added(tmp_path):
+    added = []
+    tar = archives.TarWriter(dir_output=str(tmp_path), on_added=added.append)
+    tar.add(__file__)
+    tar.add(str(tmp_path / 'missing.nc'))
+    with pytest.raises(IOError):
+        tar.close()
+    assert added == [__file__]
+
+
+def test_tar_writer_on_added_error(tmp_path):
+    def on_added(path):
+        raise ValueError(path)
+
+    tar = archives.TarWriter(dir_output=str(tmp_path), on_added=on_added)
+    tar.add(__file__)
+    with pytest.raises(ValueError):
+        tar.close()
+    # The archive is complete up to the failure.
+    with tarfile.open(tar.path) as tf:
+        assert tf.getnames() == [os.path.basename(__file__)]
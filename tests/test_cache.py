@@ -0,0 +1,32 @@
+import os
+import time
+
+from flyingpigeon.cache import DiskCache, make_key
+
+
+def test_make_key():
+    assert make_key('countries', [1, 2]) == make_key('countries', [1, 2])
+    assert make_key('countries', [1, 2]) != make_key('countries', [1, 3])
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir), max_size=10)
+
+    def write(content):
+        return lambda path: open(path, 'w').write(content)
+
+    assert cache.get('a1') is None
+    path = cache.put('a1', write('12345'))
+    assert open(path).read() == '12345'
+    assert cache.get('a1') == path
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Least recently used entries are evicted first.
+    os.utime(path, (time.time() - 10, time.time() - 10))
+    path = cache.put('b2', write('12345'))
+    os.utime(path, (time.time() - 5, time.time() - 5))
+    cache.get('a1')
+    cache.put('c3', write('12345'))
+    assert cache.get('a1') is not None
+    assert cache.get('b2') is None
+    assert cache.get('c3') is not None
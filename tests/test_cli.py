@@ -0,0 +1,60 @@
+import signal
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from flyingpigeon import cli
+
+
+def test_gunicorn_options():
+    options = cli.gunicorn_options('0.0.0.0:8093', workers=8, threads=4, max_requests=1000)
+    assert options['worker_class'] == 'gthread'
+    assert options['preload_app']
+    assert options['max_requests_jitter'] == 100
+    assert 'pidfile' not in options
+
+    options = cli.gunicorn_options('0.0.0.0:8093', daemon=True)
+    assert options['worker_class'] == 'sync'
+    assert options['pidfile'] == cli.PID_FILE
+
+
+def test_start_help():
+    result = CliRunner().invoke(cli.cli, ['start', '--help'])
+    assert result.exit_code == 0
+    assert '--server [werkzeug|gunicorn]' in result.output
+
+
+def test_gunicorn_daemon(monkeypatch):
+    from gunicorn import util
+    from gunicorn.app.base import BaseApplication
+    calls = []
+    monkeypatch.setattr(util, 'daemonize', lambda *args: calls.append('daemonize'))
+    monkeypatch.setattr(BaseApplication, 'run', lambda self: calls.append('run'))
+
+    cli._run_production(lambda: None, daemon=True)
+    assert calls == ['daemonize', 'run']
+
+    calls.clear()
+    cli._run_production(lambda: None)
+    assert calls == ['run']
+
+
+def test_reload(tmp_path, monkeypatch):
+    pid_file = tmp_path / 'pywps.pid'
+    monkeypatch.setattr(cli, 'PID_FILE', str(pid_file))
+
+    # Not a gunicorn master: the signal would stop the server.
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    pid_file.write_text(str(proc.pid))
+    result = CliRunner().invoke(cli.cli, ['reload'])
+    assert 'not a gunicorn server' in result.output
+    assert proc.poll() is None
+    proc.kill()
+    proc.wait()
+
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', 'gunicorn'])
+    pid_file.write_text(str(proc.pid))
+    result = CliRunner().invoke(cli.cli, ['reload'])
+    assert 'status=reloading' in result.output
+    assert proc.wait(timeout=10) == -signal.SIGHUP
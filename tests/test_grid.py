@@ -0,0 +1,123 @@
+import numpy as np
+import shapely
+from shapely.geometry import box, Point, Polygon
+
+from flyingpigeon import grid
+from .common import TESTDATA
+
+
+def test_get_extent_rotated():
+    # EUR-44 domain, given on a rotated pole grid.
+    minx, miny, maxx, maxy = grid.get_extent(TESTDATA['cordex_tasmax_2006_nc'][7:])
+    assert -50 < minx < -40
+    assert 15 < miny < 25
+    assert 60 < maxx < 70
+    assert 70 < maxy < 75
+
+
+def test_bbox_intersects():
+    extent = grid.get_extent(TESTDATA['cordex_tasmax_2006_nc'][7:])
+    assert grid.bbox_intersects(extent, (0, 40, 10, 50))
+    assert not grid.bbox_intersects(extent, (-100, 40, -90, 50))
+
+    # Longitudes in [0, 360]
+    extent = grid.get_extent(TESTDATA['cmip5_tasmax_2006_nc'][7:])
+    assert grid.bbox_intersects(extent, (-100, 40, -90, 50))
+
+
+def test_restrict_to_extent():
+    extent = (0, 0, 10, 10)
+    geoms = [{'geom': box(5, 5, 20, 20)}, {'geom': box(2, 2, 3, 3)}, {'geom': box(30, 30, 40, 40)}]
+    out = grid.restrict_to_extent(geoms, extent)
+    assert len(out) == 2
+    assert out[0]['geom'].bounds == (5, 5, 10, 10)
+    assert out[1]['geom'] is geoms[1]['geom']
+
+    # Geometry given across the dateline
+    out = grid.restrict_to_extent([{'geom': box(-20, 0, -10, 5)}], (300, -10, 360, 10))
+    assert out[0]['geom'].bounds == (-20, 0, -10, 5)
+
+
+def test_cell_polygons():
+    lon, lat = grid.get_coordinates(TESTDATA['cmip5_tasmax_2006_nc'][7:])
+    cells = grid.cell_polygons(lon, lat)
+    assert cells.shape == (96, 192)
+    assert cells[0, 0].contains(Point(lon[0], lat[0]))
+
+    lon, lat = grid.get_coordinates(TESTDATA['cordex_tasmax_2006_nc'][7:])
+    cells = grid.cell_polygons(lon, lat)
+    assert cells.shape == lon.shape
+    assert cells[50, 50].contains(Point(lon[50, 50], lat[50, 50]))
+
+
+def test_selection_preserved():
+    lon, lat = np.arange(0.5, 10), np.arange(0.5, 10)
+    geom = Polygon([(2.2, 2.2), (7.8, 2.2), (7.8, 7.8), (5, 8.05), (2.2, 7.8)])
+    assert grid.selection_preserved(lon, lat, geom, geom.simplify(.1), .1)
+    # Dropping the vertex reaching into the next row of cells changes the selection.
+    assert not grid.selection_preserved(lon, lat, geom, geom.simplify(.3), .3)
+
+
+def test_get_mask():
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    geom = box(-10, 40, 10, 50)
+    window, mask = grid.get_mask(path, [geom], 'intersects', 'test_get_mask')
+    assert mask.shape == (window[1] - window[0], window[3] - window[2])
+    # The window spans the dateline of the [0, 360] grid.
+    assert window[2] == 0 and window[3] == 192
+    assert mask.sum() == 6 * 11
+
+    # Second call is read from the cache.
+    assert (grid.get_mask(path, [geom], 'intersects', 'test_get_mask')[1] == mask).all()
+
+    path = TESTDATA['cordex_tasmax_2006_nc'][7:]
+    assert grid.get_mask(path, [box(-100, 0, -99, 1)], 'intersects', 'test_get_mask_empty') == (None, None)
+
+
+def test_clip_weights():
+    x, y = np.meshgrid(np.arange(3.), np.arange(2.))
+    cells = shapely.box(x, y, x + 1, y + 1)
+    weights = grid.clip_weights(cells, [box(0.5, 0, 2, 1)])
+    assert np.allclose(weights, [[.5, 1, 0], [0, 0, 0]])
+    # Cells given by their center are selected entirely.
+    points = shapely.points(*np.meshgrid(np.arange(3.) + .5, np.arange(2.) + .5))
+    assert np.allclose(grid.clip_weights(points, [box(0.5, 0, 2, 1)]), [[1, 1, 0], [0, 0, 0]])
+
+
+def test_get_mask_clip():
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    geom = box(2.1, 45.1, 7.3, 49.2)
+    window, weights = grid.get_mask(path, [geom], 'clip', 'test_get_mask_clip')
+    _, mask = grid.get_mask(path, [geom], 'intersects', 'test_get_mask_clip')
+    assert weights.dtype == float and weights.shape == mask.shape
+    assert ((weights > 0) <= mask).all()
+    assert weights.max() <= 1 and (weights == 1).any() and ((weights > 0) & (weights < 1)).any()
+
+
+def test_coordinates_fingerprint_curvilinear(tmp_path):
+    import netCDF4 as nc
+
+    def write(path, lon):
+        with nc.Dataset(str(path), 'w') as ds:
+            ds.createDimension('y', lon.shape[0])
+            ds.createDimension('x', lon.shape[1])
+            ds.createVariable('lon', 'f8', ('y', 'x'))[:] = lon
+            ds.createVariable('lat', 'f8', ('y', 'x'))[:] = np.linspace(0, 60, lon.shape[0])[:, None]
+        return str(path)
+
+    lon = np.tile(np.linspace(0, 100, 200), (150, 1))
+    moved = lon.copy()
+    # A single cell between sampled rows and columns.
+    moved[75, 101] += 0.01
+    a, b = write(tmp_path / 'a.nc', lon), write(tmp_path / 'b.nc', moved)
+    assert grid.coordinates_fingerprint(a) != grid.coordinates_fingerprint(b)
+    assert grid.coordinates_fingerprint(a) == grid.coordinates_fingerprint(write(tmp_path / 'c.nc', lon))
+
+
+def test_grid_cells():
+    lon, lat = np.arange(0.5, 10), np.arange(0.5, 5)
+    cells, centers = grid.grid_cells(lon, lat)
+    assert cells.shape == centers.shape == (50,)
+    # Built once per grid.
+    assert grid.grid_cells(lon.copy(), lat.copy())[0] is cells
+    assert grid.grid_cells(lon + 1, lat)[0] is not cells
@@ -0,0 +1,143 @@
+import os
+import signal
+import sqlite3
+import subprocess
+import time
+
+import pytest
+from pywps import LiteralInput, LiteralOutput, Process, configuration
+from pywps.exceptions import ServerBusy
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from flyingpigeon.jobs import FAST, HEAVY, JobQueue, Scheduler
+from flyingpigeon.service import Service
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.sqlite'))
+
+
+def submit(queue, uuid, job_class=FAST, user='alice', **kwargs):
+    queue.submit(uuid, 'process', job_class, user, request='{}', **kwargs)
+
+
+def test_priorities(queue):
+    submit(queue, 'h1', HEAVY)
+    submit(queue, 'h2', HEAVY)
+    submit(queue, 'f1')
+    # Fast jobs first, and a single heavy job at a time.
+    assert [uuid for uuid, _ in queue.next_jobs(slots=4, heavy_slots=1)] == ['f1', 'h1']
+    assert queue.next_jobs(slots=4, heavy_slots=1) == []
+
+    queue.finish('h1')
+    assert [uuid for uuid, _ in queue.next_jobs(slots=4, heavy_slots=1)] == ['h2']
+
+
+def test_slots(queue):
+    for uuid in ('f1', 'f2', 'f3'):
+        submit(queue, uuid)
+    assert len(queue.next_jobs(slots=2, heavy_slots=1)) == 2
+    assert queue.next_jobs(slots=2, heavy_slots=1) == []
+    assert [job[4] for job in queue.jobs()] == ['running', 'running', 'queued']
+
+
+def test_fair_share(queue):
+    for uuid in ('a1', 'a2', 'a3'):
+        submit(queue, uuid, user='alice')
+    submit(queue, 'b1', user='bob')
+    assert [uuid for uuid, _ in queue.next_jobs(slots=1, heavy_slots=1)] == ['a1']
+    # Alice has a running job, so the job of Bob starts first.
+    assert [uuid for uuid, _ in queue.next_jobs(slots=3, heavy_slots=1)] == ['b1', 'a2']
+
+
+def test_queue_full(queue):
+    submit(queue, 'f1', max_queued=1)
+    with pytest.raises(ServerBusy):
+        submit(queue, 'f2', max_queued=1)
+
+
+def test_acquire(queue):
+    assert queue.acquire('h1', 'process', HEAVY, 'alice', slots=2, heavy_slots=1)
+    assert not queue.acquire('h2', 'process', HEAVY, 'alice', slots=2, heavy_slots=1)
+    assert queue.acquire('f1', 'process', FAST, 'alice', slots=2, heavy_slots=1)
+    assert not queue.acquire('f2', 'process', FAST, 'alice', slots=2, heavy_slots=1)
+    queue.finish('f1')
+    assert queue.acquire('f2', 'process', FAST, 'alice', slots=2, heavy_slots=1)
+
+
+def test_dead_jobs(queue):
+    submit(queue, 'f1')
+    submit(queue, 'f2')
+    assert len(queue.next_jobs(slots=1, heavy_slots=1)) == 1
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    queue.started('f1', proc.pid)
+    # The process of f1 ended without finishing the job, which releases its slot.
+    assert [uuid for uuid, _ in queue.next_jobs(slots=1, heavy_slots=1)] == ['f2']
+    assert [job[0] for job in queue.jobs()] == ['f2']
+
+
+def test_job_class(queue):
+    scheduler = Scheduler(queue, heavy_processes=['spatial_analog'])
+    assert scheduler.job_class('spatial_analog') == HEAVY
+    assert scheduler.job_class('subset_bbox') == FAST
+
+
+class Sleep(Process):
+    def __init__(self):
+        super(Sleep, self).__init__(
+            self._handler, identifier='sleep', title='Sleep',
+            inputs=[LiteralInput('delay', 'Delay', data_type='float')],
+            outputs=[LiteralOutput('output', 'Output', data_type='string')],
+            store_supported=True, status_supported=True)
+
+    @staticmethod
+    def _handler(request, response):
+        time.sleep(request.inputs['delay'][0].data)
+        response.outputs['output'].data = 'done'
+        return response
+
+
+def execute(client, delay):
+    resp = client.get('/wps?service=WPS&request=Execute&version=1.0.0&identifier=sleep&datainputs=delay={}'
+                      '&storeExecuteResponse=true&status=true'.format(delay))
+    assert resp.status_code == 200
+    return resp.get_data().decode('utf-8').split('statusLocation="')[1].split('"')[0].rsplit('/', 1)[-1]
+
+
+def wait(predicate, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_killed_job(tmp_path):
+    cfg = tmp_path / 'test.cfg'
+    cfg.write_text('[server]\nworkdir = {0}\noutputpath = {0}\nparallelprocesses = 1\n'
+                   '[logging]\ndatabase = sqlite:///{0}/logs.sqlite\n'
+                   '[extra]\njob_scheduler = true\njob_database = {0}/jobs.sqlite\ndispatch_interval = 0.2\n'
+                   .format(tmp_path))
+    service = Service(processes=[Sleep()], cfgfiles=[str(cfg)])
+    try:
+        client = Client(service, BaseResponse)
+        killed = execute(client, 60)
+        queued = execute(client, 0)
+        assert [job[4] for job in service.scheduler.queue.jobs()] == ['running', 'queued']
+
+        def pid():
+            with sqlite3.connect(str(tmp_path / 'jobs.sqlite')) as db:
+                return db.execute('SELECT pid FROM jobs WHERE uuid = ?', (killed.split('.')[0],)).fetchone()[0]
+        assert wait(pid)
+        os.kill(pid(), signal.SIGKILL)
+
+        # Restarted by the periodic dispatch, without any other request.
+        assert wait(lambda: service.scheduler.queue.jobs() == [])
+        assert wait(lambda: 'ProcessSucceeded' in (tmp_path / queued).read_text())
+    finally:
+        service.scheduler.stop()
+        configuration.load_configuration()
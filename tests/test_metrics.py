@@ -0,0 +1,79 @@
+import threading
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from flyingpigeon.cache import DiskCache
+from flyingpigeon.metrics import Execution, MetricsStore
+from flyingpigeon.parallel import parallel_map
+from flyingpigeon.processes.wps_say_hello import SayHello
+from flyingpigeon.service import Service
+
+
+def test_render(tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics.sqlite'))
+    store.record('subset_bbox', 'succeeded', queue_wait=0.2, duration=3, bytes_read=100, bytes_written=10,
+                 cache={('inputs', 'hits'): 2}, peak_rss=2048)
+    store.record('subset_bbox', 'failed', duration=40, bytes_read=50, peak_rss=1024)
+
+    text = store.render()
+    assert '# TYPE flyingpigeon_execution_seconds histogram' in text
+    assert 'flyingpigeon_requests_total{process="subset_bbox",status="succeeded"} 1' in text
+    assert 'flyingpigeon_requests_total{process="subset_bbox",status="failed"} 1' in text
+    assert 'flyingpigeon_execution_seconds_bucket{process="subset_bbox",le="5"} 1' in text
+    assert 'flyingpigeon_execution_seconds_bucket{process="subset_bbox",le="+Inf"} 2' in text
+    assert 'flyingpigeon_execution_seconds_sum{process="subset_bbox"} 43' in text
+    assert 'flyingpigeon_queue_wait_seconds_count{process="subset_bbox"} 1' in text
+    assert 'flyingpigeon_read_bytes_total{process="subset_bbox"} 150' in text
+    assert 'flyingpigeon_cache_hits_total{process="subset_bbox",cache="inputs"} 2' in text
+    assert 'flyingpigeon_peak_rss_bytes{process="subset_bbox"} 2048' in text
+
+
+def test_execution_cache(tmp_path):
+    cache = DiskCache(str(tmp_path / 'inputs'))
+    execution = Execution()
+    cache.get('abc')
+    cache.put('abc', lambda path: open(path, 'w').write('x'))
+    cache.get('abc')
+    measures = execution.stop()
+    assert measures['cache'] == {('inputs', 'hits'): 1, ('inputs', 'misses'): 1}
+    assert measures['peak_rss'] > 0
+
+
+def test_metrics_endpoint(tmp_path):
+    cfg = tmp_path / 'test.cfg'
+    cfg.write_text('[extra]\nmetrics_database = {}\n'.format(tmp_path / 'metrics.sqlite'))
+    client = Client(Service(processes=[SayHello()], cfgfiles=[str(cfg)]), BaseResponse)
+
+    resp = client.get('/wps?service=WPS&request=Execute&version=1.0.0&identifier=hello&datainputs=name=LovelySugarDove')
+    assert resp.status_code == 200
+    assert b'LovelySugarDove' in resp.get_data()
+
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = resp.get_data(as_text=True)
+    assert 'flyingpigeon_requests_total{process="hello",status="succeeded"} 1' in text
+    assert 'flyingpigeon_queue_wait_seconds_count{process="hello"} 1' in text
+
+
+def write(path):
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000000)
+
+
+def test_execution_io(tmp_path):
+    execution = Execution(own_process=True)
+    thread = threading.Thread(target=write, args=(str(tmp_path / 'thread.bin'),))
+    thread.start()
+    thread.join()
+    list(parallel_map(write, [(str(tmp_path / 'worker{}.bin'.format(i)),) for i in range(2)], workers=2))
+    # Bytes of the threads and of the worker processes
+    assert execution.stop()['bytes_written'] >= 3000000
+
+    execution = Execution()
+    thread = threading.Thread(target=write, args=(str(tmp_path / 'thread.bin'),))
+    thread.start()
+    thread.join()
+    # Bytes of the current thread only
+    assert execution.stop()['bytes_written'] < 1000000
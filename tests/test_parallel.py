@@ -0,0 +1,57 @@
+import os
+
+from flyingpigeon.cache import STATISTICS, DiskCache
+from flyingpigeon.parallel import parallel_map
+
+
+def square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x, os.getpid()
+
+
+def test_parallel_map():
+    results = sorted(parallel_map(square, [(i,) for i in range(8)] + [(-1,)], workers=3))
+    assert [r[0] for _, r, _ in results[:8]] == [i * i for i in range(8)]
+    assert all(r[1] != os.getpid() for _, r, _ in results[:8])
+    assert isinstance(results[8][2], ValueError)
+
+
+def test_parallel_map_serial():
+    results = list(parallel_map(square, [(2,), (3,)], workers=1))
+    assert [(i, r[0]) for i, r, _ in results] == [(0, 4), (1, 9)]
+    assert results[0][1][1] == os.getpid()
+
+
+def test_parallel_map_iterator():
+    produced = []
+
+    def tasks():
+        for i in range(6):
+            produced.append(i)
+            yield (i,)
+
+    results = parallel_map(square, tasks(), workers=2, count=6)
+    # The first task is submitted before returning, the others while the results are read.
+    assert produced == [0]
+    assert sorted(i for i, _, _ in results) == list(range(6))
+    assert produced == list(range(6))
+
+
+def lookup(path, key):
+    if DiskCache(path).get(key) is None:
+        raise KeyError(key)
+    return key
+
+
+def test_parallel_map_cache_statistics(tmp_path):
+    cache = DiskCache(str(tmp_path / 'entries'))
+    cache.put('abc', lambda path: open(path, 'w').write('x'))
+    before = STATISTICS.copy()
+    results = list(parallel_map(lookup, [(cache.path, 'abc'), (cache.path, 'abc'), (cache.path, 'def')], workers=2))
+    assert sorted(r for _, r, _ in results if r) == ['abc', 'abc']
+    # Statistics of the worker processes, including the failed lookup.
+    STATISTICS.subtract(before)
+    assert STATISTICS['entries', 'hits'] == 2
+    assert STATISTICS['entries', 'misses'] == 1
+    STATISTICS.update(before)
@@ -0,0 +1,188 @@
+import datetime
+import gzip
+import json
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+from flyingpigeon import grid
+from flyingpigeon import points
+from .common import TESTDATA
+
+
+def test_nearest_cells_regular():
+    lon, lat = grid.get_coordinates(TESTDATA['cmip5_tasmax_2006_nc'][7:])
+    # Longitudes of the grid are in [0, 360].
+    rows, cols, inside = points.nearest_cells(lon, lat, [(2.356138, 48.846450), (-0.5, 0), (-70, -30)])
+    assert lon[cols].tolist() == [1.875, 0., 290.625]
+    assert (np.abs(lat[rows] - [48.85, 0, -30]) < 1).all()
+    assert inside.all()
+
+
+def test_nearest_cells_rotated():
+    lon, lat = grid.get_coordinates(TESTDATA['cordex_tasmax_2006_nc'][7:])
+    pts = np.array([(2.35, 48.8), (20, 60), (140, -30)])
+    rows, cols, inside = points.nearest_cells(lon, lat, pts)
+    assert inside.tolist() == [True, True, False]
+
+    # Same cells as an exhaustive search
+    for (x, y), r, c in zip(pts[:2], rows, cols):
+        dist = np.hypot((lon - x) * np.cos(np.radians(y)), lat - y)
+        assert (r, c) == np.unravel_index(np.argmin(dist), lon.shape)
+
+
+def test_extract():
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    pts = [(2.356138, 48.846450), (100, 10), (180, -45)]
+    values, columns = points.extract([path], pts)
+    assert values.shape == (12, 3)
+    assert [c.tolist() for c in columns] == [[0], [1], [2]]
+
+    lon, lat = grid.get_coordinates(path)
+    rows, cols, _ = points.nearest_cells(lon, lat, pts)
+    with nc.Dataset(path) as ds:
+        for i, (r, c) in enumerate(zip(rows, cols)):
+            np.testing.assert_array_equal(values[:, i], ds.variables['tasmax'][:, r, c])
+
+
+def test_extract_outside():
+    path = TESTDATA['cordex_tasmax_2006_nc'][7:]
+    values, _ = points.extract(path, [(2.35, 48.8), (140, -30)])
+    assert np.isfinite(values[:, 0]).all()
+    assert np.isnan(values[:, 1]).all()
+
+
+def test_extract_tiles(monkeypatch):
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    rng = np.random.RandomState(0)
+    pts = np.column_stack([rng.uniform(-180, 180, 200), rng.uniform(-90, 90, 200)])
+    monkeypatch.setattr(points, 'MAX_WINDOW_RATIO', 1000)
+    values, _ = points.extract(path, pts)
+
+    # Scattered cells read by tiles give the same values.
+    monkeypatch.setattr(points, 'TILE_SIZE', 8)
+    monkeypatch.setattr(points, 'MAX_WINDOW_RATIO', 1)
+    tiled, _ = points.extract(path, pts)
+    np.testing.assert_array_equal(values, tiled)
+
+
+def test_extract_deduplicate():
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    pts = [(2.3, 48.8), (100, 10), (2.4, 48.9), (140, -89.9)]
+    values, columns = points.extract(path, pts, deduplicate=True)
+    assert values.shape == (12, 3)
+    assert sorted(c.tolist() for c in columns) == [[0, 2], [1], [3]]
+
+
+def test_read_points(tmp_path):
+    path = tmp_path / 'stations.csv'
+    path.write_text('station;latitude;longitude\nParis;48.85;2.35\nOslo;59.91;10.75\n')
+    pts, labels = points.read_points(str(path))
+    assert pts.tolist() == [[2.35, 48.85], [10.75, 59.91]]
+    assert labels == ['Paris', 'Oslo']
+
+    path.write_text('2.35,48.85\n10.75,59.91\n')
+    pts, labels = points.read_points(str(path))
+    assert pts.shape == (2, 2)
+    assert labels is None
+
+    path = tmp_path / 'stations.geojson'
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': 'paris', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85]},
+         'properties': {}}]}))
+    pts, labels = points.read_points(str(path))
+    assert pts.tolist() == [[2.35, 48.85]]
+    assert labels == ['paris']
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'csv.gz', 'netcdf', 'parquet', 'feather'])
+def test_write_timeseries(tmp_path, output_format):
+    if output_format in ('parquet', 'feather'):
+        pytest.importorskip('pyarrow')
+    path = TESTDATA['cmip5_tasmax_2006_nc'][7:]
+    pts = np.array([(2.35, 48.85), (10.75, 59.91)])
+    values, _ = points.extract(path, pts)
+    times = [datetime.datetime(2006, month, 16) for month in range(1, 13)]
+
+    out = points.write_timeseries(str(tmp_path / 'tasmax'), times, values, ['Paris', 'Oslo'], pts,
+                                  output_format, **points.describe(path))
+    assert out.endswith(points.OUTPUT_FORMATS[output_format])
+
+    if output_format == 'netcdf':
+        with nc.Dataset(out) as ds:
+            assert ds.featureType == 'timeSeries'
+            assert ds.variables['station_name'][:].tolist() == ['Paris', 'Oslo']
+            assert ds.variables['tasmax'].units == 'K'
+            np.testing.assert_allclose(ds.variables['tasmax'][:], values.T)
+    elif output_format.startswith('csv'):
+        with (gzip.open(out, 'rt') if output_format == 'csv.gz' else open(out)) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == '# date_time,Paris,Oslo'
+        assert len(lines) == 13
+        assert lines[1].startswith('2006-01-16 00:00:00,')
+        np.testing.assert_allclose([float(v) for v in lines[1].split(',')[1:]], values[0])
+    else:
+        import pandas as pd
+        table = pd.read_parquet(out) if output_format == 'parquet' else pd.read_feather(out)
+        assert list(table.columns) == ['date_time', 'Paris', 'Oslo']
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_write_table_360_day(tmp_path, output_format):
+    pytest.importorskip('pyarrow')
+    import cftime
+    import pandas as pd
+    times = [cftime.Datetime360Day(2006, 2, day) for day in (29, 30)]
+    values = np.array([[1., 2.], [3., 4.]])
+
+    out = points.write_timeseries(str(tmp_path / 'tasmax'), times, values, ['Paris', 'Oslo'], np.zeros((2, 2)),
+                                  output_format, calendar='360_day')
+    table = pd.read_parquet(out) if output_format == 'parquet' else pd.read_feather(out)
+    assert table['date_time'].tolist() == ['2006-02-29 00:00:00', '2006-02-30 00:00:00']
+    np.testing.assert_array_equal(table[['Paris', 'Oslo']].values, values)
+
+
+@pytest.mark.parametrize('name,other', [('cmip5_tasmax_2006_nc', 'cmip5_tasmax_2007_nc'),
+                                        ('cordex_tasmax_2006_nc', 'cordex_tasmax_2007_nc')])
+def test_grid_index_cache(tmp_path, monkeypatch, name, other):
+    from collections import OrderedDict
+    from scipy.spatial import cKDTree
+    from flyingpigeon.cache import DiskCache
+    cache = DiskCache(str(tmp_path))
+    monkeypatch.setattr(points, 'get_disk_cache', lambda *args: cache)
+    monkeypatch.setattr(points, '_indexes', OrderedDict())
+
+    path = TESTDATA[name][7:]
+    assert grid.coordinates_fingerprint(path) == grid.coordinates_fingerprint(TESTDATA[other][7:])
+    assert grid.coordinates_fingerprint(TESTDATA['cmip5_tasmax_2006_nc'][7:]) != \
+        grid.coordinates_fingerprint(TESTDATA['cordex_tasmax_2006_nc'][7:])
+
+    index = points.get_grid_index(path)
+    assert cache.misses == 1 and len(cache.entries()) == 1
+    # Entries are plain arrays.
+    with np.load(cache.filename(grid.coordinates_fingerprint(path), '.npz'), allow_pickle=False) as data:
+        np.testing.assert_array_equal(data['lon'], index.lon)
+
+    # Lookups are kept in memory, then read from the disk cache without building the KD-tree again.
+    assert points.get_grid_index(path) is index
+    points._indexes.clear()
+    built = []
+
+    class KDTree(cKDTree):
+        def __init__(self, data, **kwargs):
+            built.append(len(data))
+            super(KDTree, self).__init__(data, **kwargs)
+
+    monkeypatch.setattr('scipy.spatial.cKDTree', KDTree)
+    monkeypatch.setattr(points, 'get_coordinates', None)
+    cached = points.get_grid_index(path)
+    assert cache.hits == 1
+    # Only the trees of the axes of regular grids are built.
+    assert len(built) == (2 if index.lon.ndim == 1 else 0)
+
+    pts = [(2.356138, 48.846450), (10, 50), (-70, -30)]
+    expected = points.nearest_cells(*grid.get_coordinates(path), pts)
+    for result in (index.query(pts), cached.query(pts)):
+        assert all((a == b).all() for a, b in zip(result, expected))
+    assert points.nearest_cell(path, 2.356138, 48.846450) == (int(expected[0][0]), int(expected[1][0]))
@@ -0,0 +1,50 @@
+import glob
+import os
+import pstats
+import time
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from flyingpigeon.processes.wps_say_hello import SayHello
+from flyingpigeon.profiling import PROFILE_FILENAME, STACKS_FILENAME, StackSampler
+from flyingpigeon.service import Service
+
+EXECUTE = '/wps?service=WPS&request=Execute&version=1.0.0&identifier=hello&datainputs=name=LovelySugarDove'
+
+
+def busy():
+    end = time.time() + 0.1
+    while time.time() < end:
+        pass
+
+
+def test_stack_sampler(tmp_path):
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    busy()
+    sampler.stop()
+    assert any('busy (' in stack.split(';')[-1] for stack in sampler.stacks)
+
+    lines = open(sampler.write(str(tmp_path / 'stacks'))).read().splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == sum(sampler.stacks.values())
+
+
+def test_profiled_request(tmp_path):
+    outputs = tmp_path / 'outputs'
+    cfg = tmp_path / 'test.cfg'
+    cfg.write_text('[server]\nworkdir = {}\noutputpath = {}\n[extra]\nprofiling = true\nprofiling_token = secret\n'
+                   .format(tmp_path, outputs))
+    client = Client(Service(processes=[SayHello()], cfgfiles=[str(cfg)]), BaseResponse)
+
+    assert client.get(EXECUTE).status_code == 200
+    assert client.get(EXECUTE, headers={'X-Flyingpigeon-Profile': 'wrong'}).status_code == 200
+    assert glob.glob(str(outputs / '*' / PROFILE_FILENAME)) == []
+
+    resp = client.get(EXECUTE, headers={'X-Flyingpigeon-Profile': 'secret'})
+    assert resp.status_code == 200
+    assert b'LovelySugarDove' in resp.get_data()
+    profiles = glob.glob(str(outputs / '*' / PROFILE_FILENAME))
+    assert len(profiles) == 1
+    assert pstats.Stats(profiles[0]).total_calls > 0
+    assert os.path.exists(os.path.join(os.path.dirname(profiles[0]), STACKS_FILENAME))
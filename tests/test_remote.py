@@ -0,0 +1,103 @@
+import os
+
+import pytest
+from pywps import ComplexInput, FORMATS
+
+from flyingpigeon import remote
+from flyingpigeon.cache import DiskCache
+
+from .common import StandInServer
+
+
+def respond(method, path, body):
+    """Answer like a server where only paths under /dodsC are OPeNDAP endpoints, echoing the body of POST
+    requests."""
+    if method == 'POST':
+        return 200, {'ETag': '"post"'}, body
+    if path.startswith('/dodsC/'):
+        content = b'Dataset {\n    Float32 tas[time = 12];\n} tas.nc;\n'
+    elif path.startswith('/fileServer/'):
+        content = path.encode() * 1000
+    else:
+        content = b'<html>Not found</html>'
+    return 200, {'ETag': '"{}"'.format(hash(path))}, content
+
+
+@pytest.fixture
+def server():
+    remote._opendap.clear()
+    with StandInServer(respond) as server:
+        yield server
+
+
+def test_probe_opendap(server):
+    urls = [server.url + '/dodsC/tas.nc', server.url + '/fileServer/tas.nc', 'file:///tmp/tas.nc', None]
+    assert remote.probe_opendap(urls) == [True, False, False, False]
+    assert sorted(server.paths('GET')) == ['/dodsC/tas.nc.dds', '/fileServer/tas.nc.dds']
+
+    # Verdicts are remembered.
+    assert remote.probe_opendap(urls[:2]) == [True, False]
+    assert len(server.paths('GET')) == 2
+
+
+def test_probe_unreachable():
+    remote._opendap.clear()
+    assert remote.probe_opendap(['http://127.0.0.1:1/dodsC/tas.nc']) == [False]
+    assert not remote._opendap
+
+
+def test_prefetch(server, tmp_path):
+    inputs = []
+    for path in ['/fileServer/a/tas.nc', '/fileServer/b/tas.nc', '/fileServer/pr.nc']:
+        inpt = ComplexInput('resource', 'Resource', supported_formats=[FORMATS.NETCDF], max_occurs=10)
+        inpt.workdir = str(tmp_path)
+        inpt.url = server.url + path
+        inputs.append(inpt)
+    local = ComplexInput('resource', 'Resource', supported_formats=[FORMATS.NETCDF])
+    local.file = str(tmp_path / 'local.nc')
+
+    files = remote.prefetch(inputs + [local])
+    assert len(server.paths('GET')) == 3
+    # Files with the same name are not overwritten.
+    assert [os.path.basename(path) for path in files] == ['tas.nc', 'tas_1.nc', 'pr.nc', 'local.nc']
+    for inpt, path in zip(inputs, files):
+        with open(path, 'rb') as f:
+            assert f.read() == inpt.url[len(server.url):].encode() * 1000
+
+
+def test_input_cache(server, tmp_path, monkeypatch):
+    cache = DiskCache(str(tmp_path / 'inputs'))
+    monkeypatch.setattr(remote, 'get_input_cache', lambda: cache)
+
+    files = []
+    for workdir in ['job1', 'job2']:
+        (tmp_path / workdir).mkdir()
+        inpt = ComplexInput('resource', 'Resource', supported_formats=[FORMATS.NETCDF])
+        inpt.workdir = str(tmp_path / workdir)
+        inpt.url = server.url + '/fileServer/tas.nc'
+        files.extend(remote.prefetch([inpt]))
+
+    # The second job links the file downloaded by the first one.
+    assert server.paths('GET', 'POST') == ['/fileServer/tas.nc']
+    assert cache.hits == 1
+    assert os.stat(files[0]).st_ino == os.stat(files[1]).st_ino
+    # Linked files are read-only, so that they are not modified in place.
+    assert os.stat(files[0]).st_mode & 0o777 == remote.READ_ONLY
+
+
+def test_prefetch_post(server, tmp_path, monkeypatch):
+    cache = DiskCache(str(tmp_path / 'inputs'))
+    monkeypatch.setattr(remote, 'get_input_cache', lambda: cache)
+
+    files = []
+    for body in ['<subset>a</subset>', '<subset>b</subset>']:
+        inpt = ComplexInput('resource', 'Resource', supported_formats=[FORMATS.NETCDF])
+        inpt.workdir = str(tmp_path)
+        inpt.process({'identifier': 'resource', 'href': server.url + '/wcs/tas.nc', 'method': 'POST', 'body': body})
+        files.extend(remote.prefetch([inpt]))
+        with open(files[-1]) as f:
+            assert f.read() == body
+
+    # Responses to POST requests are not cached.
+    assert server.paths('GET', 'POST') == ['/wcs/tas.nc', '/wcs/tas.nc']
+    assert not cache.entries()
@@ -0,0 +1,47 @@
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from flyingpigeon.processes import get_processes
+from flyingpigeon.service import Service
+
+CAPS = '/wps?service=WPS&request=GetCapabilities&version=1.0.0'
+
+
+def test_cached_documents():
+    service = Service(processes=get_processes())
+    # Documents prebuilt when the service is created
+    assert len(service.documents) == 2
+
+    client = Client(service, BaseResponse)
+    resp = client.get(CAPS)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    assert b'subset_countries' in resp.get_data()
+    assert len(service.documents) == 2
+
+    resp = client.get(CAPS, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == b''
+
+    resp = client.get('/wps?service=WPS&request=describeprocess&version=1.0.0&identifier=subset_bbox')
+    assert resp.status_code == 200
+    assert b'subset_bbox' in resp.get_data()
+    assert len(service.documents) == 3
+
+
+def test_uncached_errors():
+    client = Client(Service(processes=get_processes()), BaseResponse)
+    resp = client.get('/wps?service=WPS&request=DescribeProcess&version=1.0.0&identifier=unknown')
+    assert resp.status_code == 400
+    assert b'ExceptionReport' in resp.get_data()
+
+
+def test_unsupported_pywps(monkeypatch):
+    from pywps.app.Process import Process
+    monkeypatch.delattr(Process, '_run_async')
+    monkeypatch.setattr(Process, 'launch_next_process', lambda self, service: None)
+    with pytest.raises(RuntimeError) as exc:
+        Service(processes=get_processes())
+    assert 'Process._run_async is missing' in str(exc.value)
+    assert 'Process.launch_next_process takes (self, service) instead of (self)' in str(exc.value)
@@ -0,0 +1,76 @@
+import json
+import logging
+import time
+
+from pywps import configuration
+
+from flyingpigeon.stages import StageTimer, timed, TRACE_FILENAME
+
+
+def test_stage_timer(caplog):
+    timer = StageTimer('subset_bbox', 'abc')
+    with caplog.at_level(logging.INFO, logger='PYWPS'):
+        with timer.stage('fetch'):
+            time.sleep(0.01)
+        with timer.stage('ocgis', dataset='a.nc'):
+            sum(range(100000))
+        with timer.stage('ocgis', dataset='b.nc'):
+            pass
+
+    assert [r['stage'] for r in timer.records] == ['fetch', 'ocgis', 'ocgis']
+    assert timer.records[0]['wall'] >= 0.01
+    assert timer.records[1]['dataset'] == 'a.nc'
+    assert timer.records[1]['rss'] > 0
+
+    # Records are logged as JSON.
+    logged = [json.loads(r.getMessage()) for r in caplog.records]
+    assert logged[1]['stage'] == 'ocgis'
+    assert logged[1]['uuid'] == 'abc'
+
+    summary = timer.summary()
+    assert list(summary) == ['fetch', 'ocgis']
+    assert summary['ocgis']['count'] == 2
+
+    events = timer.trace()['traceEvents']
+    assert events[0]['ph'] == 'X'
+    assert events[0]['dur'] >= 10000
+
+
+def test_nested_stages():
+    timer = StageTimer('pointinspection')
+    with timer.stage('compute'):
+        list(timer.iterate('extract', range(2)))
+        with timer.stage('compute'):
+            time.sleep(0.01)
+
+    summary = timer.summary()
+    assert summary['extract']['count'] == 3
+    # The nested compute stage is included in the enclosing one.
+    assert summary['compute']['count'] == 1
+    assert summary['compute']['wall'] == timer.records[-1]['wall']
+    assert timer.records[-2]['nested'] is True
+
+
+class Process(object):
+    identifier = 'test'
+    uuid = 'abc'
+
+    @timed
+    def _handler(self, request, response):
+        with self.timer.stage('compute'):
+            return response
+
+
+def test_timed(tmp_path):
+    cfg = tmp_path / 'test.cfg'
+    cfg.write_text('[server]\noutputpath = {}\n[extra]\nstage_trace = true\n'.format(tmp_path))
+    configuration.load_configuration([str(cfg)])
+    try:
+        process = Process()
+        assert process._handler(None, 'response') == 'response'
+    finally:
+        configuration.load_configuration()
+
+    trace = json.load(open(str(tmp_path / 'abc' / TRACE_FILENAME)))
+    assert [e['name'] for e in trace['traceEvents']] == ['compute']
+    assert trace['otherData']['process'] == 'test'
@@ -0,0 +1,44 @@
+import pytest
+import shapely
+
+from flyingpigeon import grid
+from flyingpigeon import subset
+from .common import TESTDATA
+
+
+@pytest.mark.parametrize('key', ['cmip5_tasmax_2006_nc', 'cordex_tasmax_2006_nc'])
+def test_simplify_geometries(key):
+    lon, lat = grid.get_coordinates(TESTDATA[key][7:])
+    cells = grid.cell_polygons(lon, lat)
+
+    simplified_any = False
+    for country in ['DEU', 'FRA', 'GBR', 'NOR', 'ITA', 'GRC']:
+        shapes = subset.get_geometries('countries', subset.get_ugid(country, 'countries'))
+        for shape, simple in zip(shapes, subset.simplify_geometries(shapes, 'countries', lon, lat)):
+            assert (shapely.intersects(shape['geom'], cells) == shapely.intersects(simple['geom'], cells)).all()
+            simplified_any |= simple['geom'] is not shape['geom']
+
+    assert simplified_any
+
+
+def test_weighted_mean():
+    import numpy as np
+    values = np.ma.masked_invalid(np.array([[[1., 3.], [np.nan, 5.]]] * 2))
+    weights = np.array([[1., .5], [1., .5]])
+    mean = subset._weighted_mean(values, ('time', 'lat', 'lon'), 'lat', 'lon', weights)
+    assert mean.shape == (2, 1, 1)
+    # The masked cell is left out of the weights.
+    assert np.allclose(mean, (1 + 1.5 + 2.5) / 2.)
+    lat = subset._weighted_mean(np.array([10., 20.]), ('lat',), 'lat', 'lon', weights)
+    assert np.allclose(lat, (10 * 1.5 + 20 * 1.5) / 3.)
+
+
+def test_simplify_geometries_verdicts(monkeypatch):
+    lon, lat = grid.get_coordinates(TESTDATA['cmip5_tasmax_2006_nc'][7:])
+    shapes = subset.get_geometries('countries', subset.get_ugid('DEU', 'countries'))
+    first = subset.simplify_geometries(shapes, 'countries', lon, lat)
+
+    # The verdicts of a known grid and geometry are reused.
+    monkeypatch.setattr(subset, 'selection_preserved', None)
+    assert [s['geom'] for s in subset.simplify_geometries(shapes, 'countries', lon, lat)] == \
+        [s['geom'] for s in first]
@@ -0,0 +1,59 @@
+import pytest
+from shapely.geometry import box, mapping
+
+from flyingpigeon.cache import DiskCache
+from flyingpigeon.processes import subset_base
+
+from .common import StandInServer, feature_collection, wfs_respond
+
+
+def test_make_geoms_mosaic():
+    feature = feature_collection([mapping(box(0, 0, 1, 1)), mapping(box(1, 0, 2, 1)), mapping(box(2, 0, 3, 1))])
+
+    geoms = subset_base.make_geoms(feature)
+    assert len(geoms) == 3
+
+    mosaic = subset_base.make_geoms(feature, mosaic=True)
+    assert mosaic['geom'].equals(box(0, 0, 3, 1))
+    assert mosaic['properties'] == {'bbox': [0, 0, 3, 1]}
+    # Input features are left untouched.
+    assert geoms[0]['geom'].equals(box(0, 0, 1, 1))
+
+
+def boxes(ids):
+    return [mapping(box(i, 0, i + 1, 1)) for i in range(len(ids))]
+
+
+@pytest.fixture
+def wfs():
+    with StandInServer(wfs_respond(boxes)) as server:
+        yield server
+
+
+def test_get_feature_cache(wfs, tmp_path, monkeypatch):
+    monkeypatch.setattr(subset_base, 'get_disk_cache', lambda name, size_option=None: DiskCache(str(tmp_path / name)))
+
+    feature = subset_base.get_feature(wfs.url + '/wfs', 'public:countries', ['countries.2', 'countries.1'])
+    assert len(feature['features']) == 2
+    assert wfs.queries()[0]['request'] == ['GetFeature']
+    assert wfs.queries()[0]['version'] == ['1.1.0']
+    assert wfs.queries()[0]['typename'] == ['public:countries']
+
+    # Same features in another order are read from the cache.
+    assert subset_base.get_feature(wfs.url + '/wfs', 'public:countries', ['countries.1', 'countries.2']) == feature
+    assert len(wfs.requests) == 1
+
+    # Expired entries are fetched again.
+    monkeypatch.setattr(subset_base, 'get_feature_cache_ttl', lambda: 0)
+    subset_base.get_feature(wfs.url + '/wfs', 'public:countries', ['countries.1', 'countries.2'])
+    assert len(wfs.requests) == 2
+
+
+def test_get_mosaic_cache_disabled(wfs, tmp_path, monkeypatch):
+    monkeypatch.setattr(subset_base, 'get_disk_cache', lambda name, size_option=None: DiskCache(str(tmp_path / name)))
+    monkeypatch.setattr(subset_base, 'get_feature_cache_ttl', lambda: 0)
+
+    mosaic = subset_base.get_mosaic(wfs.url + '/wfs', 'public:countries', ['countries.1', 'countries.2'])
+    assert mosaic['geom'].equals(box(0, 0, 2, 1))
+    # Neither the features nor the mosaic are written to the disk caches.
+    assert not any(tmp_path.iterdir())
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+from pywps import configuration
+from pywps.exceptions import ServerBusy
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from flyingpigeon.processes.wps_say_hello import SayHello
+from flyingpigeon.service import Service
+from flyingpigeon.workdir import QuotaExceeded, Workdir, has_free_space, managed
+
+EXECUTE = '/wps?service=WPS&request=Execute&version=1.0.0&identifier=hello&datainputs=name=LovelySugarDove'
+
+
+@pytest.fixture
+def config(tmp_path):
+    def load(**options):
+        cfg = tmp_path / 'test.cfg'
+        cfg.write_text('[server]\nworkdir = {0}\noutputpath = {0}\n[extra]\n{1}\n'.format(
+            tmp_path, '\n'.join('{} = {}'.format(*item) for item in options.items())))
+        configuration.load_configuration([str(cfg)])
+        return str(cfg)
+    yield load
+    configuration.load_configuration()
+
+
+def write(path, size=10):
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def test_intermediate_files(tmp_path):
+    files = Workdir(str(tmp_path))
+    inpt, out = write(tmp_path / 'input.nc'), write(tmp_path / 'output.nc')
+    files.intermediate(inpt, out)
+    files.output(out)
+    files.consumed(inpt, out)
+    assert not os.path.exists(inpt)
+    assert os.path.exists(out)
+
+    tmp = files.mkdtemp()
+    write(tmp_path / tmp / 'clipped.nc')
+    files.cleanup()
+    assert not os.path.exists(tmp)
+    assert os.path.exists(out)
+
+
+def test_files_outside_workdir(tmp_path):
+    (tmp_path / 'workdir').mkdir()
+    local = write(tmp_path / 'local.nc')
+    files = Workdir(str(tmp_path / 'workdir'))
+    files.intermediate(local, 'http://example.org/workdir/remote.nc')
+    files.cleanup()
+    assert os.path.exists(local)
+    assert files.intermediates == set()
+
+
+def test_quota(tmp_path):
+    files = Workdir(str(tmp_path), quota=100)
+    files.intermediate(write(tmp_path / 'a.nc', 60))
+    with pytest.raises(QuotaExceeded):
+        files.output(write(tmp_path / 'b.nc', 60))
+
+
+def test_managed(tmp_path, config):
+    config(workdir_quota='1kb')
+
+    class Handler(object):
+        workdir = str(tmp_path)
+
+        @managed
+        def handler(self, request, response):
+            self.files.intermediate(write(tmp_path / 'input.nc', 100))
+            self.files.output(write(tmp_path / 'output.nc', 2000))
+
+    with pytest.raises(QuotaExceeded):
+        Handler().handler(None, None)
+    assert not (tmp_path / 'input.nc').exists()
+
+
+def test_free_space(config):
+    config(min_free_space='1gb')
+    assert has_free_space()
+    config(min_free_space='1000000000gb')
+    assert not has_free_space()
+    config(min_free_space='')
+    assert has_free_space()
+
+
+def test_refused_without_free_space(config):
+    cfg = config(min_free_space='1000000000gb')
+    client = Client(Service(processes=[SayHello()], cfgfiles=[cfg]), BaseResponse)
+    resp = client.get(EXECUTE)
+    assert resp.status_code == ServerBusy.code
+    assert b'ServerBusy' in resp.get_data()
+    assert b'free disk space' in resp.get_data()
+
+
+def test_stored_requests_kept_without_free_space(config, monkeypatch):
+    from pywps import dblog
+    popped = []
+    monkeypatch.setattr(dblog, 'pop_first_stored', lambda: popped.append(1))
+
+    cfg = config(min_free_space='1000000000gb')
+    process = Service(processes=[SayHello()], cfgfiles=[cfg]).prepare_process_for_execution('hello')
+    process.launch_next_process()
+    assert popped == []
+
+    config(min_free_space='')
+    process.launch_next_process()
+    assert popped == [1]
@@ -1,10 +1,14 @@
+import subprocess
+import sys
+
+import pytest
 from pywps import Service
 from .common import client_for
-from flyingpigeon.processes import processes
+from flyingpigeon.processes import get_processes
 
 
 def test_wps_caps():
-    client = client_for(Service(processes=processes))
+    client = client_for(Service(processes=get_processes()))
     resp = client.get(service='wps', request='getcapabilities', version='1.0.0')
     names = resp.xpath_text('/wps:Capabilities'
                             '/wps:ProcessOfferings'
@@ -20,3 +24,36 @@ def test_wps_caps():
         'subset_continents',
         'subset_countries',
     ]
+
+
+def test_processes_lazy_imports():
+    # The computation stacks are only imported by Execute requests.
+    code = "import sys, flyingpigeon.wsgi; print([m for m in ('ocgis', 'eggshell', 'matplotlib') if m in sys.modules])"
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == '[]'
+
+
+def test_process_registry(monkeypatch):
+    from flyingpigeon.processes import registry, _register, PlottimeseriesProcess
+    assert [cls().identifier for cls in registry.values()] == list(registry)
+
+    # Only the selected processes are instantiated.
+    created = []
+    monkeypatch.setattr(PlottimeseriesProcess, '__init__', lambda self: created.append(self))
+    assert [p.identifier for p in get_processes(['subset_countries', 'subset_bbox'])] == \
+        ['subset_bbox', 'subset_countries']
+    assert created == []
+    with pytest.raises(ValueError):
+        get_processes(['subset_bbox', 'unknown'])
+    with pytest.raises(ValueError):
+        _register([PlottimeseriesProcess, PlottimeseriesProcess])
+
+
+def test_enabled_processes(tmp_path):
+    from flyingpigeon.wsgi import create_app
+    cfg = tmp_path / 'subset.cfg'
+    cfg.write_text('[extra]\nprocesses = subset_bbox, subset_countries\n')
+    try:
+        assert sorted(create_app([str(cfg)]).processes) == ['subset_bbox', 'subset_countries']
+    finally:
+        create_app()
@@ -22,3 +22,18 @@ def test_wps_pointinspection():
         identifier='pointinspection',
         datainputs=datainputs)
     assert_response_success(resp)
+
+
+def test_wps_pointinspection_points_file():
+    client = client_for(
+        Service(processes=[PointinspectionProcess()], cfgfiles=CFG_FILE))
+    datainputs = (
+        "resource=files@xlink:href={0};"
+        "points=stations@xlink:href={1}@mimeType=text/csv;"
+        "deduplicate=1;"
+    ).format(TESTDATA['cmip5_tasmax_2006_nc'], TESTDATA['stations_csv'])
+    resp = client.get(
+        service='wps', request='execute', version='1.0.0',
+        identifier='pointinspection',
+        datainputs=datainputs)
+    assert_response_success(resp)
@@ -18,6 +18,7 @@ from ocgis.base import get_variable_names
 from ocgis.test.base import TestBase
 
 from eggshell.utils import local_path
+import flyingpigeon.ocgisDissimilarity  # noqa: F401
 from flyingpigeon.processes import SpatialAnalogProcess, PlotSpatialAnalogProcess
 from .common import TESTDATA, client_for, CFG_FILE
 
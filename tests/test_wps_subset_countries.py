@@ -5,6 +5,7 @@ from pywps.tests import assert_response_success
 
 from flyingpigeon.processes import SubsetcountryProcess
 from tests.common import TESTDATA, client_for, get_output, CFG_FILE
+from tests.common import HISTORICAL_PAIR, historical_archive, fake_clipping
 
 
 datainputs_fmt = (
@@ -37,3 +38,21 @@ def test_wps_subset_countries():
     # ins = os.path.getsize(TESTDATA['cmip5_tasmax_2006_nc'][6:])
     # outs = os.path.getsize(out['ncout'][6:])
     # assert (outs < ins)
+
+
+def test_historical_concatenation(tmp_path, monkeypatch):
+    pytest.importorskip('ocgis')
+    from flyingpigeon import subset
+    calls = []
+    monkeypatch.setattr(subset, 'clipping', fake_clipping(calls))
+
+    client = client_for(Service(processes=[SubsetcountryProcess()], cfgfiles=CFG_FILE))
+    datainputs = datainputs_fmt.format('file://' + historical_archive(str(tmp_path / 'input.tar')), 'DEU', 'False')
+    resp = client.get(
+        service='wps', request='execute', version='1.0.0',
+        identifier='subset_countries',
+        datainputs=datainputs)
+
+    assert_response_success(resp)
+    # The historical and scenario files are clipped as a single time series.
+    assert calls == [HISTORICAL_PAIR]